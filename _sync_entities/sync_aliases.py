@@ -0,0 +1,176 @@
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+# pylint: disable=unused-argument
+
+
+"""
+Short topic aliases - event types and entity ids as short tokens, negotiated per peer.
+
+    mqtt_shared/seattle/all/state/input_select.home_mode  -->  mqtt_shared/seattle/all/~0/~1c
+
+Each site numbers the names it publishes (0, 1, 2, ... as they are first used) and publishes
+the list:
+
+    mqtt_shared/seattle/all/aliases       {"epoch": 1690000000, "names": ["state", ...]}
+    mqtt_shared/haven/seattle/aliases_ack {"epoch": 1690000000, "n": 58}
+
+A token is only used toward a peer once that peer has acked a list that includes it - and
+for tohost "all", once *every* peer heard from recently has. A site that does not understand
+aliases never acks, so it keeps getting full topics (and so does "all").
+
+Inbound, expand() turns tokens back into names (a list index) before anything else looks at
+the topic. Fromhost and tohost are never aliased - brokers and bridges may route on them.
+
+A restarted site has lost the lists - it asks for them (send_aliases), and drops aliased
+messages until they arrive.
+"""
+
+TOKEN_PREFIX = "~"
+# Never aliased - needed to agree on aliases in the first place
+NEGOTIATION_EVENT_TYPES = frozenset(["aliases", "aliases_ack", "send_aliases"])
+
+_DIGITS = "0123456789abcdefghijklmnopqrstuvwxyz"
+
+
+def _token(index: int) -> str:
+    digits = ""
+    while True:
+        (index, digit) = divmod(index, 36)
+        digits = _DIGITS[digit] + digits
+        if not index:
+            return TOKEN_PREFIX + digits
+
+
+class TopicAliases:
+    def __init__(
+        self,
+        myhostname: str,
+        max_names: int = 4096,
+        peer_timeout: float = 600,
+        on_unknown: Optional[Callable[[str], None]] = None,
+    ):
+        self.myhostname = myhostname
+        self.max_names = max_names
+        self.peer_timeout = peer_timeout
+        # on_unknown(fromhost) - an aliased message from a host whose list we don't have
+        self.on_unknown = on_unknown
+        self.epoch = int(time.time())
+        self.dirty = False  # New names since the list was last published
+        self.unknown = 0
+
+        self._lock = threading.Lock()
+        # Mine (outbound)
+        self._names: List[str] = []
+        self._tokens: Dict[str, str] = {}  # name -> token
+        self._acked: Dict[str, int] = {}  # host -> how many of my names it has
+        self._peers: Dict[str, float] = {}  # host -> last heard from (monotonic)
+        # Theirs (inbound): host -> (epoch, names)
+        self._tables: Dict[str, Tuple[int, List[str]]] = {}
+
+    #
+    # Outbound
+    #
+    def table(self) -> dict:
+        return {"epoch": self.epoch, "names": list(self._names)}
+
+    def acked(self, host: str, epoch, count) -> bool:
+        if epoch != self.epoch or not isinstance(count, int):
+            return False  # For an older list of mine (before a restart)
+        self._acked[host] = min(count, len(self._names))
+        return True
+
+    def forget_peer(self, host: str):
+        """
+        host lost my list (eg: it restarted) - full topics to it, until it acks again.
+        """
+        self._acked.pop(host, None)
+
+    def _usable(self, tohost: str) -> int:
+        """
+        How many of my names tohost has (for "all": every recent peer).
+        """
+        if tohost != "all":
+            return self._acked.get(tohost, 0)
+        now = time.monotonic()
+        peers = [
+            host
+            for (host, heard) in list(self._peers.items())
+            if now - heard < self.peer_timeout
+        ]
+        if not peers:
+            return 0
+        return min(self._acked.get(host, 0) for host in peers)
+
+    def _alias(self, name: str, usable: int) -> str:
+        token = self._tokens.get(name)
+        if token is None:
+            self._define(name)
+            return name
+        return token if int(token[1:], 36) < usable else name
+
+    def _define(self, name: str):
+        with self._lock:
+            if name in self._tokens or len(self._names) >= self.max_names:
+                return
+            self._tokens[name] = _token(len(self._names))
+            self._names.append(name)
+            self.dirty = True
+
+    def compress(self, topic: str) -> str:
+        """
+        mqtt_shared/seattle/haven/state/light.office --> mqtt_shared/seattle/haven/~0/~5
+        (Only the parts haven has acked.)
+        """
+        parts = topic.split("/", 4)
+        if len(parts) < 4 or parts[3] in NEGOTIATION_EVENT_TYPES:
+            return topic
+        usable = self._usable(parts[2])
+        parts[3] = self._alias(parts[3], usable)
+        if len(parts) == 5:
+            parts[4] = self._alias(parts[4], usable)
+        return "/".join(parts)
+
+    #
+    # Inbound
+    #
+    def learn(self, host: str, table) -> Optional[int]:
+        """
+        table - {"epoch": ..., "names": [...]} from host. Returns the count to ack (None if bad).
+        """
+        if not isinstance(table, dict):
+            return None
+        names = table.get("names")
+        if not isinstance(names, list) or not all(isinstance(n, str) for n in names):
+            return None
+        self._tables[host] = (table.get("epoch"), names)
+        return len(names)
+
+    def expand(self, topic: Optional[str]) -> Optional[str]:
+        """
+        mqtt_shared/seattle/haven/~0/~5 --> mqtt_shared/seattle/haven/state/light.office
+        None if a token is unknown (on_unknown is called).
+        """
+        if not topic:
+            return topic
+        parts = topic.split("/", 4)
+        if len(parts) < 4 or parts[1] == self.myhostname:
+            return topic  # (My own, echoed back - the loop guard drops those)
+        self._peers[parts[1]] = time.monotonic()
+        if TOKEN_PREFIX not in topic:
+            return topic
+
+        table = self._tables.get(parts[1])
+        names = table[1] if table else ()
+        for index in range(3, len(parts)):
+            part = parts[index]
+            if part.startswith(TOKEN_PREFIX):
+                try:
+                    parts[index] = names[int(part[1:], 36)]
+                except (ValueError, IndexError):
+                    self.unknown += 1
+                    if self.on_unknown:
+                        self.on_unknown(parts[1])
+                    return None
+        return "/".join(parts)
@@ -0,0 +1,162 @@
+import itertools
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass
+from typing import Any, Callable, Deque, Dict, Optional
+
+from _sync_entities.sync_log import SyncLogger
+from appdaemon.adapi import ADAPI
+
+# pylint: disable=unused-argument
+
+
+"""
+Outbound command tracking (acks / nacks)
+
+    seattle: mqtt_shared/seattle/haven/event/light.office   {"state": "on", "cid": "seattle-17"}
+    haven:   mqtt_shared/haven/seattle/ack/light.office     {"cid": "seattle-17", "ok": true, "state": "on"}
+
+The receiver acks once it *sees* the state change (listen_state), not with an immediate read-back.
+If nothing comes back within `timeout` seconds, the command fails with reason "timeout".
+
+Pipelining: up to `max_in_flight` commands may be outstanding per host. Extra commands queue
+and go out as acks (or timeouts) free up slots. max_in_flight=1 is stop-and-wait.
+"""
+
+# success_cb(cid, detail) / failure_cb(cid, reason)
+CommandCallbackType = Callable[[str, Any], Any]
+
+
+@dataclass
+class PendingCommand:
+    cid: str
+    tohost: str
+    entity: Optional[str]  # None for bulk_event
+    payload: Any
+    success_cb: Optional[CommandCallbackType] = None
+    failure_cb: Optional[CommandCallbackType] = None
+    event_type: str = "event"
+    sent_at: Optional[float] = None
+    timer: Optional[str] = None
+
+
+class CommandTracker:
+    def __init__(
+        self,
+        adapi: ADAPI,
+        myhostname: str,
+        send_fn: Callable[[PendingCommand], None],
+        timeout: float = 10,
+        max_in_flight: int = 32,
+        on_result: Optional[Callable[[PendingCommand, bool, Any], None]] = None,
+        log: Optional[SyncLogger] = None,
+    ):
+        self.adapi = adapi
+        self.log = log if log else SyncLogger(adapi)
+        self.send_fn = send_fn
+        self.on_result = on_result
+        self.timeout = timeout
+        self.max_in_flight = max(1, max_in_flight)
+
+        self._cids = (f"{myhostname}-{i}" for i in itertools.count(1))
+        # Guards the bookkeeping below. Never held while sending or calling back.
+        self._lock = threading.Lock()
+        self._in_flight: Dict[str, PendingCommand] = {}  # cid -> command
+        self._in_flight_per_host: Dict[str, int] = {}
+        self._waiting: Dict[str, Deque[PendingCommand]] = {}  # tohost -> queue
+
+    def submit(
+        self,
+        tohost: str,
+        entity: Optional[str],
+        payload: Any,
+        success_cb: Optional[CommandCallbackType] = None,
+        failure_cb: Optional[CommandCallbackType] = None,
+        event_type: str = "event",
+    ) -> str:
+        with self._lock:
+            command = PendingCommand(
+                next(self._cids),
+                tohost,
+                entity,
+                payload,
+                success_cb,
+                failure_cb,
+                event_type,
+            )
+            send_now = self._in_flight_per_host.get(tohost, 0) < self.max_in_flight
+            if send_now:
+                self._reserve(command)
+            else:
+                self._waiting.setdefault(tohost, deque()).append(command)
+        if send_now:
+            self._send(command)
+        return command.cid
+
+    def in_flight(self, tohost: Optional[str] = None) -> int:
+        if tohost is None:
+            return len(self._in_flight)
+        return self._in_flight_per_host.get(tohost, 0)
+
+    def _reserve(self, command: PendingCommand):
+        # With self._lock held
+        self._in_flight[command.cid] = command
+        self._in_flight_per_host[command.tohost] = (
+            self._in_flight_per_host.get(command.tohost, 0) + 1
+        )
+
+    def _send(self, command: PendingCommand):
+        command.sent_at = time.monotonic()
+        command.timer = self.adapi.run_in(
+            self._cb_timeout, self.timeout, cid=command.cid
+        )
+        self.send_fn(command)
+
+    def _complete(self, cid: str) -> Optional[PendingCommand]:
+        with self._lock:
+            command = self._in_flight.pop(cid, None)
+            if command is None:
+                return None  # Already acked or timed out
+            self._in_flight_per_host[command.tohost] -= 1
+
+            waiting = self._waiting.get(command.tohost)
+            next_command = waiting.popleft() if waiting else None
+            if next_command:
+                self._reserve(next_command)
+        if next_command:
+            self._send(next_command)
+        return command
+
+    def on_ack(self, cid: str, ok: bool, detail: Any = None) -> bool:
+        """
+        Returns False if the cid is unknown (eg: it already timed out)
+        """
+        command = self._complete(cid)
+        if command is None:
+            return False
+        if command.timer:
+            self.adapi.cancel_timer(command.timer)
+
+        if self.on_result:
+            self.on_result(command, ok, detail)
+        if ok and command.success_cb:
+            command.success_cb(cid, detail)
+        elif not ok and command.failure_cb:
+            command.failure_cb(cid, detail)
+        return True
+
+    def _cb_timeout(self, kwargs):
+        command = self._complete(kwargs["cid"])
+        if command is None:
+            return
+        self.log.warning(
+            "CommandTracker: timeout - %s -> %s/%s",
+            command.cid,
+            command.tohost,
+            command.entity,
+        )
+        if self.on_result:
+            self.on_result(command, False, "timeout")
+        if command.failure_cb:
+            command.failure_cb(command.cid, "timeout")
@@ -0,0 +1,118 @@
+import threading
+from collections import deque
+from typing import Any, Callable, Deque, Hashable, List, Optional
+
+from _sync_entities.sync_log import SyncLogger
+
+# pylint: disable=unused-argument
+
+
+"""
+Concurrency model - for when AppDaemon runs this app's callbacks on several worker threads
+(ie: the app is not pinned to one thread).
+
+Inbound messages are dispatched in parallel, *partitioned*: every message for the same
+(fromhost, entity) lands in the same partition, and a partition handles its messages one at
+a time, in arrival order. Different partitions run at the same time, on whichever threads
+delivered their messages. No threads of our own.
+
+    partitions = Partitions(handler, count=16)
+    partitions.submit(partition_key(topic), item)   # --> handler(item), maybe on another thread
+
+Shared state follows three rules:
+    * Read-mostly structures are swapped, not mutated (ListenerRegistry snapshots)
+    * Small bookkeeping dicts use single atomic operations (dict.pop(key, None), not "if in: del")
+    * Anything else takes a lock - one per object, or StripedLock, one of N by key, where
+      unrelated keys should not wait on each other
+
+Log sampling counters (SyncLogger) are left unlocked - a lost increment only shifts a sample.
+"""
+
+
+def partition_key(topic: Optional[str]) -> str:
+    """
+    mqtt_shared/haven/seattle/state/light.office --> "haven/light.office"
+    mqtt_shared/haven/all/state/light.office     --> "haven/light.office" (same partition)
+    mqtt_shared/haven/seattle/ping               --> the topic
+    """
+    if not topic:
+        return ""
+    parts = topic.split("/", 4)
+    if len(parts) == 5:
+        return f"{parts[1]}/{parts[4]}"
+    return topic
+
+
+class StripedLock:
+    """
+    N locks, picked by key. Same key, same lock.
+
+        locks = StripedLock(16)
+        with locks.for_key("light.office"):
+            ...
+    """
+
+    def __init__(self, stripes: int = 16):
+        self._locks = [threading.Lock() for _ in range(max(1, stripes))]
+
+    def __len__(self):
+        return len(self._locks)
+
+    def for_key(self, key: Hashable) -> threading.Lock:
+        return self._locks[hash(key) % len(self._locks)]
+
+
+class Partitions:
+    """
+    submit() queues the item on its key's partition. If no thread is working that partition,
+    the calling thread does - until the partition's queue is empty. Otherwise it returns right
+    away, and the thread already working the partition handles the item after the ones before it.
+
+    A handler may submit() again (even to its own partition) - that item is just queued.
+    """
+
+    def __init__(
+        self,
+        handler: Callable[[Any], Any],
+        count: int = 16,
+        log: Optional[SyncLogger] = None,
+    ):
+        self.handler = handler
+        self.log = log
+        count = max(1, count)
+        self._locks = StripedLock(count)
+        self._queues: List[Deque[Any]] = [deque() for _ in range(count)]
+        self._busy = [False] * count
+
+    def __len__(self):
+        return len(self._queues)
+
+    def pending(self) -> int:
+        return sum(len(queue) for queue in self._queues)
+
+    def submit(self, key: Hashable, item: Any):
+        index = hash(key) % len(self._queues)
+        lock = self._locks.for_key(key)
+        with lock:
+            self._queues[index].append(item)
+            if self._busy[index]:
+                return  # That thread will get to it
+            self._busy[index] = True
+        self._work(index, lock)
+
+    def _work(self, index: int, lock: threading.Lock):
+        queue = self._queues[index]
+        while True:
+            with lock:
+                if not queue:
+                    self._busy[index] = False
+                    return
+                item = queue.popleft()
+            try:
+                self.handler(item)
+            except Exception as err:  # pylint: disable=broad-except
+                # One bad message must not stall the partition
+                if self.log:
+                    self.log.error(
+                        "Partitions - handler failed: %s -- %.80s", err, item
+                    )
@@ -0,0 +1,94 @@
+import threading
+import zlib
+from typing import Dict, Iterable, List, Optional, Tuple
+
+# pylint: disable=unused-argument
+
+
+"""
+Bucketed state digests, for anti-entropy repair.
+
+Each synced entity falls in one of N buckets (by a hash of its name). A bucket's hash is the
+XOR of hash(entity, state) over its entities - so it is order independent, and can be kept up
+to date incrementally as states are published.
+
+    haven:   mqtt_shared/haven/all/digest           {"n": 64, "b": [2212294583, 0, ...]}
+    seattle: (compares with its mirrors of haven - buckets 3 and 17 differ)
+             mqtt_shared/seattle/haven/send_state   {"n": 64, "buckets": [3, 17]}
+    haven:   (resends the entities in buckets 3 and 17, then)
+             mqtt_shared/haven/seattle/repaired     {"n": 64, "buckets": [3, 17], "entities": [...]}
+    seattle: (forgets mirrors in those buckets that haven no longer syncs)
+
+A digest costs N numbers, however many entities there are, and a repair costs the entities
+in the buckets that differ - not a full send_state.
+"""
+
+
+def bucket_for(entity: str, buckets: int) -> int:
+    # crc32, not hash() - it has to be the same on every site
+    return zlib.crc32(entity.encode("utf-8")) % buckets
+
+
+def mirrored_state(state) -> str:
+    """
+    A state as a mirror ends up with it - what both sides hash. None (no such entity, published
+    as an empty payload) is "".
+    """
+    return "" if state is None else str(state)
+
+
+def item_hash(entity: str, state) -> int:
+    return zlib.crc32(f"{entity}\t{mirrored_state(state)}".encode("utf-8"))
+
+
+class BucketDigest:
+    def __init__(self, buckets: int = 64):
+        self.n = max(1, buckets)
+        self._lock = threading.Lock()
+        self._buckets = [0] * self.n
+        self._items: Dict[str, int] = {}  # entity -> item_hash
+
+    @classmethod
+    def of(cls, items: Iterable[Tuple[str, object]], buckets: int) -> "BucketDigest":
+        """
+        BucketDigest.of([("light.office", "on"), ...], 64)
+        """
+        digest = cls(buckets)
+        for (entity, state) in items:
+            digest.set(entity, state)
+        return digest
+
+    def __len__(self):
+        return len(self._items)
+
+    def set(self, entity: str, state):
+        new = item_hash(entity, state)
+        index = bucket_for(entity, self.n)
+        with self._lock:
+            old = self._items.get(entity)
+            if old == new:
+                return
+            if old is not None:
+                self._buckets[index] ^= old
+            self._buckets[index] ^= new
+            self._items[entity] = new
+
+    def remove(self, entity: str):
+        with self._lock:
+            old = self._items.pop(entity, None)
+            if old is not None:
+                self._buckets[bucket_for(entity, self.n)] ^= old
+
+    def buckets(self) -> List[int]:
+        with self._lock:
+            return list(self._buckets)
+
+    def diff(self, other: List[int]) -> Optional[List[int]]:
+        """
+        Indexes of the buckets that differ from other (another site's buckets()).
+        None if other is not a digest with the same number of buckets.
+        """
+        if not isinstance(other, list) or len(other) != self.n:
+            return None
+        mine = self.buckets()
+        return [index for index in range(self.n) if mine[index] != other[index]]
@@ -1,8 +1,20 @@
 import json
+import threading
+import time
 from dataclasses import dataclass
-from typing import Any, Callable, Optional, Union
+from typing import Any, Callable, Dict, Optional, Tuple, Union
 
 import adplus
+from _sync_entities.sync_log import SyncLogger
+from _sync_entities.sync_loop_guard import Envelope, LoopGuard, unwrap_payload
+from _sync_entities.sync_message_ring import (
+    DROPPED,
+    ERROR,
+    NO_MATCH,
+    OK,
+    MessageRing,
+)
+from _sync_entities.sync_profiler import ProfileSession
 from appdaemon.adapi import ADAPI
 
 adplus.importlib.reload(adplus)
@@ -63,8 +75,10 @@ class EventParts:
         mqtt_base_topic: str,
         event: str,
         pattern: Optional[EventPattern],
+        log: Optional[SyncLogger] = None,
     ):
         self.adapi = adapi
+        self.log = log
         self.mqtt_base_topic = mqtt_base_topic
         self.event = event
         self._pattern_fromhost = pattern.pattern_fromhost if pattern else None
@@ -85,15 +99,14 @@ class EventParts:
     def _do_split(self):
         parts = self.event.split("/")
         if len(parts) < 4 or len(parts) > 5:
-            self.adapi.log(
-                f"match failed - improper format: {self.event}", level="WARNING"
-            )
+            self._warn("match failed - improper format: %s", self.event)
             return False
 
         if parts[0] != self.mqtt_base_topic:
-            self.adapi.log(
-                f"split failed - does not start with {self.mqtt_base_topic}: {self.event}",
-                level="WARNING",
+            self._warn(
+                "split failed - does not start with %s: %s",
+                self.mqtt_base_topic,
+                self.event,
             )
             return False
 
@@ -103,6 +116,13 @@ class EventParts:
         self.entity = parts[4] if len(parts) >= 5 else None
         return True
 
+    def _warn(self, msg: str, *args):
+        # Bad topics tend to come in floods - so rate limit if we can
+        if self.log:
+            self.log.warning_ratelimited("EventParts", msg, *args)
+        else:
+            self.adapi.log(msg % args, level="WARNING")
+
     def _match_pattern(
         self, value: Optional[str], pattern: Optional[str], special_all: bool = False
     ) -> bool:
@@ -135,6 +155,25 @@ class EventParts:
             and self._match_pattern(self.entity, self._pattern_entity)
         )
 
+    def match(self, pattern: Optional[EventPattern]) -> bool:
+        """
+        Match the (already split) event against another pattern, without splitting again.
+        """
+        if self.fromhost is None:
+            return False
+        if pattern is None:
+            return True
+        return (
+            self._match_pattern(
+                self.fromhost, pattern.pattern_fromhost, special_all=True
+            )
+            and self._match_pattern(
+                self.tohost, pattern.pattern_tohost, special_all=True
+            )
+            and self._match_pattern(self.event_type, pattern.pattern_event_type)
+            and self._match_pattern(self.entity, pattern.pattern_entity)
+        )
+
 
 # Dispatcher Callback Signature
 # my_callback(fromhost, tohost, event_str, entity_str, payload, payload_asobj=None) -> Any
@@ -150,6 +189,104 @@ class EventListener:
     callback: Optional[DispatcherCallbackType]
 
 
+class ListenerSnapshot:
+    """
+    Immutable view of the listeners at one generation, with a routing index:
+        event_type -> listeners that could match it, in registration order
+
+    Listeners with no event_type (or a "!negated" one) could match anything, so they are in
+    every route, and in `wildcard` (for event types nobody registered for).
+    """
+
+    def __init__(self, generation: int, listeners: Tuple[EventListener, ...]):
+        self.generation = generation
+        self.listeners = listeners
+        self.wildcard = tuple(
+            listener
+            for listener in listeners
+            if not _routes_by_event_type(listener.pattern)
+        )
+        event_types = {
+            listener.pattern.pattern_event_type
+            for listener in listeners
+            if _routes_by_event_type(listener.pattern)
+        }
+        self.routes: Dict[str, Tuple[EventListener, ...]] = {
+            event_type: tuple(
+                listener
+                for listener in listeners
+                if not _routes_by_event_type(listener.pattern)
+                or listener.pattern.pattern_event_type == event_type
+            )
+            for event_type in event_types
+        }
+
+    def candidates(self, event_type: Optional[str]) -> Tuple[EventListener, ...]:
+        return self.routes.get(event_type, self.wildcard)
+
+
+def _routes_by_event_type(pattern: Optional[EventPattern]) -> bool:
+    event_type = pattern.pattern_event_type if pattern else None
+    return bool(event_type) and event_type[0] != "!"
+
+
+class ListenerRegistry:
+    """
+    Listeners by name. add / replace / remove are O(1).
+
+    Every change bumps the generation. snapshot() returns the ListenerSnapshot for the current
+    generation - rebuilt (once) after a change, otherwise the same object. A dispatch iterates
+    its snapshot without holding any lock, so listeners can be changed (from another thread, or
+    from inside a callback) while a message is being dispatched; that message finishes with the
+    listeners it started with.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._listeners: Dict[str, EventListener] = {}
+        self._generation = 0
+        self._snapshot = ListenerSnapshot(0, ())
+
+    def __contains__(self, name: str):
+        return name in self._listeners
+
+    def __len__(self):
+        return len(self._listeners)
+
+    @property
+    def generation(self) -> int:
+        return self._generation
+
+    def put(self, listener: EventListener) -> bool:
+        """
+        Add, or replace the listener of the same name (which keeps its place in line).
+        Returns True if it replaced one.
+        """
+        with self._lock:
+            replaced = listener.name in self._listeners
+            self._listeners[listener.name] = listener
+            self._generation += 1
+        return replaced
+
+    def remove(self, name: str) -> Optional[EventListener]:
+        with self._lock:
+            listener = self._listeners.pop(name, None)
+            if listener is not None:
+                self._generation += 1
+        return listener
+
+    def snapshot(self) -> ListenerSnapshot:
+        snapshot = self._snapshot
+        if snapshot.generation == self._generation:
+            return snapshot
+        with self._lock:
+            if self._snapshot.generation != self._generation:
+                self._snapshot = ListenerSnapshot(
+                    self._generation, tuple(self._listeners.values())
+                )
+            return self._snapshot
+
+
 class EventListenerDispatcher:
     """
     This will dispatch *ALREADY CAUGHT* mqtt events and send them to the proper callback.
@@ -165,75 +302,171 @@ class EventListenerDispatcher:
     dispatcher.dispatch(mq_event, payload)
     """
 
-    def __init__(self, adapi: ADAPI, mqtt_base_topic: str):
+    def __init__(
+        self,
+        adapi: ADAPI,
+        mqtt_base_topic: str,
+        loop_guard: Optional[LoopGuard] = None,
+        log: Optional[SyncLogger] = None,
+    ):
         self.adapi = adapi
         self.mqtt_base_topic = mqtt_base_topic
+        self.loop_guard = loop_guard
+        self.log = log if log else SyncLogger(adapi)
+        # The message being dispatched - per thread, as messages may be dispatched in parallel
+        self._current = threading.local()
+        # Recently dispatched messages, if set. See sync_message_ring
+        self.ring: Optional[MessageRing] = None
+        # While profiling, listeners are timed (and maybe cProfiled). See sync_profiler
+        self.profile: Optional[ProfileSession] = None
+
+        self._listeners = ListenerRegistry()
+
+    @property
+    def current_envelope(self) -> Optional[Envelope]:
+        """
+        Envelope of the message being dispatched (None if not enveloped). For listeners.
+        """
+        return getattr(self._current, "envelope", None)
+
+    @property
+    def current_cause(self) -> Optional[Tuple[str, Optional[Envelope]]]:
+        """
+        (event_type, envelope) of the message being dispatched - None outside a listener.
+        For LoopGuard.outbound().
+        """
+        event_type = getattr(self._current, "event_type", None)
+        if event_type is None:
+            return None
+        return (event_type, self.current_envelope)
 
-        self._listeners = {}
+    @property
+    def current_namespace(self) -> Optional[str]:
+        """
+        mqtt namespace the message being dispatched arrived on
+        """
+        return getattr(self._current, "namespace", None)
 
     def add_listener(
         self, name, pattern: EventPattern, callback: Optional[DispatcherCallbackType]
     ):
         if name in self._listeners:
-            self.adapi.log(
-                f"add_listener - being asked to re-register following listener: {name}",
-                LEVEL="WARNING",
+            self.log.warning(
+                "add_listener - being asked to re-register following listener: %s",
+                name,
             )
-            del self._listeners["name"]
+        self.replace_listener(name, pattern, callback)
 
-        self._listeners[name] = EventListener(
-            name, pattern, callback if callback else self.default_callback
-        )
+    def replace_listener(
+        self, name, pattern: EventPattern, callback: Optional[DispatcherCallbackType]
+    ):
+        """
+        add_listener(), for when replacing an existing listener is expected (reconfiguring).
+        """
+        callback = callback if callback else self.default_callback
+        self._listeners.put(EventListener(name, pattern, callback))
 
     def remove_listener(self, name):
-        if name not in self._listeners:
-            self.adapi.log(
-                f"remove_listener - being asked to remove listener that is not found: {name}",
-                LEVEL="WARNING",
+        if self._listeners.remove(name) is None:
+            self.log.warning(
+                "remove_listener - being asked to remove listener that is not found: %s",
+                name,
             )
-            return
-        del self._listeners["name"]
 
     def default_callback(
         self, fromhost, tohost, event_type, entity, payload, payload_as_obj
     ) -> list:
         return [
-            self.adapi.log(
-                f"default_callback: {fromhost}/{tohost}/{event_type}/{entity} -- {payload}",
-                level="DEBUG",
+            self.log.debug(
+                "default_callback: %s/%s/%s/%s -- %.80s",
+                fromhost,
+                tohost,
+                event_type,
+                entity,
+                payload,
             )
         ]
 
     def safe_payload_as_obj(self, payload: str) -> Union[str, object]:
         return safe_payload_as_obj(payload, self.adapi)
 
-    def dispatch(self, mq_event, payload) -> list:
-        self.adapi.log(
-            f"dispatching mq_eventxx: {mq_event} -- {payload}", level="DEBUG"
+    def dispatch(self, mq_event, payload, namespace: Optional[str] = None) -> list:
+        try:
+            return self._dispatch(mq_event, payload, namespace)
+        finally:
+            # Whatever this thread publishes next is not caused by this message
+            self._current.envelope = None
+            self._current.event_type = None
+            self._current.namespace = None
+
+    def _dispatch(self, mq_event, payload, namespace: Optional[str]) -> list:
+        self.log.debug_sampled(
+            "dispatch", "dispatching: %s -- %.80s", mq_event, payload
         )
-        did_dispatch = False
-        results = []
-        for (
-            name,
-            listener,
-        ) in self._listeners.items():  # pylint: disable=unused-variable
-            ep = EventParts(
-                self.adapi, self.mqtt_base_topic, mq_event, listener.pattern
-            )
-            if ep.matches:
-                # self.adapi.log(f"dispatcher: dispatching to: {name}", level="DEBUG")
-                results.append(
-                    listener.callback(
-                        ep.fromhost,
-                        ep.tohost,
-                        ep.event_type,
-                        ep.entity,
+        ring = self.ring
+        started = time.perf_counter() if ring is not None else 0.0
+        envelope, payload = unwrap_payload(payload)
+        self._current.envelope = envelope
+        self._current.namespace = namespace
+        # Split once. Each listener's pattern is matched against the parts.
+        ep = EventParts(self.adapi, self.mqtt_base_topic, mq_event, None, self.log)
+        self._current.event_type = ep.event_type if ep.matches else None
+        if self.loop_guard:
+            if not ep.matches or not self.loop_guard.accept(
+                ep.fromhost, ep.tohost, ep.event_type, ep.entity, envelope
+            ):
+                if ring is not None:
+                    ring.record(
+                        time.time(),
+                        time.perf_counter() - started,
+                        DROPPED,
+                        namespace,
+                        mq_event,
                         payload,
-                        self.safe_payload_as_obj(payload),
                     )
+                return []
+
+        results = []
+        matched = []  # Listener names
+        payload_asobj = None
+        outcome = OK
+        profile = self.profile
+        try:
+            if ep.matches:
+                payload_asobj = self.safe_payload_as_obj(payload)
+                for listener in self._listeners.snapshot().candidates(ep.event_type):
+                    if ep.match(listener.pattern):
+                        matched.append(listener.name)
+                        callback = listener.callback
+                        if profile is not None:
+                            callback = profile.timed(listener.name, callback)
+                        results.append(
+                            callback(
+                                ep.fromhost,
+                                ep.tohost,
+                                ep.event_type,
+                                ep.entity,
+                                payload,
+                                payload_asobj,
+                            )
+                        )
+        except Exception:
+            outcome = ERROR
+            raise
+        finally:
+            if ring is not None:
+                ring.record(
+                    time.time(),
+                    time.perf_counter() - started,
+                    outcome if matched else NO_MATCH,
+                    namespace,
+                    mq_event,
+                    payload,
+                    tuple(matched),
                 )
-                did_dispatch = True
 
-        if not did_dispatch:
-            self.adapi.log(f"dispatcher: could not find pattern to match: {mq_event}.")
+        if not matched:
+            self.log.warning_ratelimited(
+                "no_match", "dispatcher: could not find pattern to match: %s.", mq_event
+            )
         return results
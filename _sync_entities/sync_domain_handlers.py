@@ -0,0 +1,265 @@
+import json
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Tuple
+
+# pylint: disable=unused-argument
+
+
+"""
+Inbound command -> Hass service call.
+
+A command is an entity, a desired state, and (optionally) extra fields from a JSON payload:
+
+    light.office        "on"                                    --> light/turn_on
+    light.office        {"state": "on", "brightness": 128}      --> light/turn_on(brightness=128)
+    climate.den         {"hvac_mode": "heat", "temperature": 20} --> climate/set_temperature(...)
+    cover.garage        "open"                                  --> cover/open_cover
+
+Resolution is two table lookups, no if/elif chain:
+    1. _STATE_ACTIONS[(domain, state)] - precomputed for fixed states (on/off, locked, open, ...)
+    2. DOMAIN_HANDLERS[domain](domain, state, fields) - for commands that carry values
+
+Fields are passed on only where a handler names them - a remote payload can not add service
+arguments of its own (entity_id, namespace, ...).
+
+Add a domain with:
+
+    @register_domain_handler("vacuum")
+    def _vacuum(domain, state, fields): return HassAction("vacuum/start", {}, "cleaning")
+"""
+
+
+class HassAction(NamedTuple):
+    service: str
+    data: dict
+    # State Hass will report once done. None = nothing to wait for.
+    expect: Optional[str]
+
+
+# handler(domain, state, fields) -> HassAction or None (not supported)
+DomainHandlerType = Callable[[str, Optional[str], dict], Optional[HassAction]]
+
+DOMAIN_HANDLERS: Dict[str, DomainHandlerType] = {}
+
+
+def register_domain_handler(*domains: str):
+    def decorator(handler: DomainHandlerType) -> DomainHandlerType:
+        for domain in domains:
+            DOMAIN_HANDLERS[domain] = handler
+        return handler
+
+    return decorator
+
+
+def _on_off(domain: str) -> Dict[Tuple[str, str], HassAction]:
+    return {
+        (domain, "on"): HassAction(f"{domain}/turn_on", {}, "on"),
+        (domain, "off"): HassAction(f"{domain}/turn_off", {}, "off"),
+    }
+
+
+_STATE_ACTIONS: Dict[Tuple[str, str], HassAction] = {
+    **_on_off("light"),
+    **_on_off("switch"),
+    **_on_off("fan"),
+    **_on_off("input_boolean"),
+    **_on_off("media_player"),
+    ("scene", "on"): HassAction("scene/turn_on", {}, None),
+    ("script", "on"): HassAction("script/turn_on", {}, None),
+    ("script", "off"): HassAction("script/turn_off", {}, None),
+    ("lock", "locked"): HassAction("lock/lock", {}, "locked"),
+    ("lock", "unlocked"): HassAction("lock/unlock", {}, "unlocked"),
+    ("lock", "open"): HassAction("lock/open", {}, None),
+    ("cover", "open"): HassAction("cover/open_cover", {}, "open"),
+    ("cover", "closed"): HassAction("cover/close_cover", {}, "closed"),
+    ("cover", "stop"): HassAction("cover/stop_cover", {}, None),
+    ("media_player", "playing"): HassAction("media_player/media_play", {}, "playing"),
+    ("media_player", "paused"): HassAction("media_player/media_pause", {}, "paused"),
+    ("media_player", "idle"): HassAction("media_player/media_stop", {}, "idle"),
+}
+
+
+# Service fields a command may carry, by handler
+LIGHT_FIELDS = frozenset(
+    {
+        "brightness",
+        "brightness_pct",
+        "brightness_step",
+        "brightness_step_pct",
+        "color_name",
+        "color_temp",
+        "color_temp_kelvin",
+        "effect",
+        "flash",
+        "hs_color",
+        "kelvin",
+        "profile",
+        "rgb_color",
+        "rgbw_color",
+        "rgbww_color",
+        "transition",
+        "white",
+        "xy_color",
+    }
+)
+LIGHT_OFF_FIELDS = frozenset({"flash", "transition"})
+CLIMATE_TEMPERATURE_FIELDS = frozenset(
+    {"temperature", "target_temp_low", "target_temp_high", "hvac_mode"}
+)
+
+
+def _only(fields: dict, allowed: frozenset) -> dict:
+    return {key: value for key, value in fields.items() if key in allowed}
+
+
+@register_domain_handler("input_number", "input_text")
+def _set_value(domain, state, fields):
+    value = fields.get("value", state)
+    if value is None:
+        return None
+    return HassAction(f"{domain}/set_value", {"value": value}, str(value))
+
+
+@register_domain_handler("input_select")
+def _select_option(domain, state, fields):
+    option = fields.get("option", state)
+    if option is None:
+        return None
+    return HassAction("input_select/select_option", {"option": option}, option)
+
+
+@register_domain_handler("light")
+def _light(domain, state, fields):
+    # {"state": "on", "brightness": 128, "color_temp": 300} or {"state": "off", "transition": 2}
+    if state == "off":
+        return HassAction("light/turn_off", _only(fields, LIGHT_OFF_FIELDS), "off")
+    data = _only(fields, LIGHT_FIELDS)
+    if data and state in (None, "on"):
+        return HassAction("light/turn_on", data, "on")
+    return None
+
+
+@register_domain_handler("climate")
+def _climate(domain, state, fields):
+    # "heat" or {"hvac_mode": "heat", "temperature": 20}
+    hvac_mode = fields.get("hvac_mode", state)
+    if any(
+        key in fields for key in ("temperature", "target_temp_low", "target_temp_high")
+    ):
+        data = _only(fields, CLIMATE_TEMPERATURE_FIELDS)
+        if hvac_mode is not None:
+            # Also when given as the state - it is what we wait for
+            data["hvac_mode"] = hvac_mode
+        return HassAction("climate/set_temperature", data, hvac_mode)
+    if "preset_mode" in fields:
+        return HassAction(
+            "climate/set_preset_mode", {"preset_mode": fields["preset_mode"]}, None
+        )
+    if hvac_mode is not None:
+        return HassAction("climate/set_hvac_mode", {"hvac_mode": hvac_mode}, hvac_mode)
+    return None
+
+
+@register_domain_handler("cover")
+def _cover(domain, state, fields):
+    # "50" or {"position": 50}
+    position = fields.get("position", state)
+    try:
+        position = int(position)
+    except (TypeError, ValueError):
+        return None
+    return HassAction(
+        "cover/set_cover_position",
+        {"position": position},
+        "closed" if position == 0 else "open",
+    )
+
+
+@register_domain_handler("fan")
+def _fan(domain, state, fields):
+    # {"percentage": 50} or {"preset_mode": "auto"}
+    if "percentage" in fields:
+        return HassAction(
+            "fan/set_percentage", {"percentage": int(fields["percentage"])}, None
+        )
+    if "preset_mode" in fields:
+        return HassAction(
+            "fan/set_preset_mode", {"preset_mode": fields["preset_mode"]}, None
+        )
+    return None
+
+
+@register_domain_handler("media_player")
+def _media_player(domain, state, fields):
+    # {"volume_level": 0.4} or {"source": "Radio"}
+    if "volume_level" in fields:
+        return HassAction(
+            "media_player/volume_set",
+            {"volume_level": float(fields["volume_level"])},
+            None,
+        )
+    if "source" in fields:
+        return HassAction(
+            "media_player/select_source", {"source": fields["source"]}, None
+        )
+    return None
+
+
+def split_command(command: Any) -> Tuple[Optional[str], dict]:
+    """
+    "on" --> ("on", {})
+    {"state": "on", "brightness": 128, "cid": "x"} --> ("on", {"brightness": 128})
+    """
+    if isinstance(command, dict):
+        fields = {
+            key: value for key, value in command.items() if key not in ("state", "cid")
+        }
+        state = command.get("state")
+        return (None if state is None else str(state), fields)
+    return (None if command is None else str(command), {})
+
+
+def resolve_hass_action(
+    entity: str, state: Optional[str], fields: Optional[dict] = None
+) -> Optional[HassAction]:
+    """
+    Returns None if there is no appropriate action (unknown domain, unexpected state, ...)
+    """
+    domain, sep, _ = entity.partition(".")
+    if not sep:
+        return None
+
+    if not fields:
+        action = _STATE_ACTIONS.get((domain, state))
+        if action is not None:
+            return action
+
+    handler = DOMAIN_HANDLERS.get(domain)
+    if handler is None:
+        return None
+    try:
+        return handler(domain, state, fields or {})
+    except (TypeError, ValueError):
+        return None
+
+
+def group_hass_actions(
+    commands: Dict[str, Any],
+) -> Tuple[List[Tuple[HassAction, List[str]]], List[str]]:
+    """
+    {"light.a": "off", "light.b": "off", "switch.c": "on"}
+        --> ([(light/turn_off, ["light.a", "light.b"]), (switch/turn_on, ["switch.c"])], [])
+
+    Returns: (grouped service calls, entities with no possible action)
+    """
+    groups: Dict[Tuple[str, str], Tuple[HassAction, List[str]]] = {}
+    failed = []
+    for entity, command in commands.items():
+        action = resolve_hass_action(entity, *split_command(command))
+        if action is None:
+            failed.append(entity)
+            continue
+        key = (action.service, json.dumps(action.data, sort_keys=True))
+        if key not in groups:
+            groups[key] = (action, [])
+        groups[key][1].append(entity)
+    return (list(groups.values()), failed)
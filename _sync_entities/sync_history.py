@@ -0,0 +1,271 @@
+import sqlite3
+import threading
+import time
+from collections import deque
+from typing import Deque, Dict, Iterable, List, Optional, Tuple
+
+# pylint: disable=unused-argument
+
+
+"""
+Downsampled history - min / max / mean per time bucket, for remote graphs.
+
+The owner aggregates each history entity into buckets of `history_interval` seconds, and
+publishes each bucket once it is complete - one small message per entity per interval,
+however often the sensor changes:
+
+    mqtt_shared/haven/all/history/sensor.house_power  {"i": 300, "b": [[1690000200, 310, 2250, 640.5]]}
+
+    b - buckets: [start (epoch seconds), min, max, mean]
+
+The mean is time weighted - a value counts for as long as it was the state. A bucket in
+which the state did not change still gets a bucket (its value, carried over). Non-numeric
+states (unavailable, ...) are gaps.
+
+Backfill: a site asks for what it is missing, and the owner answers from its buckets (which
+it rebuilds from HA's recorder at startup):
+
+    mqtt_shared/seattle/all/send_history   {"since": 1690000000}
+
+The receiver keeps buckets in a small SQLite table (HistoryStore), one row per bucket.
+"""
+
+# (start - epoch seconds, min, max, mean)
+Bucket = Tuple[int, float, float, float]
+
+
+def as_number(state) -> Optional[float]:
+    try:
+        number = float(state)
+    except (TypeError, ValueError):
+        return None
+    return number if number == number else None  # Not NaN
+
+
+def compact(number: float) -> float:
+    # 6 significant digits is plenty for a graph, and keeps payloads small
+    return float(f"{number:.6g}")
+
+
+def aggregate(
+    samples: Iterable[Tuple[float, Optional[float]]],
+    interval: float,
+    start: int,
+    end: int,
+    previous: Optional[float] = None,
+) -> List[Bucket]:
+    """
+    samples - (time, value) in time order. value None - a gap (eg: unavailable).
+    previous - the value in effect at start
+    Returns the buckets from start to end (both multiples of interval) with any value in them.
+    """
+    buckets: List[Bucket] = []
+    samples = iter(samples)
+    pending = next(samples, None)
+    value = previous
+    bucket_start = start
+    while bucket_start < end:
+        bucket_end = bucket_start + interval
+        # (value, seconds it was in effect) within this bucket
+        segments = []
+        at = bucket_start
+        while pending is not None and pending[0] < bucket_end:
+            sample_time = max(pending[0], bucket_start)
+            segments.append((value, sample_time - at))
+            (at, value) = (sample_time, pending[1])
+            pending = next(samples, None)
+        segments.append((value, bucket_end - at))
+
+        segments = [
+            (number, seconds)
+            for (number, seconds) in segments
+            if number is not None and seconds > 0
+        ]
+        if segments:
+            values = [number for (number, _) in segments]
+            known = sum(seconds for (_, seconds) in segments)
+            mean = sum(number * seconds for (number, seconds) in segments) / known
+            buckets.append(
+                (
+                    int(bucket_start),
+                    compact(min(values)),
+                    compact(max(values)),
+                    compact(mean),
+                )
+            )
+        bucket_start = bucket_end
+    return buckets
+
+
+class _Series:
+    def __init__(self, keep: int):
+        self.samples: List[Tuple[float, Optional[float]]] = []  # Since open_start
+        self.previous: Optional[float] = None  # Value in effect at open_start
+        self.open_start: Optional[int] = None
+        self.buckets: Deque[Bucket] = deque(maxlen=keep)
+
+
+class HistoryAggregator:
+    """
+    The owner's side.
+
+        history = HistoryAggregator(interval=300, keep=288)   # 24 hours of 5 minute buckets
+        history.add("sensor.house_power", "1234")             # From a state callback
+        history.close()  # --> {"sensor.house_power": [(1690000200, 310.0, 2250.0, 640.5)], ...}
+    """
+
+    def __init__(self, interval: float = 300, keep: int = 288):
+        self.interval = interval
+        self.keep = keep
+        self._lock = threading.Lock()
+        self._series: Dict[str, _Series] = {}
+
+    def _floor(self, timestamp: float) -> int:
+        return int(timestamp // self.interval * self.interval)
+
+    def add(self, entity: str, state, timestamp: Optional[float] = None):
+        timestamp = time.time() if timestamp is None else timestamp
+        with self._lock:
+            series = self._series.get(entity)
+            if series is None:
+                series = self._series[entity] = _Series(self.keep)
+            if series.open_start is None:
+                series.open_start = self._floor(timestamp)
+            series.samples.append((timestamp, as_number(state)))
+
+    def backfill(
+        self,
+        entity: str,
+        states: Iterable[Tuple[float, object]],
+        now: Optional[float] = None,
+    ):
+        """
+        Rebuilds entity's buckets from (time, state) - eg: HA's recorder history - up to now.
+        """
+        samples = [(timestamp, as_number(state)) for (timestamp, state) in states]
+        if not samples:
+            return
+        samples.sort(key=lambda sample: sample[0])
+        now = time.time() if now is None else now
+        open_start = self._floor(now)
+        start = max(self._floor(samples[0][0]), open_start - self.keep * self.interval)
+        before = [sample for sample in samples if sample[0] < start]
+        buckets = aggregate(
+            [sample for sample in samples if start <= sample[0] < open_start],
+            self.interval,
+            start,
+            open_start,
+            before[-1][1] if before else None,
+        )
+        with self._lock:
+            series = self._series[entity] = _Series(self.keep)
+            series.buckets.extend(buckets)
+            in_effect = [sample for sample in samples if sample[0] < open_start]
+            series.previous = in_effect[-1][1] if in_effect else None
+            series.samples = [sample for sample in samples if sample[0] >= open_start]
+            series.open_start = open_start
+
+    def close(self, now: Optional[float] = None) -> Dict[str, List[Bucket]]:
+        """
+        Completes the buckets that ended before now. Returns them, by entity.
+        """
+        now = time.time() if now is None else now
+        end = self._floor(now)
+        closed = {}
+        with self._lock:
+            for (entity, series) in self._series.items():
+                if series.open_start is None or series.open_start >= end:
+                    continue
+                done = [sample for sample in series.samples if sample[0] < end]
+                buckets = aggregate(
+                    done, self.interval, series.open_start, end, series.previous
+                )
+                if done:
+                    series.previous = done[-1][1]
+                series.samples = series.samples[len(done) :]
+                series.open_start = end
+                series.buckets.extend(buckets)
+                if buckets:
+                    closed[entity] = buckets
+        return closed
+
+    def buckets(self, entity: str, since: float = 0) -> List[Bucket]:
+        with self._lock:
+            series = self._series.get(entity)
+            if series is None:
+                return []
+            return [bucket for bucket in series.buckets if bucket[0] >= since]
+
+    def forget(self, entity: str):
+        with self._lock:
+            self._series.pop(entity, None)
+
+
+class HistoryStore:
+    """
+    The receiver's side - buckets by mirror entity, on disk (or ":memory:").
+    One row per bucket, upserted, so a backfill that overlaps what we have is harmless.
+    """
+
+    def __init__(self, path: str = ":memory:"):
+        self.path = path
+        self._lock = threading.Lock()
+        # AppDaemon callbacks run on worker threads. All access is under self._lock.
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS history ("
+            " local_entity TEXT NOT NULL,"
+            " start INTEGER NOT NULL,"
+            " min REAL NOT NULL,"
+            " max REAL NOT NULL,"
+            " mean REAL NOT NULL,"
+            " PRIMARY KEY (local_entity, start)) WITHOUT ROWID"
+        )
+        self._db.commit()
+
+    def put(self, local_entity: str, buckets: Iterable[Bucket]) -> int:
+        rows = [(local_entity, *bucket) for bucket in buckets]
+        with self._lock:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO history (local_entity, start, min, max, mean)"
+                " VALUES (?, ?, ?, ?, ?)",
+                rows,
+            )
+            self._db.commit()
+        return len(rows)
+
+    def series(self, local_entity: str, since: float = 0) -> List[Bucket]:
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT start, min, max, mean FROM history"
+                " WHERE local_entity = ? AND start >= ? ORDER BY start",
+                (local_entity, since),
+            )
+            return [tuple(row) for row in rows]
+
+    def entities(self) -> List[str]:
+        with self._lock:
+            rows = self._db.execute("SELECT DISTINCT local_entity FROM history")
+            return [row[0] for row in rows]
+
+    def newest(self) -> Dict[str, int]:
+        """
+        local_entity -> start of the newest bucket we have of it
+        """
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT local_entity, MAX(start) FROM history GROUP BY local_entity"
+            )
+            return {local_entity: start for (local_entity, start) in rows}
+
+    def prune(self, before: float) -> int:
+        with self._lock:
+            count = self._db.execute(
+                "DELETE FROM history WHERE start < ?", (before,)
+            ).rowcount
+            self._db.commit()
+            return count
+
+    def close(self):
+        with self._lock:
+            self._db.close()
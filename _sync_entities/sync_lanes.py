@@ -0,0 +1,153 @@
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, FrozenSet, Hashable, Optional
+
+from _sync_entities.sync_log import SyncLogger
+from _sync_entities.sync_pacing import AimdPacer
+from appdaemon.adapi import ADAPI
+
+# pylint: disable=unused-argument
+
+
+"""
+Priority lanes - commands ahead of bulk state traffic.
+
+Two lanes, picked by event type:
+
+    interactive: event, bulk_event, ack, ping, pong  -- handled immediately
+    bulk:        everything else (state, send_state, heartbeat, ...) -- queued
+
+Bulk messages are queued and handled `batch` at a time from a run_in(0) callback. So when a
+peer replays its whole state, each state message just gets queued, and a command that arrives
+in the middle of it is handled right away - not after hundreds of set_state() calls. (The
+queue is locked: callbacks may run on several of AppDaemon's worker threads. See
+sync_concurrency.)
+
+Only coalesce_event_types (default: state) are coalesced, by key (the topic): if a newer
+message for the same topic arrives while the old one is still queued, the old one is
+replaced - only the latest state matters. Every other bulk message (send_state, digest,
+repaired, aliases, ...) is queued as is: two requests to the same host are two requests.
+
+Each lane has its own MQTT QoS for publishing (lane_qos).
+
+With a pacer (outbound only), the bulk lane is drained at the pacer's rate. See sync_pacing.
+"""
+
+INTERACTIVE = "interactive"
+BULK = "bulk"
+
+DEFAULT_INTERACTIVE_EVENT_TYPES = ["event", "bulk_event", "ack", "ping", "pong"]
+# Bulk event types where only the latest message for a topic matters
+DEFAULT_COALESCE_EVENT_TYPES = ["state"]
+
+
+def topic_event_type(topic: Optional[str]) -> Optional[str]:
+    """
+    mqtt_shared/haven/seattle/state/light.office --> "state"
+    """
+    if not topic:
+        return None
+    parts = topic.split("/", 4)
+    return parts[3] if len(parts) > 3 else None
+
+
+@dataclass
+class LaneConfig:
+    interactive_event_types: FrozenSet[str] = frozenset(DEFAULT_INTERACTIVE_EVENT_TYPES)
+    qos: Dict[str, int] = field(default_factory=lambda: {INTERACTIVE: 0, BULK: 0})
+    batch: int = 50
+    coalesce_event_types: FrozenSet[str] = frozenset(DEFAULT_COALESCE_EVENT_TYPES)
+
+    def lane_for(self, event_type: Optional[str]) -> str:
+        return INTERACTIVE if event_type in self.interactive_event_types else BULK
+
+    def coalesce_key(
+        self, event_type: Optional[str], key: Hashable
+    ) -> Optional[Hashable]:
+        """
+        The key to submit() a bulk message with - None (never replaced) unless it may be.
+        """
+        return key if event_type in self.coalesce_event_types else None
+
+    def qos_for(self, lane: str) -> int:
+        return self.qos.get(lane, 0)
+
+
+class Lanes:
+    """
+    lanes = Lanes(adapi, handler, LaneConfig())
+    lanes.submit(BULK, topic, item)  # --> handler(item), later. Replaces a queued item with key.
+    lanes.submit(BULK, None, item)  # --> handler(item), later. Never replaced.
+    lanes.submit(INTERACTIVE, topic, item)  # --> handler(item), now
+
+    pacer - bulk items go at most at pacer's rate
+    """
+
+    def __init__(
+        self,
+        adapi: ADAPI,
+        handler: Callable[[Any], Any],
+        config: LaneConfig,
+        log: Optional[SyncLogger] = None,
+        pacer: Optional[AimdPacer] = None,
+    ):
+        self.adapi = adapi
+        self.handler = handler
+        self.config = config
+        self.log = log if log else SyncLogger(adapi)
+        self.pacer = pacer
+
+        self._lock = threading.Lock()
+        self._bulk: "OrderedDict[Hashable, Any]" = OrderedDict()  # key -> item
+        self._drain_scheduled = False
+        self.coalesced = 0
+
+    def pending(self) -> int:
+        return len(self._bulk)
+
+    def submit(self, lane: str, key: Hashable, item: Any):
+        if lane == INTERACTIVE:
+            self.handler(item)
+            return
+
+        if key is None:
+            key = object()  # Unique - nothing replaces it
+        with self._lock:
+            if key in self._bulk:
+                # Newer replaces older, and keeps the older one's place in line
+                self.coalesced += 1
+            self._bulk[key] = item
+            if self._drain_scheduled:
+                return
+            self._drain_scheduled = True
+        self.adapi.run_in(self.drain, 0)
+
+    def drain(self, kwargs):
+        count = self.config.batch
+        if self.pacer:
+            count = min(count, self.pacer.allowance(time.monotonic()))
+        with self._lock:
+            batch = [
+                self._bulk.popitem(last=False)[1]
+                for _ in range(min(count, len(self._bulk)))
+            ]
+        for item in batch:
+            try:
+                self.handler(item)
+            except Exception as err:  # pylint: disable=broad-except
+                # One bad message must not stall the lane
+                self.log.error("Lanes - handler failed: %s -- %.80s", err, item)
+
+        with self._lock:
+            backlog = len(self._bulk)
+            self._drain_scheduled = bool(backlog)
+        if backlog:
+            self.log.debug_sampled("lanes_backlog", "Lanes - bulk backlog: %s", backlog)
+            wait = 0
+            if self.pacer:
+                now = time.monotonic()
+                self.pacer.backlogged(now)
+                wait = self.pacer.delay(now)
+            self.adapi.run_in(self.drain, wait)
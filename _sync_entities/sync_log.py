@@ -0,0 +1,94 @@
+import logging
+import time
+from typing import Dict, Tuple
+
+from appdaemon.adapi import ADAPI
+
+# pylint: disable=unused-argument
+
+
+"""
+Logging for the hot path.
+
+adapi.log() does real work on every call (stack inspection, ascii encoding), even when the
+message is below the app's log_level. And an f-string is formatted before the call is made.
+
+SyncLogger checks the level first and formats %-style args only if the message will be written:
+
+    self.log.debug("state_callback(): %s -- %.80s", entity, payload)  # nothing happens at INFO
+
+For messages that fire on every MQTT message:
+
+    self.log.debug_sampled("dispatch", "dispatching: %s", topic)   # 1 in sample_every
+    self.log.warning_ratelimited("nomatch", "no listener: %s", topic)  # once per ratelimit_seconds
+"""
+
+_LEVELS = {
+    "DEBUG": logging.DEBUG,
+    "INFO": logging.INFO,
+    "WARNING": logging.WARNING,
+    "ERROR": logging.ERROR,
+    "CRITICAL": logging.CRITICAL,
+}
+
+
+class SyncLogger:
+    def __init__(
+        self, adapi: ADAPI, sample_every: int = 100, ratelimit_seconds: float = 60
+    ):
+        self.adapi = adapi
+        self.sample_every = max(1, sample_every)
+        self.ratelimit_seconds = ratelimit_seconds
+        self._logger = adapi.get_main_log()
+
+        self._samples: Dict[str, int] = {}  # key -> calls so far
+        self._ratelimits: Dict[str, Tuple[float, int]] = {}  # key -> (next_ok, dropped)
+
+    def enabled(self, level: str) -> bool:
+        return self._logger.isEnabledFor(_LEVELS[level])
+
+    def log(self, level: str, msg: str, *args):
+        if not self._logger.isEnabledFor(_LEVELS[level]):
+            return
+        self.adapi.log(msg % args if args else msg, level=level)
+
+    def debug(self, msg: str, *args):
+        self.log("DEBUG", msg, *args)
+
+    def info(self, msg: str, *args):
+        self.log("INFO", msg, *args)
+
+    def warning(self, msg: str, *args):
+        self.log("WARNING", msg, *args)
+
+    def error(self, msg: str, *args):
+        self.log("ERROR", msg, *args)
+
+    def debug_sampled(self, key: str, msg: str, *args):
+        """
+        Logs the 1st, then every sample_every-th call for this key.
+        """
+        if not self._logger.isEnabledFor(logging.DEBUG):
+            return
+        count = self._samples.get(key, 0)
+        self._samples[key] = count + 1
+        if count % self.sample_every:
+            return
+        suffix = f" [sampled 1/{self.sample_every}]" if self.sample_every > 1 else ""
+        self.adapi.log((msg % args if args else msg) + suffix, level="DEBUG")
+
+    def warning_ratelimited(self, key: str, msg: str, *args):
+        """
+        At most one message per ratelimit_seconds for this key.
+        The next one that gets through says how many were suppressed.
+        """
+        if not self._logger.isEnabledFor(logging.WARNING):
+            return
+        now = time.monotonic()
+        next_ok, dropped = self._ratelimits.get(key, (0.0, 0))
+        if now < next_ok:
+            self._ratelimits[key] = (next_ok, dropped + 1)
+            return
+        self._ratelimits[key] = (now + self.ratelimit_seconds, 0)
+        suffix = f" [{dropped} similar suppressed]" if dropped else ""
+        self.adapi.log((msg % args if args else msg) + suffix, level="WARNING")
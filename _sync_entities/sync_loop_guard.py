@@ -0,0 +1,216 @@
+import itertools
+import json
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Dict, Optional, Tuple
+
+# pylint: disable=unused-argument
+
+
+"""
+Echo and loop suppression.
+
+Every outbound message can optionally be wrapped in a small envelope:
+
+    {"sem":1,"o":"seattle","s":1690000000123,"h":0,"p":"on"}
+
+    o = origin host - the host that started the chain of messages
+    s = sequence number (monotonic per sender, survives restarts since it is time based)
+    h = hop count - incremented every time a message causes another message
+    p = the original payload
+
+Un-enveloped payloads are still accepted, so mixed installations keep working.
+Only turn on `loop_suppression` once every site understands envelopes.
+
+Causality: a message published while handling an inbound one (from its listener) is part
+of the inbound message's chain - it inherits the origin and hops+1. Once hops > max_hops, it
+is dropped. Except a command caused by a state: that state's origin is where the command must
+go, so it starts a new origin (still counting hops).
+
+A command to us about one of our entities is also remembered for a few seconds. Our state for
+that entity, published in that window (the state change the command caused, arriving through
+Hass), inherits its chain too.
+
+Everything else - a user or a service, here - starts a new chain (origin: us, hops: 0).
+"""
+
+ENVELOPE_MARKER = '{"sem":'
+
+# For these event types the entity belongs to the sender. For everything else (eg: event),
+# the entity belongs to the receiver.
+_OWNER_IS_SENDER = {"state"}
+
+
+@dataclass
+class Envelope:
+    origin: str
+    seq: int
+    hops: int = 0
+
+
+def wrap_payload(payload: Optional[str], envelope: Envelope) -> str:
+    return json.dumps(
+        {
+            "sem": 1,
+            "o": envelope.origin,
+            "s": envelope.seq,
+            "h": envelope.hops,
+            "p": payload,
+        },
+        separators=(",", ":"),
+    )
+
+
+def unwrap_payload(payload) -> Tuple[Optional[Envelope], Optional[str]]:
+    """
+    Returns:
+        (Envelope, inner_payload) if payload is enveloped
+    else
+        (None, payload)
+    """
+    if not isinstance(payload, str) or not payload.startswith(ENVELOPE_MARKER):
+        return (None, payload)
+    try:
+        obj = json.loads(payload)
+        envelope = Envelope(str(obj["o"]), int(obj["s"]), int(obj["h"]))
+    except (ValueError, KeyError, TypeError):
+        return (None, payload)
+    return (envelope, obj.get("p"))
+
+
+def message_owner(fromhost: str, tohost: str, event_type: str) -> str:
+    return fromhost if event_type in _OWNER_IS_SENDER else tohost
+
+
+class LoopGuard:
+    """
+    Decides, cheaply and before any listener runs, whether an inbound message should be dropped.
+
+    Drops:
+        * Our own messages echoed back to us (fromhost == myhostname)
+        * Messages we have already seen (same fromhost:seq) within seen_ttl seconds
+        * Messages that have travelled more than max_hops
+        * Commands (event) that originated here and came back around
+    """
+
+    def __init__(
+        self,
+        myhostname: str,
+        tag_outbound: bool = False,
+        max_hops: int = 3,
+        seen_ttl: float = 30.0,
+        seen_max: int = 4096,
+        context_ttl: float = 10.0,
+    ):
+        self.myhostname = myhostname
+        self.tag_outbound = tag_outbound
+        self.max_hops = max_hops
+        self.seen_ttl = seen_ttl
+        self.seen_max = seen_max
+        self.context_ttl = context_ttl
+
+        self._seq = itertools.count(int(time.time() * 1000))
+        self._seen: "OrderedDict[str, float]" = OrderedDict()  # msg_id -> expires
+        self._seen_lock = threading.Lock()
+        # (owner, entity) -> (origin, hops, expires) - of recent commands. Oldest first.
+        self._context: "OrderedDict[Tuple[str, str], Tuple[str, int, float]]" = (
+            OrderedDict()
+        )
+        self._context_lock = threading.Lock()
+        self.dropped = 0
+
+    def _expire_seen(self, now: float):
+        seen = self._seen
+        while seen:
+            msg_id, expires = next(iter(seen.items()))
+            if expires > now and len(seen) <= self.seen_max:
+                break
+            del seen[msg_id]
+
+    def _expire_context(self, now: float):
+        # With self._context_lock held
+        context = self._context
+        while context:
+            key, (_, _, expires) = next(iter(context.items()))
+            if expires > now and len(context) <= self.seen_max:
+                break
+            del context[key]
+
+    def accept(
+        self,
+        fromhost: Optional[str],
+        tohost: Optional[str],
+        event_type: Optional[str],
+        entity: Optional[str],
+        envelope: Optional[Envelope],
+    ) -> bool:
+        if fromhost == self.myhostname:
+            self.dropped += 1
+            return False
+
+        if envelope is None:
+            return True
+
+        if envelope.hops > self.max_hops or (
+            event_type == "event" and envelope.origin == self.myhostname
+        ):
+            self.dropped += 1
+            return False
+
+        now = time.monotonic()
+        msg_id = f"{fromhost}:{envelope.seq}"
+        with self._seen_lock:
+            self._expire_seen(now)
+            if msg_id in self._seen:
+                self.dropped += 1
+                return False
+            self._seen[msg_id] = now + self.seen_ttl
+
+        if entity and event_type not in _OWNER_IS_SENDER:
+            # A command - our state for its entity will follow, through Hass
+            key = (message_owner(fromhost, tohost, event_type), entity)
+            with self._context_lock:
+                self._context.pop(key, None)  # Re-inserted last, in expiry order
+                self._context[key] = (
+                    envelope.origin,
+                    envelope.hops,
+                    now + self.context_ttl,
+                )
+                self._expire_context(now)
+        return True
+
+    def outbound(
+        self,
+        tohost: str,
+        event_type: str,
+        entity: Optional[str],
+        payload: Optional[str],
+        cause: Optional[Tuple[str, Optional[Envelope]]] = None,
+    ) -> Optional[str]:
+        """
+        Returns the payload to publish - enveloped if tag_outbound, else unchanged.
+
+        cause - (event_type, envelope) of the inbound message being handled, when publishing
+            from its listener. None otherwise.
+        """
+        if not self.tag_outbound:
+            return payload
+
+        origin, hops = self.myhostname, 0
+        if cause is not None and cause[1] is not None:
+            (cause_type, envelope) = cause
+            hops = envelope.hops + 1
+            if event_type in _OWNER_IS_SENDER or cause_type not in _OWNER_IS_SENDER:
+                origin = envelope.origin
+        elif entity and event_type in _OWNER_IS_SENDER:
+            key = (message_owner(self.myhostname, tohost, event_type), entity)
+            now = time.monotonic()
+            with self._context_lock:
+                self._expire_context(now)
+                context = self._context.get(key)
+            if context is not None and context[2] > now:
+                origin, hops = context[0], context[1] + 1
+
+        return wrap_payload(payload, Envelope(origin, next(self._seq), hops))
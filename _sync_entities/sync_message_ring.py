@@ -0,0 +1,114 @@
+import itertools
+import time
+from array import array
+from typing import List, Optional, Tuple
+
+# pylint: disable=unused-argument
+
+
+"""
+The last N dispatched messages, in memory - for after-the-fact debugging, without DEBUG logs.
+
+    ring = MessageRing(1024)
+    ring.record(time.time(), 0.0004, OK, "mqtt", topic, payload, ("inbound_state",))
+    ring.lines()   # --> oldest first:
+        12:00:01.123   0.4ms ok      mqtt mqtt_shared/haven/all/state/light.office [inbound_state] -- on
+
+Recording is a few assignments into preallocated slots (numbers in arrays, references in
+lists) - nothing is formatted or copied until a dump. The oldest entry is overwritten.
+
+Dumped by the sync_entities_via_mqtt/dump_recent_messages service, and to the log when a
+listener fails.
+
+Concurrent record() calls each get their own slot. A dump during writes may show a half
+written entry - it is for reading by a person, not for replay (see sync_trace for that).
+"""
+
+OK = 0
+DROPPED = 1  # By the loop guard, or not our topic
+NO_MATCH = 2  # No listener
+ERROR = 3  # A listener raised
+
+OUTCOMES = ("ok", "dropped", "nomatch", "error")
+
+
+class MessageRing:
+    def __init__(self, capacity: int = 1024):
+        self.capacity = max(1, capacity)
+        self._index = itertools.count()  # next() is atomic
+        self._written = 0
+
+        self._times = array("d", [0.0]) * self.capacity  # time.time()
+        self._seconds = array("f", [0.0]) * self.capacity  # In dispatch
+        self._outcomes = array("b", [0]) * self.capacity
+        self._namespaces: List[Optional[str]] = [None] * self.capacity
+        self._topics: List[Optional[str]] = [None] * self.capacity
+        self._payloads: List[object] = [None] * self.capacity
+        self._listeners: List[Tuple[str, ...]] = [()] * self.capacity
+
+    def __len__(self):
+        return min(self._written, self.capacity)
+
+    def record(
+        self,
+        when: float,
+        seconds: float,
+        outcome: int,
+        namespace: Optional[str],
+        topic: Optional[str],
+        payload,
+        listeners: Tuple[str, ...] = (),
+    ):
+        index = next(self._index)
+        slot = index % self.capacity
+        self._times[slot] = when
+        self._seconds[slot] = seconds
+        self._outcomes[slot] = outcome
+        self._namespaces[slot] = namespace
+        self._topics[slot] = topic
+        self._payloads[slot] = payload
+        self._listeners[slot] = listeners
+        if index >= self._written:
+            self._written = index + 1
+
+    def entries(self, last: Optional[int] = None) -> List[dict]:
+        """
+        Oldest first. last - only the most recent N.
+        """
+        written = self._written
+        count = min(written, self.capacity, last if last else self.capacity)
+        entries = []
+        for index in range(written - count, written):
+            slot = index % self.capacity
+            entries.append(
+                {
+                    "time": self._times[slot],
+                    "seconds": self._seconds[slot],
+                    "outcome": OUTCOMES[self._outcomes[slot]],
+                    "namespace": self._namespaces[slot],
+                    "topic": self._topics[slot],
+                    "payload": self._payloads[slot],
+                    "listeners": list(self._listeners[slot]),
+                }
+            )
+        return entries
+
+    def lines(self, last: Optional[int] = None, payload_chars: int = 80) -> List[str]:
+        lines = []
+        for entry in self.entries(last):
+            clock = time.strftime("%H:%M:%S", time.localtime(entry["time"]))
+            lines.append(
+                "%s.%03d %7.1fms %-7s %s %s [%s] -- %.*s"
+                % (
+                    clock,
+                    int(entry["time"] % 1 * 1000),
+                    entry["seconds"] * 1000,
+                    entry["outcome"],
+                    entry["namespace"],
+                    entry["topic"],
+                    ", ".join(entry["listeners"]),
+                    payload_chars,
+                    entry["payload"],
+                )
+            )
+        return lines
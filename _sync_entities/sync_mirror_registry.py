@@ -0,0 +1,178 @@
+import sys
+import threading
+import time
+import zlib
+from typing import Dict, Iterator, List, Optional, Set, Tuple
+
+from _sync_entities.sync_digest import mirrored_state
+from _sync_entities.sync_utils import entity_local_to_remote, entity_remote_to_local
+
+# pylint: disable=unused-argument
+
+
+"""
+In-memory model of every mirror (remote entity) this site knows about.
+
+    mirrors.update("haven", "light.office", "on", seq=17)
+    mirrors.get("sensor.light_office_xxhavenxx").state      --> "on"
+    mirrors.lookup("haven", "light.office").local_entity   --> "sensor.light_office_xxhavenxx"
+    mirrors.by_host("haven")                               --> [MirrorRecord, ...]
+    mirrors.by_domain("light")                             --> [MirrorRecord, ...]
+
+Records use __slots__ (no per-instance __dict__), and host / domain strings are interned, so
+thousands of mirrors cost little memory. Names are derived once, when a record is created.
+
+add() / remove() take a lock (they touch three indexes), as do the reads that walk an index.
+Messages for one mirror are dispatched in order, one at a time (see sync_concurrency), but
+mark_host() writes records from a timer - so update() writes under the lock too.
+"""
+
+
+def state_digest(state) -> int:
+    """
+    Compact fingerprint of a state, for "which of these do you already have" exchanges.
+    """
+    return zlib.crc32(mirrored_state(state).encode("utf-8"))
+
+
+class MirrorRecord:
+    __slots__ = (
+        "host",
+        "entity",
+        "local_entity",
+        "domain",
+        "state",
+        "updated_at",
+        "seq",
+    )
+
+    def __init__(self, host: str, entity: str, local_entity: str):
+        self.host = sys.intern(host)
+        self.entity = entity  # Remote name, eg: light.office
+        self.local_entity = local_entity  # eg: sensor.light_office_xxhavenxx
+        self.domain = sys.intern(entity.partition(".")[0])
+        self.state: Optional[str] = None
+        self.updated_at: Optional[float] = None  # time.time()
+        # Sender's envelope seq, if loop_suppression is on
+        self.seq: Optional[int] = None
+
+    def __repr__(self):
+        return f"MirrorRecord({self.local_entity}={self.state!r}, seq={self.seq})"
+
+
+class MirrorRegistry:
+    def __init__(self):
+        self._by_local: Dict[str, MirrorRecord] = {}
+        # host -> entity -> record
+        self._by_host: Dict[str, Dict[str, MirrorRecord]] = {}
+        self._by_domain: Dict[str, Set[str]] = {}  # domain -> local_entity
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._by_local)
+
+    def __contains__(self, local_entity: str):
+        return local_entity in self._by_local
+
+    def __iter__(self) -> Iterator[MirrorRecord]:
+        return iter(list(self._by_local.values()))
+
+    def get(self, local_entity: str) -> Optional[MirrorRecord]:
+        return self._by_local.get(local_entity)
+
+    def lookup(self, host: str, entity: str) -> Optional[MirrorRecord]:
+        return self._by_host.get(host, {}).get(entity)
+
+    def by_host(self, host: str) -> List[MirrorRecord]:
+        return list(self._by_host.get(host, {}).values())
+
+    def by_domain(self, domain: str) -> List[MirrorRecord]:
+        with self._lock:
+            return [self._by_local[local] for local in self._by_domain.get(domain, ())]
+
+    def hosts(self) -> List[str]:
+        return sorted(self._by_host)
+
+    def resolve_local(self, local_entity: str) -> Tuple[str, str]:
+        """
+        sensor.light_office_xxhavenxx --> ("light.office", "haven")
+        Known mirrors come from the registry. Raises ValueError if not a mirror name.
+        """
+        record = self._by_local.get(local_entity)
+        if record is not None:
+            return (record.entity, record.host)
+        return entity_local_to_remote(local_entity)
+
+    def add(self, host: str, entity: str) -> MirrorRecord:
+        record = self.lookup(host, entity)
+        if record is not None:
+            return record
+        with self._lock:
+            record = self.lookup(host, entity)
+            if record is not None:
+                return record
+            record = MirrorRecord(host, entity, entity_remote_to_local(entity, host))
+            self._by_local[record.local_entity] = record
+            self._by_host.setdefault(record.host, {})[entity] = record
+            self._by_domain.setdefault(record.domain, set()).add(record.local_entity)
+        return record
+
+    def update(
+        self,
+        host: str,
+        entity: str,
+        state,
+        seq: Optional[int] = None,
+        updated_at: Optional[float] = None,
+    ) -> Optional[MirrorRecord]:
+        """
+        Returns None (and changes nothing) if seq is older than the one we have -
+        an out-of-order message.
+        """
+        record = self.add(host, entity)
+        with self._lock:
+            if seq is not None and record.seq is not None and seq < record.seq:
+                return None
+            record.state = None if state is None else str(state)
+            record.updated_at = time.time() if updated_at is None else updated_at
+            record.seq = seq
+        return record
+
+    def mark_host(self, host: str, state: str, not_since: float) -> List[MirrorRecord]:
+        """
+        Sets the state of host's mirrors not updated since not_since (time.time()) - eg:
+        "unavailable". One that was just updated keeps its news. Returns those marked.
+        """
+        with self._lock:
+            marked = [
+                record
+                for record in self._by_host.get(host, {}).values()
+                if record.updated_at is None or record.updated_at <= not_since
+            ]
+            for record in marked:
+                record.state = state
+        return marked
+
+    def remove(self, local_entity: str) -> Optional[MirrorRecord]:
+        with self._lock:
+            record = self._by_local.pop(local_entity, None)
+            if record is None:
+                return None
+            del self._by_host[record.host][record.entity]
+            if not self._by_host[record.host]:
+                del self._by_host[record.host]
+            self._by_domain[record.domain].discard(local_entity)
+        return record
+
+    def digests(self) -> Dict[str, Dict[str, int]]:
+        """
+        {"haven": {"light.office": state_digest("on"), ...}, ...}
+        """
+        with self._lock:
+            return {
+                host: {
+                    entity: state_digest(record.state)
+                    for entity, record in records.items()
+                }
+                for host, records in self._by_host.items()
+            }
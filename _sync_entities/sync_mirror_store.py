@@ -0,0 +1,127 @@
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass
+from typing import Dict, Iterable, Optional
+
+from _sync_entities.sync_mirror_registry import MirrorRecord
+
+# pylint: disable=unused-argument
+
+
+"""
+Last-known state of every mirror entity (sensor.*_xxhostxx), kept on disk.
+
+Mirrors only live in HA's state machine, so after a restart they are empty until
+the remotes answer `send_state`. With a store:
+
+    1. At startup, the mirrors are set from the store right away.
+    2. send_state carries a digest of what we already have, so each remote only
+        sends the entities that differ:
+
+        mqtt_shared/haven/all/send_state  {"have": {"seattle": {"light.office": 2212294583}}}
+
+One SQLite table, one row per mirror (upsert - nothing to compact).
+Writes are buffered and flushed as a single transaction, see put() / flush().
+The in-memory model is the MirrorRegistry. This only persists its records.
+"""
+
+
+@dataclass
+class MirrorRow:
+    host: str
+    entity: str  # Remote name, eg: light.office
+    state: Optional[str]
+    updated_at: float  # time.time()
+    seq: Optional[int] = None  # Sender's envelope seq, if loop_suppression is on
+
+
+class MirrorStore:
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        # AppDaemon callbacks run on worker threads. All access is under self._lock.
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS mirrors ("
+            " local_entity TEXT PRIMARY KEY,"
+            " host TEXT NOT NULL,"
+            " entity TEXT NOT NULL,"
+            " state TEXT,"
+            " updated_at REAL NOT NULL,"
+            " seq INTEGER)"
+        )
+        self._db.commit()
+
+        self._dirty: Dict[str, tuple] = {}  # local_entity -> row
+
+    def load(self, forget_seconds: Optional[float] = None) -> Dict[str, MirrorRow]:
+        """
+        Reads the whole table. Rows not updated within forget_seconds are deleted.
+        (eg: an entity removed from a remote's state_for_entities)
+        """
+        with self._lock:
+            if forget_seconds:
+                self._db.execute(
+                    "DELETE FROM mirrors WHERE updated_at < ?",
+                    (time.time() - forget_seconds,),
+                )
+                self._db.commit()
+            rows = self._db.execute(
+                "SELECT local_entity, host, entity, state, updated_at, seq FROM mirrors"
+            )
+            return {row[0]: MirrorRow(*row[1:]) for row in rows}
+
+    def put(self, record: MirrorRecord):
+        """
+        Buffers the write, until flush().
+        """
+        with self._lock:
+            self._dirty[record.local_entity] = (
+                record.local_entity,
+                record.host,
+                record.entity,
+                record.state,
+                record.updated_at,
+                record.seq,
+            )
+
+    def delete(self, local_entities: Iterable[str]) -> int:
+        """
+        Forgets mirrors now (eg: the remote no longer syncs them). Returns the number deleted.
+        """
+        local_entities = [(local_entity,) for local_entity in local_entities]
+        with self._lock:
+            for (local_entity,) in local_entities:
+                self._dirty.pop(local_entity, None)
+            count = self._db.executemany(
+                "DELETE FROM mirrors WHERE local_entity = ?", local_entities
+            ).rowcount
+            self._db.commit()
+            return count
+
+    def pending(self) -> int:
+        return len(self._dirty)
+
+    def flush(self) -> int:
+        """
+        Writes buffered rows in one transaction. Returns the number written.
+        """
+        with self._lock:
+            if not self._dirty:
+                return 0
+            self._db.executemany(
+                "INSERT OR REPLACE INTO mirrors"
+                " (local_entity, host, entity, state, updated_at, seq)"
+                " VALUES (?, ?, ?, ?, ?, ?)",
+                list(self._dirty.values()),
+            )
+            self._db.commit()
+            count = len(self._dirty)
+            self._dirty = {}
+            return count
+
+    def close(self):
+        self.flush()
+        with self._lock:
+            self._db.close()
@@ -0,0 +1,157 @@
+import threading
+from typing import Optional
+
+# pylint: disable=unused-argument
+
+
+"""
+Adaptive outbound pacing - publish bulk messages as fast as the broker and bridge keep up, and
+no faster. AIMD, like TCP:
+
+    * While the bulk lane has a backlog and nothing looks congested: rate += increase, each second
+    * On a congestion signal: rate *= decrease (at most once a second - one signal per burst)
+
+Congestion signals:
+    * An mqtt_publish() call that takes longer than latency_target (the client is backing up)
+    * An mqtt_publish() call that fails
+    * A probe round trip well above the best one seen (queueing in the broker / bridge)
+    * A lost probe
+    (Probes only run with more than one mqtt namespace - see sync_transport)
+
+The rate is a token bucket: bulk messages wait for a token. Interactive messages (commands,
+acks, pings) never wait - but they use up tokens, so the bulk lane makes room for them.
+
+    pacer = AimdPacer(rate=50)
+    pacer.allowance(now)      # --> how many bulk messages may go now
+    pacer.sent(1, now)        # every message sent, bulk or not
+    pacer.on_publish(0.002, now)
+    pacer.delay(now)          # --> seconds until the next bulk message may go
+"""
+
+
+class AimdPacer:
+    def __init__(
+        self,
+        rate: float = 50,
+        min_rate: float = 5,
+        max_rate: float = 500,
+        increase: float = 5,
+        decrease: float = 0.5,
+        latency_target: float = 0.1,
+        burst_seconds: float = 0.5,
+    ):
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.rate = min(max(rate, min_rate), max_rate)  # Messages per second
+        self.increase = increase
+        self.decrease = decrease
+        self.latency_target = latency_target  # Seconds
+        self.burst_seconds = burst_seconds
+
+        self.latency: Optional[float] = None  # Moving average of mqtt_publish() time
+        self.min_rtt: Optional[float] = None
+        self.sent_total = 0
+        self.increases = 0
+        self.decreases = 0
+
+        self._lock = threading.Lock()
+        self._tokens = self._burst()
+        self._updated: Optional[float] = None  # monotonic
+        self._last_increase = float("-inf")
+        self._last_decrease = float("-inf")
+
+    def _burst(self) -> float:
+        return max(1.0, self.rate * self.burst_seconds)
+
+    def _refill(self, now: float):
+        # With self._lock held
+        if self._updated is not None:
+            self._tokens = min(
+                self._burst(), self._tokens + (now - self._updated) * self.rate
+            )
+        self._updated = now
+
+    #
+    # Sending
+    #
+    def allowance(self, now: float) -> int:
+        with self._lock:
+            self._refill(now)
+            return max(0, int(self._tokens))
+
+    def delay(self, now: float) -> float:
+        with self._lock:
+            self._refill(now)
+            return 0.0 if self._tokens >= 1 else (1 - self._tokens) / self.rate
+
+    def sent(self, count: int, now: float):
+        """
+        May go below zero tokens (interactive messages do not wait) - bulk then waits longer.
+        """
+        with self._lock:
+            self._refill(now)
+            self._tokens -= count
+            self.sent_total += count
+
+    #
+    # Feedback
+    #
+    def backlogged(self, now: float):
+        """
+        The bulk lane is waiting on the rate. Additive increase - once a second, and not
+        within a second of a decrease.
+        """
+        with self._lock:
+            if now - max(self._last_increase, self._last_decrease) < 1:
+                return
+            self._last_increase = now
+            if self.rate < self.max_rate:
+                self.rate = min(self.max_rate, self.rate + self.increase)
+                self.increases += 1
+
+    def congested(self, now: float) -> bool:
+        """
+        Multiplicative decrease. False if we just decreased (the same burst's signals).
+        """
+        with self._lock:
+            if now - self._last_decrease < 1:
+                return False
+            self._last_decrease = now
+            self.rate = max(self.min_rate, self.rate * self.decrease)
+            self._tokens = min(self._tokens, self._burst())
+            self.decreases += 1
+            return True
+
+    def on_publish(self, seconds: float, now: float):
+        self.latency = (
+            seconds if self.latency is None else self.latency * 0.9 + seconds * 0.1
+        )
+        if seconds > self.latency_target:
+            self.congested(now)
+
+    def on_failure(self, now: float):
+        self.congested(now)
+
+    def on_rtt(self, rtt: float, now: float):
+        if self.min_rtt is None or rtt < self.min_rtt:
+            self.min_rtt = rtt
+        # Queueing delay, beyond the latency target
+        if rtt - self.min_rtt > max(self.latency_target, self.min_rtt):
+            self.congested(now)
+
+    def on_loss(self, now: float):
+        self.congested(now)
+
+    def metrics(self) -> dict:
+        return {
+            "rate": round(self.rate, 1),
+            "latency_ms": (
+                None if self.latency is None else round(self.latency * 1000, 1)
+            ),
+            "min_rtt_ms": (
+                None if self.min_rtt is None else round(self.min_rtt * 1000, 1)
+            ),
+            "sent": self.sent_total,
+            "increases": self.increases,
+            "decreases": self.decreases,
+        }
@@ -1,7 +1,29 @@
+from importlib import import_module, reload
+from typing import Optional, Type
+
 from _sync_entities.sync_dispatcher import EventListenerDispatcher
+from _sync_entities.sync_log import SyncLogger
+from _sync_entities.sync_mirror_registry import MirrorRegistry
+from _sync_entities.sync_transport import Transport
 from appdaemon.adapi import ADAPI
 from appdaemon.plugins.mqtt.mqttapi import Mqtt as mqttapi
 
+# Plugins, by the name used in the .yaml `plugins:` list --> "module:Class"
+# Modules are only imported if the plugin is configured.
+PLUGIN_REGISTRY = {
+    "print_all": "_sync_entities.sync_plugin_print_all:PluginPrintAll",
+    "ping_pong": "_sync_entities.sync_plugin_ping_pong:PluginPingPong",
+    "inbound_state": "_sync_entities.sync_plugin_inbound_state:PluginInboundState",
+    "events": "_sync_entities.sync_plugin_events:PluginEvents",
+    "aliases": "_sync_entities.sync_plugin_aliases:PluginAliases",
+    "relay": "_sync_entities.sync_plugin_relay:PluginRelay",
+    "history": "_sync_entities.sync_plugin_history:PluginHistory",
+    "shards": "_sync_entities.sync_plugin_shards:PluginShards",
+}
+
+# print_all is for debugging only - its catch-all listener runs on every message
+DEFAULT_PLUGINS = ["ping_pong", "inbound_state", "events"]
+
 
 class Plugin:
     def __init__(
@@ -12,6 +34,9 @@ class Plugin:
         mqtt_base_topic: str,
         argsn: dict,
         myhostname: str,
+        transport: Optional[Transport] = None,
+        mirrors: Optional[MirrorRegistry] = None,
+        sync_log: Optional[SyncLogger] = None,
     ):
         self.adapi = adapi
         self.mqtt = mqtt
@@ -19,10 +44,68 @@ class Plugin:
         self.mqtt_base_topic = mqtt_base_topic
         self.argsn = argsn
         self.myhostname = myhostname
+        # Shared with the app, so sampling and rate limits count across all plugins
+        self.log = sync_log
+        if self.log is None:
+            self.log = SyncLogger(
+                adapi,
+                sample_every=argsn.get("log_sample_every", 100),
+                ratelimit_seconds=argsn.get("log_ratelimit_seconds", 60),
+            )
+        self.transport = transport if transport else Transport(mqtt, ["mqtt"], self.log)
+        # Shared by all plugins - see sync_mirror_registry
+        self.mirrors = mirrors if mirrors is not None else MirrorRegistry()
 
         self.initialize()
 
-        self.adapi.log(f"Plugin Initialized: {self.__class__.__name__}", level="DEBUG")
+        self.log.debug("Plugin Initialized: %s", self.__class__.__name__)
 
     def initialize(self):
         raise NotImplementedError("Overide in inherited object")
+
+    def terminate(self):
+        """
+        The app is stopping. Override to clean up.
+        """
+
+    def publish(
+        self,
+        tohost: str,
+        event_type: str,
+        entity: Optional[str] = None,
+        payload: Optional[str] = None,
+        namespace: Optional[str] = None,
+    ):
+        """
+        publish("all", "state", "light.office", "on")
+            --> mqtt_shared/<myhostname>/all/state/light.office on
+
+        All plugins publish through here, so the payload gets tagged (see sync_loop_guard),
+        and goes out on the healthiest mqtt namespace, in the event type's lane (see sync_transport).
+        namespace - force a specific namespace instead.
+        """
+        topic = f"{self.mqtt_base_topic}/{self.myhostname}/{tohost}/{event_type}"
+        if entity:
+            topic = f"{topic}/{entity}"
+        if self.dispatcher.loop_guard:
+            payload = self.dispatcher.loop_guard.outbound(
+                tohost, event_type, entity, payload, self.dispatcher.current_cause
+            )
+        self.transport.publish(topic, payload, namespace, event_type)
+
+
+def load_plugin(name: str, dev_reload: bool = False) -> Type[Plugin]:
+    """
+    load_plugin("ping_pong") --> PluginPingPong (the class)
+
+    dev_reload - reload the module first. (For development, so edits are picked up.)
+    """
+    if name not in PLUGIN_REGISTRY:
+        raise ValueError(
+            f"Unknown plugin: {name}. Valid plugins: {list(PLUGIN_REGISTRY)}"
+        )
+    module_name, _, class_name = PLUGIN_REGISTRY[name].partition(":")
+    module = import_module(module_name)
+    if dev_reload:
+        module = reload(module)
+    return getattr(module, class_name)
@@ -0,0 +1,100 @@
+import json
+import time
+
+from _sync_entities.sync_aliases import TopicAliases
+from _sync_entities.sync_dispatcher import EventPattern
+from _sync_entities.sync_plugin import Plugin
+
+# pylint: disable=unused-argument
+
+
+class PluginAliases(Plugin):
+    """
+    Negotiates short topic aliases with the other sites. See sync_aliases.
+
+    Enable by adding "aliases" to plugins. Sites without it keep getting full topics.
+    """
+
+    def initialize(self):
+        self.aliases = TopicAliases(self.myhostname, on_unknown=self.on_unknown)
+        # Every outbound topic is compressed, every inbound one expanded, by the transport
+        self.transport.aliases = self.aliases
+        self._asked = {}  # host -> when we last asked it for its aliases (monotonic)
+
+        for (name, event_type, callback) in (
+            ("aliases", "aliases", self.cb_aliases),
+            ("aliases_ack", "aliases_ack", self.cb_aliases_ack),
+            ("send_aliases", "send_aliases", self.cb_send_aliases),
+        ):
+            self.dispatcher.add_listener(
+                name,
+                EventPattern(
+                    pattern_fromhost=f"!{self.myhostname}",
+                    pattern_tohost=self.myhostname,
+                    pattern_event_type=event_type,
+                ),
+                callback,
+            )
+
+        # I have just started: nobody has my list, and I have nobody's
+        self.adapi.run_in(self.ask_for_aliases, 0, tohost="all")
+        self.adapi.run_every(
+            self.publish_aliases_if_changed,
+            "now",
+            self.argsn.get("alias_publish_seconds", 10),
+        )
+
+    def publish_aliases(self, tohost: str = "all"):
+        self.aliases.dirty = False
+        self.publish(tohost, "aliases", payload=json.dumps(self.aliases.table()))
+
+    def publish_aliases_if_changed(self, kwargs):
+        # New names are only aliased once the other sites ack a list that has them
+        if self.aliases.dirty:
+            self.publish_aliases()
+
+    def ask_for_aliases(self, kwargs):
+        self.publish(kwargs["tohost"], "send_aliases")
+
+    def on_unknown(self, fromhost: str):
+        """
+        An aliased message from a host whose list we don't have. Ask - at most every 10s.
+        """
+        now = time.monotonic()
+        if now - self._asked.get(fromhost, 0) < 10:
+            return
+        self._asked[fromhost] = now
+        self.log.warning_ratelimited(
+            "alias_unknown",
+            "PluginAliases - unknown aliases from %s. Asking for them.",
+            fromhost,
+        )
+        self.adapi.run_in(self.ask_for_aliases, 0, tohost=fromhost)
+
+    def cb_aliases(self, fromhost, tohost, event, entity, payload, payload_asobj=None):
+        count = self.aliases.learn(fromhost, payload_asobj)
+        if count is None:
+            self.log.warning_ratelimited(
+                "alias_bad", "PluginAliases - bad list: %s -- %.80s", fromhost, payload
+            )
+            return
+        self.publish(
+            fromhost,
+            "aliases_ack",
+            payload=json.dumps({"epoch": payload_asobj.get("epoch"), "n": count}),
+        )
+
+    def cb_aliases_ack(
+        self, fromhost, tohost, event, entity, payload, payload_asobj=None
+    ):
+        if isinstance(payload_asobj, dict):
+            self.aliases.acked(
+                fromhost, payload_asobj.get("epoch"), payload_asobj.get("n")
+            )
+
+    def cb_send_aliases(
+        self, fromhost, tohost, event, entity, payload, payload_asobj=None
+    ):
+        # It lost my list (restarted) - full topics to it, until it acks the new copy
+        self.aliases.forget_peer(fromhost)
+        self.publish_aliases(fromhost)
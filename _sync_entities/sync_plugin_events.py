@@ -1,17 +1,57 @@
 import json
-from typing import Optional
+import threading
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
 
+from _sync_entities.sync_commands import CommandTracker, PendingCommand
 from _sync_entities.sync_dispatcher import EventPattern
+from _sync_entities.sync_domain_handlers import (
+    HassAction,
+    group_hass_actions,
+    resolve_hass_action,
+    split_command,
+)
 from _sync_entities.sync_plugin import Plugin
-from _sync_entities.sync_utils import entity_local_to_remote
-from appdaemon.adapi import ADAPI
+from _sync_entities.sync_state_cache import StateCache
 from appdaemon.plugins.hass.hassplugin import HassPlugin
 
 # pylint: disable=unused-argument
 
+# Extra time the sender waits, beyond the receiver's confirmation timeout, before giving up.
+ACK_NETWORK_ALLOWANCE = 5
+
+
+def _states_match(cur_state, target) -> bool:
+    """
+    "on" == "on", "5" == "5.0"
+    """
+    if cur_state is None:
+        return False
+    if str(cur_state) == str(target):
+        return True
+    try:
+        return float(cur_state) == float(target)
+    except (TypeError, ValueError):
+        return False
+
 
 class PluginEvents(Plugin):
     def initialize(self):
+        self.command_acks = self.argsn.get("command_acks", False)
+        self.command_timeout = self.argsn.get("command_timeout", 10)
+        self.commands = CommandTracker(
+            self.adapi,
+            self.myhostname,
+            self._send_command,
+            timeout=self.command_timeout + ACK_NETWORK_ALLOWANCE,
+            max_in_flight=self.argsn.get("command_window", 32),
+            on_result=self._command_result,
+            log=self.log,
+        )
+        self._confirming: Dict[str, dict] = {}  # cid -> {"timer", "listeners", "done"}
+        self._confirming_lock = threading.Lock()
+        # Local entity states, so a command does not wait on Hass lookups
+        self.states = StateCache(self.adapi, self.log)
+
         self.adapi.run_in(
             self.register_inbound_event, 0
         )  # EG: mqtt_shared/haven/seattle/event/light.office off
@@ -36,42 +76,75 @@ class PluginEvents(Plugin):
             payload == desired state
 
             """
-            self.adapi.log(
-                f"EVENT - received: {fromhost}/{tohost}/{event}/{entity} data: {payload}",
-                level="DEBUG",
+            self.log.debug(
+                "EVENT - received: %s/%s/%s/%s data: %.80s",
+                fromhost,
+                tohost,
+                event,
+                entity,
+                payload,
             )
-            if not self.adapi.entity_exists(entity):
-                self.adapi.log(
-                    f"callback_inbound_event(): entity does not exist: {entity}.",
-                    level="WARNING",
+            cid = None
+            command = payload
+            if isinstance(payload_asobj, dict):
+                # {"state": "on", "cid": "seattle-17"} or {"hvac_mode": "heat", "temperature": 20}
+                cid = payload_asobj.get("cid")
+                command = payload_asobj
+            elif isinstance(payload_asobj, list):
+                self.log.warning(
+                    "callback_inbound_event(): [NOT IMPLEMENTED] - got JSON list payload: |%.80s|",
+                    payload,
                 )
                 return
+
+            cur_state = self.states.get(entity)
+            if cur_state is None:
+                self.log.warning(
+                    "callback_inbound_event(): entity does not exist: %s.", entity
+                )
+                self._send_ack(fromhost, entity, cid, False, "entity does not exist")
+                return
             if event != "event":
-                self.adapi.log(
-                    f"callback_inbound_event(): [NOT IMPLEMENTED] - got unexpected event: {event}",
-                    level="WARNING",
+                self.log.warning(
+                    "callback_inbound_event(): [NOT IMPLEMENTED] - got unexpected event: %s",
+                    event,
                 )
                 return
-            try:
-                _ = json.loads(payload)
-            except json.JSONDecodeError:
-                pass
-            else:
-                self.adapi.log(
-                    f"callback_inbound_event(): [NOT IMPLEMENTED] - got JSON payload. Currently only accept simple states: |{payload}|",
-                    level="WARNING",
+
+            (state, fields) = split_command(command)
+            action = resolve_hass_action(entity, state, fields)
+            if action is None:
+                self.log.warning(
+                    "callback_inbound_event(): [NOT IMPLEMENTED] - no action for: %s -- %.80s",
+                    entity,
+                    payload,
                 )
+                self._send_ack(fromhost, entity, cid, False, "unsupported action")
                 return
 
+            already_there = (
+                cid is not None
+                and action.expect is not None
+                and _states_match(cur_state, action.expect)
+            )
+
             # Do it
-            _inbound_take_hass_action(
-                self.adapi,
-                self.mqtt.get_plugin_api("HASS"),
-                event,
+            hass = self.mqtt.get_plugin_api("HASS")
+            if cid is None or action.expect is None or already_there:
+                _inbound_take_hass_action(hass, action, entity)
+                self._send_ack(fromhost, entity, cid, True, state)
+                return
+            if not self._confirm_command(
+                fromhost,
                 entity,
-                payload,
-                payload_asobj,
-            )
+                {entity: action.expect},
+                cid,
+                lambda: _inbound_take_hass_action(hass, action, entity),
+            ):
+                self.log.warning(
+                    "callback_inbound_event(): %s is already pending - repeat ignored",
+                    cid,
+                )
 
         self.dispatcher.add_listener(
             "event_in",
@@ -83,6 +156,241 @@ class PluginEvents(Plugin):
             callback_inbound_event,
         )
 
+        def callback_inbound_bulk_event(
+            fromhost, tohost, event, entity, payload, payload_asobj=None
+        ):
+            """
+            Act on many entities with one message:
+
+                mqtt_shared/haven/seattle/bulk_event {"entities": {"light.office": "off", "light.den": "off"}}
+
+            Entities that need the same Hass service call are grouped into one call.
+            (Eg: one light/turn_off with both lights.)
+
+            A value may also be a multi-field command: {"climate.den": {"hvac_mode": "heat", "temperature": 20}}
+            """
+            self.log.debug(
+                "BULK EVENT - received: %s/%s/%s data: %.80s",
+                fromhost,
+                tohost,
+                event,
+                payload,
+            )
+            entities = (
+                payload_asobj.get("entities")
+                if isinstance(payload_asobj, dict)
+                else None
+            )
+            if not isinstance(entities, dict):
+                self.log.warning(
+                    "callback_inbound_bulk_event(): invalid payload: |%.80s|", payload
+                )
+                return
+            cid = payload_asobj.get("cid")
+
+            # From the cache. Any misses cost one get_state() for all, not one call each.
+            cur_states = self.states.get_many(entities)
+            commands = {}
+            failed = []
+            for entity_id, command in entities.items():
+                if entity_id in cur_states:
+                    commands[entity_id] = command
+                else:
+                    failed.append(entity_id)
+
+            (groups, unsupported) = group_hass_actions(commands)
+            failed += unsupported
+            if failed:
+                self.log.warning(
+                    "callback_inbound_bulk_event(): entities do not exist or have no action: %s",
+                    failed,
+                )
+
+            hass = self.mqtt.get_plugin_api("HASS")
+
+            def take_actions():
+                for (action, entity_ids) in groups:
+                    _inbound_take_hass_action(hass, action, entity_ids)
+
+            pending = {
+                entity_id: action.expect
+                for (action, entity_ids) in groups
+                for entity_id in entity_ids
+                if action.expect is not None
+                and not _states_match(cur_states[entity_id], action.expect)
+            }
+            if cid is None or failed or not pending:
+                take_actions()
+                if failed:
+                    self._send_ack(fromhost, None, cid, False, f"failed: {failed}")
+                else:
+                    self._send_ack(fromhost, None, cid, True, commands)
+                return
+            if not self._confirm_command(fromhost, None, pending, cid, take_actions):
+                self.log.warning(
+                    "callback_inbound_bulk_event(): %s is already pending - repeat ignored",
+                    cid,
+                )
+
+        self.dispatcher.add_listener(
+            "bulk_event_in",
+            EventPattern(
+                pattern_fromhost=f"!{self.myhostname}",
+                pattern_tohost=f"{self.myhostname}",
+                pattern_event_type="bulk_event",
+            ),
+            callback_inbound_bulk_event,
+        )
+
+        def callback_inbound_ack(
+            fromhost, tohost, event, entity, payload, payload_asobj=None
+        ):
+            """
+            mqtt_shared/haven/seattle/ack/light.office {"cid": "seattle-17", "ok": true, "state": "on"}
+            """
+            if not isinstance(payload_asobj, dict) or "cid" not in payload_asobj:
+                self.log.warning(
+                    "callback_inbound_ack(): invalid ack: %s/%s/%s/%s -- %.80s",
+                    fromhost,
+                    tohost,
+                    event,
+                    entity,
+                    payload,
+                )
+                return
+            ok = bool(payload_asobj.get("ok"))
+            self.commands.on_ack(
+                payload_asobj["cid"],
+                ok,
+                payload_asobj.get("state") if ok else payload_asobj.get("reason"),
+            )
+
+        self.dispatcher.add_listener(
+            "ack_in",
+            EventPattern(
+                pattern_fromhost=f"!{self.myhostname}",
+                pattern_tohost=f"{self.myhostname}",
+                pattern_event_type="ack",
+            ),
+            callback_inbound_ack,
+        )
+
+    def _confirm_command(
+        self,
+        fromhost: str,
+        ack_entity: Optional[str],
+        targets: Dict[str, str],
+        cid: str,
+        act: Callable[[], None],
+    ) -> bool:
+        """
+        Does act() (the Hass service calls), then acks once HA reports every target state.
+        Nacks after command_timeout.
+
+        The timer and state listeners are in place before act(), so a device that changes
+        quickly is not missed - and the states are checked once more after it.
+        False (and act() is not done) if cid is already pending - a repeat.
+
+        targets: {entity: desired_state}
+        """
+        remaining = dict(targets)
+        listeners: List[Any] = []
+        pending = {"timer": None, "listeners": listeners, "done": False}
+        with self._confirming_lock:
+            if cid in self._confirming:
+                return False
+            self._confirming[cid] = pending
+
+        def finish(ok: bool, detail):
+            with self._confirming_lock:
+                if pending["done"]:
+                    return  # Already finished
+                pending["done"] = True
+                self._confirming.pop(cid, None)
+                handles = list(listeners)
+            for handle in handles:
+                self.adapi.cancel_listen_state(handle)
+            if ok:
+                self.adapi.cancel_timer(pending["timer"])
+            self._send_ack(fromhost, ack_entity, cid, ok, detail)
+
+        def cb_state(entity, attribute, old, new, kwargs):
+            if entity not in remaining or not _states_match(new, remaining[entity]):
+                return
+            remaining.pop(entity, None)
+            if not remaining:
+                finish(True, new if ack_entity else targets)
+
+        def cb_timeout(kwargs):
+            finish(False, f"timeout: {sorted(remaining)}")
+
+        pending["timer"] = self.adapi.run_in(cb_timeout, self.command_timeout)
+        for entity in targets:
+            handle = self.adapi.listen_state(cb_state, entity)
+            with self._confirming_lock:
+                if not pending["done"]:
+                    listeners.append(handle)
+                    continue
+            self.adapi.cancel_listen_state(handle)  # Finished in the meantime
+
+        try:
+            act()
+        except Exception as err:
+            finish(False, f"failed: {err}")
+            raise
+        # A change before the listeners were registered, or one they were not told about
+        for entity in list(remaining):
+            cb_state(entity, None, None, self.adapi.get_state(entity), None)
+        return True
+
+    def _send_ack(
+        self,
+        tohost: str,
+        entity: Optional[str],
+        cid: Optional[str],
+        ok: bool,
+        detail,
+    ):
+        if cid is None:
+            return
+        ack = {"cid": cid, "ok": ok}
+        ack["state" if ok else "reason"] = detail
+        self.publish(tohost, "ack", entity, json.dumps(ack))
+
+    def _send_command(self, command: PendingCommand):
+        if command.event_type == "bulk_event":
+            body = {"entities": command.payload}
+        elif isinstance(command.payload, dict):
+            body = dict(command.payload)  # Multi-field command
+        else:
+            body = {"state": command.payload}
+        body["cid"] = command.cid
+        self.publish(
+            command.tohost, command.event_type, command.entity, json.dumps(body)
+        )
+
+    def _command_result(self, command: PendingCommand, ok: bool, detail):
+        """
+        Let Hass know how a command turned out. (Eg: to show an error on a dashboard.)
+        """
+        self.log.log(
+            "DEBUG" if ok else "WARNING",
+            "command result: %s %s/%s ok=%s -- %.80s",
+            command.cid,
+            command.tohost,
+            command.entity,
+            ok,
+            detail,
+        )
+        self.adapi.fire_event(
+            "app.sync_entities_via_mqtt_result",
+            cid=command.cid,
+            host=command.tohost,
+            entity_id=command.entity or list(command.payload),
+            ok=ok,
+            detail=detail,
+        )
+
     def register_outbound_service(self, kwargs):
         """
         Register a service for signaling to a remote entity that it should change the state of an object.
@@ -94,16 +402,25 @@ class PluginEvents(Plugin):
         call_service("default", "sync_entities_via_mqtt", "set_state", {"entity_id":"sensor.light_office_pihaven","state":"on"})
         call_service("default", "sync_entities_via_mqtt", "toggle_state", {"entity_id":"sensor.light_office_pihaven"})
 
+        Optional (AppDaemon only, with command_acks: true):
+            success_cb=fn(cid, state), failure_cb=fn(cid, reason)
+
         What it does:
             mqtt_publish("mqtt_shared/pihaven/state", payload="on")
+
+            With command_acks, the payload carries a correlation id and the remote acks it:
+            mqtt_publish("mqtt_shared/pihaven/state", payload='{"state": "on", "cid": "seattle-17"}')
         """
 
         def callback_outbound_service(
             namespace: str, service: str, action: str, kwargs
         ) -> None:
-            self.adapi.log(
-                f"sync_service_callback(namespace={namespace}, service={service}, action={action}, kwargs={kwargs})",
-                level="DEBUG",
+            self.log.debug(
+                "sync_service_callback(namespace=%s, service=%s, action=%s, kwargs=%.80s)",
+                namespace,
+                service,
+                action,
+                kwargs,
             )
 
             if (
@@ -117,7 +434,7 @@ class PluginEvents(Plugin):
 
             local_entity = kwargs["entity_id"]
 
-            (remote_entity, remote_host) = entity_local_to_remote(local_entity)
+            (remote_entity, remote_host) = self.mirrors.resolve_local(local_entity)
             if remote_host is None:
                 raise RuntimeError(
                     f"Programming error - invalid remote_entity_id: {local_entity}"
@@ -126,9 +443,13 @@ class PluginEvents(Plugin):
             if action == "set_state":
                 value = kwargs["state"]
             elif action == "toggle_state":
-                if not self.adapi.entity_exists(local_entity):
+                # The mirror registry has the last state the remote sent
+                record = self.mirrors.get(local_entity)
+                cur_state = record.state if record is not None else None
+                if cur_state is None:
+                    cur_state = self.states.get(local_entity)
+                if cur_state is None:
                     raise RuntimeError(f"entity does not exist: {local_entity}")
-                cur_state = self.adapi.get_state(entity_id=local_entity)
                 if cur_state == "on":
                     value = "off"
                 elif cur_state == "off":
@@ -140,11 +461,69 @@ class PluginEvents(Plugin):
             else:
                 raise RuntimeError(f"Invalid action: |{action}|, type: {type(action)}")
 
-            self.mqtt.mqtt_publish(
-                topic=f"{self.mqtt_base_topic}/{self.myhostname}/{remote_host}/event/{remote_entity}",
-                payload=value,
-                namespace="mqtt",
+            if self.command_acks:
+                self.commands.submit(
+                    remote_host,
+                    remote_entity,
+                    value,
+                    kwargs.get("success_cb"),
+                    kwargs.get("failure_cb"),
+                )
+            else:
+                self.publish(
+                    remote_host,
+                    "event",
+                    remote_entity,
+                    json.dumps(value) if isinstance(value, dict) else value,
+                )
+
+        def callback_outbound_bulk_service(
+            namespace: str, service: str, action: str, kwargs
+        ) -> None:
+            """
+            call_service("sync_entities_via_mqtt/bulk_set_state", entities={
+                "sensor.light_office_xxhavenxx": "off",
+                "sensor.light_den_xxhavenxx": "off",
+            })
+
+            entities may also be a list: [{"entity_id": ..., "state": ...}, ...] or [[entity_id, state], ...]
+
+            What it does - one message per remote host:
+                mqtt_publish("mqtt_shared/seattle/haven/bulk_event", payload='{"entities": {"light.office": "off", "light.den": "off"}}')
+            """
+            self.log.debug(
+                "callback_outbound_bulk_service(namespace=%s, service=%s, action=%s, kwargs=%.80s)",
+                namespace,
+                service,
+                action,
+                kwargs,
             )
+            if namespace != "default" or action != "bulk_set_state":
+                raise RuntimeError(
+                    f"Invalid parameters: callback_outbound_bulk_service(namespace={namespace}, service={service}, action={action}, kwargs={kwargs})"
+                )
+
+            per_host: Dict[str, Dict[str, Any]] = {}
+            for local_entity, state in _bulk_entities_arg(kwargs.get("entities")):
+                (remote_entity, remote_host) = self.mirrors.resolve_local(local_entity)
+                per_host.setdefault(remote_host, {})[remote_entity] = state
+
+            for remote_host, entities in per_host.items():
+                if self.command_acks:
+                    self.commands.submit(
+                        remote_host,
+                        None,
+                        entities,
+                        kwargs.get("success_cb"),
+                        kwargs.get("failure_cb"),
+                        event_type="bulk_event",
+                    )
+                else:
+                    self.publish(
+                        remote_host,
+                        "bulk_event",
+                        payload=json.dumps({"entities": entities}),
+                    )
 
         hass = self.mqtt.get_plugin_api("HASS")
 
@@ -154,9 +533,11 @@ class PluginEvents(Plugin):
         hass.register_service(
             "sync_entities_via_mqtt/toggle_state", callback_outbound_service
         )
-        self.adapi.log(
-            "register_service: sync_entities_via_mqtt -- set_state, toggle_state",
-            level="DEBUG",
+        hass.register_service(
+            "sync_entities_via_mqtt/bulk_set_state", callback_outbound_bulk_service
+        )
+        self.log.debug(
+            "register_service: sync_entities_via_mqtt -- set_state, toggle_state, bulk_set_state"
         )
 
     def register_outbound_event(self, kwargs):
@@ -183,23 +564,37 @@ class PluginEvents(Plugin):
                 service: script.fire_event_sync_entities_via_mqtt_toggle
                 service_data:
                   entity_id: light.office_seattle
+
+        Bulk:
+            - event: app.sync_entities_via_mqtt
+                event_data:
+                    action: bulk_set_state
+                    entities:
+                        sensor.light_office_xxhavenxx: "off"
+                        sensor.light_den_xxhavenxx: "off"
         """
 
         def callback_outbound_event(event, data, kwargs):
-            self.adapi.log(
-                f"callback_outbound_event(): {event} -- {data} -- {kwargs}",
-                level="DEBUG",
-            )
-            self.adapi.call_service(
-                f'sync_entities_via_mqtt/{data.get("action", "NO_ACTION")}',
-                entity_id=data.get("entity_id"),
-                state=data.get("state"),
+            self.log.debug(
+                "callback_outbound_event(): %s -- %.80s -- %.80s", event, data, kwargs
             )
+            action = data.get("action", "NO_ACTION")
+            if action == "bulk_set_state":
+                self.adapi.call_service(
+                    f"sync_entities_via_mqtt/{action}",
+                    entities=data.get("entities"),
+                )
+            else:
+                self.adapi.call_service(
+                    f"sync_entities_via_mqtt/{action}",
+                    entity_id=data.get("entity_id"),
+                    state=data.get("state"),
+                )
 
         self.adapi.listen_event(
             callback_outbound_event, event="app.sync_entities_via_mqtt"
         )
-        self.adapi.log("Registered event: app.sync_entities_via_mqtt", level="DEBUG")
+        self.log.debug("Registered event: app.sync_entities_via_mqtt")
 
     def test_event_mechanism(self, _):
         self.adapi.log("TEST event mechanism")
@@ -211,59 +606,48 @@ class PluginEvents(Plugin):
             )  # pyright: reportGeneralTypeIssues=false
 
 
+def _command_arg(state):
+    # Multi-field commands (dicts) go through as is. Everything else is a simple state.
+    return state if isinstance(state, dict) else str(state)
+
+
+def _bulk_entities_arg(entities) -> List[Tuple[str, Any]]:
+    """
+    {entity: state} or [{"entity_id": entity, "state": state}] or [[entity, state]]
+        --> [(entity, state), ...]
+    """
+    if isinstance(entities, dict):
+        return [(entity, _command_arg(state)) for entity, state in entities.items()]
+    if isinstance(entities, list):
+        pairs = []
+        for item in entities:
+            if isinstance(item, dict):
+                pairs.append((item["entity_id"], _command_arg(item["state"])))
+            else:
+                (entity, state) = item
+                pairs.append((entity, _command_arg(state)))
+        return pairs
+    raise RuntimeError(f"Invalid entities for bulk_set_state: {entities}")
+
+
 def _inbound_take_hass_action(
-    adapi: ADAPI,
     hass: HassPlugin,
-    event: str,
-    entity: str,
-    payload: str,
-    payload_asobj: Optional[dict] = None,
+    action: HassAction,
+    entity: Union[str, List[str]],
 ):
     """
-    Given and entity, and a state, take an appropriate action.
+    Take a resolved action (see sync_domain_handlers) on one entity, or a list of like entities.
 
     EG:
-    "light.office", "on" --> hass.turn_on("light.office")
-    "input_select.home_mode", "Away" --> hass.select_option("input_select.home_mode", "Away")
+    "light.office", "on" --> light/turn_on(entity_id="light.office")
+    "input_select.home_mode", "Away" --> input_select/select_option(entity_id="input_select.home_mode", option="Away")
+    ["light.a", "light.b"], "off" --> light/turn_off(entity_id=["light.a", "light.b"])
 
+    It does NOT wait for the result.
 
     Dev Notes:
 
     * Unfortunately, you can NOT simply set the state on an entity.
     * If you do that, it WILL set the state, but it will NOT change the underlying Hass device.
     """
-    platform, sep, _ = entity.partition(".")
-    if not sep:
-        adapi.log(
-            f"_inbound_take_hass_action(): entity of improper format: {entity}",
-            level="WARNING",
-        )
-        return
-
-    if platform in ["light", "switch", "scene", "script"]:
-        if payload == "on":
-            hass.turn_on(entity_id=entity)
-        elif payload == "off":
-            hass.turn_off(entity_id=entity)
-        else:
-            adapi.log(
-                f"_inbound_take_hass_action(): unexpected state for entity: {entity} -- {payload}",
-                level="WARNING",
-            )
-    elif platform == "input_number":
-        hass.set_value(entity, payload)
-    elif platform == "input_text":
-        hass.set_textvalue(entity, payload)
-    elif platform == "input_select":
-        hass.select_option(entity, payload)
-    else:
-        adapi.log(
-            f"_inbound_take_hass_action(): NOT IMPLEMENTED: Unexpected platform for entity: {entity}",
-            level="WARNING",
-        )
-        return
-
-    if adapi.get_state(entity_id=entity) != payload:
-        adapi.log(
-            f"event_in_callback(): Not able to set state correctly.", level="WARNING"
-        )
+    hass.call_service(action.service, **{**action.data, "entity_id": entity})
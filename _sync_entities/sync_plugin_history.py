@@ -0,0 +1,218 @@
+import json
+import time
+from datetime import datetime, timezone
+from typing import Dict, List
+
+from _sync_entities.sync_dispatcher import EventPattern
+from _sync_entities.sync_history import Bucket, HistoryAggregator, HistoryStore
+from _sync_entities.sync_plugin import Plugin
+from _sync_entities.sync_utils import entity_local_to_remote, entity_remote_to_local
+
+# pylint: disable=unused-argument
+
+
+class PluginHistory(Plugin):
+    """
+    Downsampled history for remote graphs. See sync_history.
+
+    Owner:    history_for_entities are aggregated, and each complete bucket published.
+    Receiver: buckets are kept in history_store, and shown on <mirror>_history:
+        sensor.sensor_house_power_xxhavenxx_history
+            state: the latest bucket's mean
+            attributes: {"interval": 300, "buckets": [[start, min, max, mean], ...]}
+
+    Enable by adding "history" to plugins - on the owner, and on the sites that want graphs.
+    """
+
+    def initialize(self):
+        self.interval = self.argsn.get("history_interval", 300)
+        self.keep_seconds = self.argsn.get("history_keep_hours", 24) * 60 * 60
+        self.history_entities = self.argsn.get("history_for_entities") or []
+        self.aggregator = HistoryAggregator(
+            self.interval, keep=int(self.keep_seconds // self.interval)
+        )
+        self.store = HistoryStore(self.argsn.get("history_store") or ":memory:")
+
+        for (name, event_type, callback) in (
+            ("inbound_history", "history", self.cb_history),
+            ("inbound_send_history", "send_history", self.cb_send_history),
+        ):
+            self.dispatcher.add_listener(
+                name,
+                EventPattern(
+                    pattern_fromhost=f"!{self.myhostname}",
+                    pattern_tohost=self.myhostname,
+                    pattern_event_type=event_type,
+                ),
+                callback,
+            )
+
+        if self.history_entities:
+            self.adapi.run_in(self.register_history_entities, 0)
+            # A bucket goes out at most a minute after it ends
+            self.adapi.run_every(
+                self.publish_closed_buckets, "now", min(60, self.interval)
+            )
+        self.adapi.run_in(self.restore_history, 0)
+        self.adapi.run_in(self.ask_for_history, 1, tohost="all")
+        self.adapi.run_in(self.register_backfill_service, 0)
+
+    #
+    # Owner
+    #
+    def register_history_entities(self, kwargs):
+        for entity in self.history_entities:
+            self.backfill_from_recorder(entity)
+            self.adapi.listen_state(self.cb_history_state, entity)
+
+    def backfill_from_recorder(self, entity: str):
+        """
+        Rebuilds the buckets from HA's recorder, so a restart does not leave a hole.
+        """
+        start = datetime.fromtimestamp(time.time() - self.keep_seconds, timezone.utc)
+        try:
+            hass = self.mqtt.get_plugin_api("HASS")
+            history = hass.get_history(entity_id=entity, start_time=start) or []
+            states = [
+                (datetime.fromisoformat(row["last_changed"]).timestamp(), row["state"])
+                for rows in history
+                for row in rows
+            ]
+        except Exception as err:  # pylint: disable=broad-except
+            # No recorder, or an unexpected format - start from now
+            self.log.warning(
+                "PluginHistory - no recorder history for %s: %s", entity, err
+            )
+            return
+        self.aggregator.backfill(entity, states)
+        self.log.debug(
+            "PluginHistory - %s: %s buckets from the recorder",
+            entity,
+            len(self.aggregator.buckets(entity)),
+        )
+
+    def cb_history_state(self, entity, attribute, old, new, kwargs):
+        self.aggregator.add(entity, new)
+
+    def publish_closed_buckets(self, kwargs):
+        for (entity, buckets) in self.aggregator.close().items():
+            self.publish_buckets("all", entity, buckets)
+
+    def publish_buckets(self, tohost: str, entity: str, buckets: List[Bucket]):
+        self.publish(
+            tohost,
+            "history",
+            entity,
+            json.dumps({"i": self.interval, "b": buckets}, separators=(",", ":")),
+        )
+
+    def cb_send_history(
+        self, fromhost, tohost, event, entity, payload, payload_asobj=None
+    ):
+        # {"since": 1700000000, "after": {"haven": {"sensor.power": 1700086400}}}
+        since = 0
+        after = {}
+        if isinstance(payload_asobj, dict):
+            since = payload_asobj.get("since") or 0
+            after = payload_asobj.get("after")
+            after = after.get(self.myhostname) if isinstance(after, dict) else None
+            after = after if isinstance(after, dict) else {}
+        for entity_name in self.history_entities:
+            entity_since = after.get(entity_name)
+            if not isinstance(entity_since, (int, float)):
+                entity_since = since
+            buckets = self.aggregator.buckets(entity_name, entity_since)
+            if buckets:
+                self.publish_buckets(fromhost, entity_name, buckets)
+
+    #
+    # Receiver
+    #
+    def history_entity(self, local_entity: str) -> str:
+        # Not a mirror name (it does not end in xx<host>xx) - nothing mistakes it for one
+        return f"{local_entity}_history"
+
+    def cb_history(self, fromhost, tohost, event, entity, payload, payload_asobj=None):
+        buckets = payload_asobj.get("b") if isinstance(payload_asobj, dict) else None
+        try:
+            buckets = [
+                (int(bucket[0]), float(bucket[1]), float(bucket[2]), float(bucket[3]))
+                for bucket in buckets
+            ]
+            local_entity = entity_remote_to_local(entity, fromhost)
+        except (TypeError, ValueError, IndexError, NotImplementedError):
+            self.log.warning_ratelimited(
+                "history_bad",
+                "PluginHistory - bad history: %s/%s -- %.80s",
+                fromhost,
+                entity,
+                payload,
+            )
+            return
+        self.store.put(local_entity, buckets)
+        self.show_history(local_entity, payload_asobj.get("i", self.interval))
+
+    def show_history(self, local_entity: str, interval):
+        series = self.store.series(local_entity, time.time() - self.keep_seconds)
+        if not series:
+            return
+        self.adapi.set_state(
+            self.history_entity(local_entity),
+            state=series[-1][3],
+            attributes={"interval": interval, "buckets": [list(b) for b in series]},
+            namespace="default",
+            _silent=True,
+        )
+
+    def restore_history(self, kwargs):
+        pruned = self.store.prune(time.time() - self.keep_seconds)
+        entities = self.store.entities()
+        for local_entity in entities:
+            self.show_history(local_entity, self.interval)
+        self.log.debug(
+            "PluginHistory - restored %s, pruned %s buckets", len(entities), pruned
+        )
+
+    def ask_for_history(self, kwargs):
+        """
+        Backfill. Ask for everything since keep_hours ago - except, of the entities we have,
+        only since the newest bucket we have of each. (Each owner reads its own.)
+        """
+        since = time.time() - kwargs.get("hours", self.keep_seconds / 3600) * 60 * 60
+        message = {"since": int(since)}
+        after: Dict[str, Dict[str, int]] = {}  # host -> entity -> newest bucket start
+        if not kwargs.get("hours"):
+            for (local_entity, newest) in self.store.newest().items():
+                try:
+                    (entity, host) = entity_local_to_remote(local_entity)
+                except ValueError:
+                    continue
+                if newest > since:
+                    after.setdefault(host, {})[entity] = int(newest)
+        if after:
+            message["after"] = after
+        self.publish(
+            kwargs.get("tohost", "all"), "send_history", payload=json.dumps(message)
+        )
+
+    def terminate(self):
+        self.store.close()
+
+    def register_backfill_service(self, kwargs):
+        """
+        self.call_service(
+            "sync_entities_via_mqtt/history_backfill",
+            tohost="haven",  # Default: all
+            hours=24,  # Default: since the newest bucket we have
+        )
+        """
+
+        def callback_backfill_service(
+            namespace: str, service: str, action: str, kwargs
+        ):
+            self.ask_for_history(kwargs)
+
+        hass = self.mqtt.get_plugin_api("HASS")
+        hass.register_service(
+            "sync_entities_via_mqtt/history_backfill", callback_backfill_service
+        )
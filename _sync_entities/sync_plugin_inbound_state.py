@@ -1,8 +1,16 @@
-from typing import Callable
+import json
+import time
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set
 
+from _sync_entities.sync_concurrency import StripedLock
+from _sync_entities.sync_digest import BucketDigest, bucket_for
 from _sync_entities.sync_dispatcher import EventPattern
+from _sync_entities.sync_mirror_registry import MirrorRecord, state_digest
+from _sync_entities.sync_mirror_store import MirrorStore
 from _sync_entities.sync_plugin import Plugin
-from _sync_entities.sync_utils import entity_local_to_remote, entity_remote_to_local
+from _sync_entities.sync_timer_wheel import TimerWheel
+from _sync_entities.sync_transforms import StateTransforms
+from _sync_entities.sync_utils import entity_local_to_remote
 
 # pylint: disable=unused-argument
 
@@ -12,11 +20,52 @@ class PluginInboundState(Plugin):
         self.state_entities = self.argsn.get("state_for_entities", [])
 
         if not self.state_entities:
-            self.adapi.log(
-                f"PluginInboundState - no entities in config to watch for. argsn: {self.argsn}",
-                level="WARNING",
+            self.log.warning(
+                "PluginInboundState - no entities in config to watch for. argsn: %.80s",
+                self.argsn,
             )
 
+        # Outbound: round / deadband / min_interval / attributes, per entity
+        self.transforms = StateTransforms(self.argsn.get("state_transforms", {}))
+        self._deferred: Dict[str, tuple] = {}  # entity -> (tohost, state, attributes)
+        # State callbacks for one entity may overlap on different threads
+        self._entity_locks = StripedLock(16)
+        # Inbound, by (host, entity): a mirror's record and its Hass state change together
+        self._mirror_locks = StripedLock(16)
+
+        # Staleness. A host is alive while it sends state or heartbeats. If nothing arrives
+        # for stale_after_heartbeats * (its heartbeat interval), its mirrors go "unavailable".
+        # Heartbeats are only sent (and listened to) with stale_after_heartbeats set.
+        self.heartbeat_seconds = self.argsn.get("heartbeat_seconds", 60)
+        self.stale_after_heartbeats = self.argsn.get("stale_after_heartbeats", 0)
+        self._peer_intervals: Dict[str, float] = {}  # host -> its heartbeat_seconds
+        self._stale_hosts: Set[str] = set()
+        self._staleness = TimerWheel(
+            slot_seconds=max(1.0, self.heartbeat_seconds / 10), slots=64
+        )
+
+        # Anti-entropy. Every anti_entropy_seconds, advertise a digest of what we published.
+        # Remotes ask for just the buckets that differ from their mirrors. See sync_digest.
+        self.anti_entropy_seconds = self.argsn.get("anti_entropy_seconds", 0)
+        self.digest = BucketDigest(self.argsn.get("anti_entropy_buckets", 64))
+
+        # Sharded: this instance publishes only its share of state_for_entities. See sync_shards
+        self.shards = self.transport.shards
+        if self.shards is not None:
+            self.shards.on_change(self.rebalance)
+            if self.anti_entropy_seconds:
+                # Each instance's digest covers only its share - remotes would "repair" the rest
+                self.log.warning(
+                    "PluginInboundState - anti_entropy_seconds is ignored with instance_id"
+                )
+                self.anti_entropy_seconds = 0
+
+        self.mirror_store: Optional[MirrorStore] = None
+        self._mirror_flush_timer = None
+        if self.argsn.get("mirror_store"):
+            self.mirror_store = MirrorStore(self.argsn["mirror_store"])
+            self.restore_mirrors()
+
         self.dispatcher.add_listener(
             "inbound_state",
             EventPattern(
@@ -27,7 +76,13 @@ class PluginInboundState(Plugin):
             self.inbound_state_callback,
         )
 
+        self._state_handles: Dict[str, Any] = {}  # entity -> listen_state handle
         self.adapi.run_in(self.register_state_entities, 0)
+        # Change the synced entities without restarting the app (and a full resync). From HA:
+        #   event: SYNC_ENTITIES_RECONFIGURE
+        #   event_data: {"add": ["light.porch"], "remove": ["light.den"]}
+        #   event_data: {"state_for_entities": ["light.porch", "light.office"]}
+        self.adapi.listen_event(self.cb_reconfigure, "SYNC_ENTITIES_RECONFIGURE")
 
         self.adapi.run_in(
             self.register_inbound_send_state_event, 0
@@ -36,10 +91,47 @@ class PluginInboundState(Plugin):
         # Ask other sites to send me their state, upon startup
         self.adapi.run_in(self.ask_remotes_for_state, 1)
 
+        if self.anti_entropy_seconds:
+            for (name, event_type, callback) in (
+                ("inbound_digest", "digest", self.inbound_digest_callback),
+                ("inbound_repaired", "repaired", self.inbound_repaired_callback),
+            ):
+                self.dispatcher.add_listener(
+                    name,
+                    EventPattern(
+                        pattern_fromhost=f"!{self.myhostname}",
+                        pattern_tohost=self.myhostname,
+                        pattern_event_type=event_type,
+                    ),
+                    callback,
+                )
+            # Not "now" - first let startup's send_state settle
+            self.adapi.run_every(
+                self.send_digest,
+                f"now+{int(self.anti_entropy_seconds)}",
+                self.anti_entropy_seconds,
+            )
+
+        if self.heartbeat_seconds and self.stale_after_heartbeats:
+            # EG: mqtt_shared/seattle/all/heartbeat {"interval": 60}
+            self.dispatcher.add_listener(
+                "inbound_heartbeat",
+                EventPattern(
+                    pattern_fromhost=f"!{self.myhostname}",
+                    pattern_tohost=self.myhostname,
+                    pattern_event_type="heartbeat",
+                ),
+                self.inbound_heartbeat_callback,
+            )
+            self.adapi.run_every(self.send_heartbeat, "now", self.heartbeat_seconds)
+            self.adapi.run_every(
+                self.expire_stale_hosts, "now", self._staleness.slot_seconds
+            )
+
     def inbound_state_callback(
         self, fromhost, tohost, event, entity, payload, payload_asobj=None
     ):
-        self.adapi.log(f"inbound_state_callback entity: {entity}", level="DEBUG")
+        self.log.debug("inbound_state_callback entity: %s", entity)
         try:
             # Make sure I'm not doing something wrong and getting a remote entity like _xxSeattlexx
             (_, _) = entity_local_to_remote(entity)
@@ -47,54 +139,333 @@ class PluginInboundState(Plugin):
             pass
         else:
             # Should not be here - programming error
-            self.adapi.log(
-                f"inbound_state_callback(): Ignoring /{fromhost}/{tohost}/{event}/{entity} -- {payload}",
-                level="ERROR",
+            self.log.error(
+                "inbound_state_callback(): Ignoring /%s/%s/%s/%s -- %.80s",
+                fromhost,
+                tohost,
+                event,
+                entity,
+                payload,
+            )
+            return
+
+        self.log.debug(
+            "inbound_state_callback(): set_state: /%s/%s/%s/%s -- %.80s",
+            fromhost,
+            tohost,
+            event,
+            entity,
+            payload,
+        )
+
+        state = payload
+        if isinstance(payload_asobj, dict) and "state" in payload_asobj:
+            state = payload_asobj["state"]
+        attributes = None
+        if isinstance(payload_asobj, dict) and "state" in payload_asobj:
+            # {"state": "1234", "attributes": {...}} - see sync_transforms
+            attributes = payload_asobj.get("attributes")
+        envelope = self.dispatcher.current_envelope
+        # The record and Hass change together - expire_stale_hosts() may be marking it
+        with self._mirror_locks.for_key((fromhost, entity)):
+            record = self.mirrors.update(
+                fromhost, entity, state, envelope.seq if envelope else None
+            )
+            if record is not None:
+                self.set_mirror_state(record, attributes)
+        self._heard_from(fromhost)
+        if record is None:
+            self.log.debug(
+                "inbound_callback() out of order, ignoring: %s/%s", fromhost, entity
+            )
+            return
+
+        self.log.debug(
+            "inbound_callback() set_state(%s, state=%.80s)",
+            record.local_entity,
+            payload,
+        )
+        if self.mirror_store:
+            self.mirror_store.put(record)
+            if self._mirror_flush_timer is None:
+                self._mirror_flush_timer = self.adapi.run_in(
+                    self.flush_mirrors, self.argsn.get("mirror_flush_seconds", 5)
+                )
+
+    def set_mirror_state(self, record: MirrorRecord, attributes: Optional[dict] = None):
+        if isinstance(attributes, dict):
+            self.adapi.set_state(
+                record.local_entity,
+                state=record.state,
+                attributes=attributes,
+                namespace="default",
+                _silent=True,
+            )
+        else:
+            self.adapi.set_state(
+                record.local_entity,
+                state=record.state,
+                namespace="default",
+                _silent=True,
             )
+
+    def _heard_from(self, host: str, interval: Optional[float] = None):
+        if interval:
+            self._peer_intervals[host] = interval
+        if not self.stale_after_heartbeats:
             return
+        ttl = self.stale_after_heartbeats * self._peer_intervals.get(
+            host, self.heartbeat_seconds
+        )
+        self._staleness.schedule(host, ttl, time.monotonic())
+
+        if host in self._stale_hosts:
+            # Back from the dead. Its mirrors are "unavailable" - ask for everything.
+            self._stale_hosts.discard(host)
+            self.log.info("PluginInboundState - %s is back. Asking for state.", host)
+            self.publish(host, "send_state")
 
-        self.adapi.log(
-            f"inbound_state_callback(): set_state: /{fromhost}/{tohost}/{event}/{entity} -- {payload}",
-            level="DEBUG",
+    def inbound_heartbeat_callback(
+        self, fromhost, tohost, event, entity, payload, payload_asobj=None
+    ):
+        interval = None
+        if isinstance(payload_asobj, dict):
+            interval = payload_asobj.get("interval")
+        self._heard_from(
+            fromhost, interval if isinstance(interval, (int, float)) else None
         )
 
-        remote_entity = entity_remote_to_local(entity, fromhost)
-        self.adapi.log(
-            f"inbound_callback() set_state({remote_entity}, state={payload})",
-            level="DEBUG",
+    def send_heartbeat(self, kwargs):
+        self.publish(
+            "all", "heartbeat", payload=json.dumps({"interval": self.heartbeat_seconds})
         )
-        self.adapi.set_state(
-            f"{remote_entity}", state=payload, namespace="default", _silent=True
+
+    def expire_stale_hosts(self, kwargs):
+        for host in self._staleness.advance(time.monotonic()):
+            self._stale_hosts.add(host)
+            seconds = self.stale_after_heartbeats * self._peer_intervals.get(
+                host, self.heartbeat_seconds
+            )
+            # The registry too - its digests, and what the events plugin sees, follow.
+            # A mirror updated meanwhile (the host is back) is left alone.
+            mirrors = self.mirrors.mark_host(host, "unavailable", time.time() - seconds)
+            self.log.warning(
+                "PluginInboundState - nothing from %s in %ss. Marking %s mirrors unavailable.",
+                host,
+                seconds,
+                len(mirrors),
+            )
+            for record in mirrors:
+                with self._mirror_locks.for_key((record.host, record.entity)):
+                    if record.state == "unavailable":  # Not updated since
+                        self.set_mirror_state(record)
+
+    def restore_mirrors(self):
+        """
+        Sets every mirror to its last known state, before any remote has answered.
+        """
+        rows = self.mirror_store.load(
+            forget_seconds=self.argsn.get("mirror_forget_days", 7) * 24 * 60 * 60
         )
+        for (local_entity, row) in rows.items():
+            self.mirrors.update(
+                row.host, row.entity, row.state, row.seq, row.updated_at
+            )
+            self.adapi.set_state(
+                local_entity, state=row.state, namespace="default", _silent=True
+            )
+        for host in self.mirrors.hosts():
+            # If a host never comes back, its restored mirrors still go stale
+            self._heard_from(host)
+        self.log.info(
+            "PluginInboundState - restored %s mirrors from %s",
+            len(rows),
+            self.mirror_store.path,
+        )
+
+    def flush_mirrors(self, kwargs):
+        self._mirror_flush_timer = None
+        count = self.mirror_store.flush()
+        self.log.debug("flush_mirrors(): wrote %s", count)
+
+    def terminate(self):
+        if self.mirror_store is None:
+            return
+        if self._mirror_flush_timer is not None:
+            self.adapi.cancel_timer(self._mirror_flush_timer)
+            self._mirror_flush_timer = None
+        # Writes what is still buffered - those mirrors would otherwise restore stale
+        (store, self.mirror_store) = (self.mirror_store, None)
+        store.close()
 
     def __register_or_send_state(
-        self, tohost: str, action_fn: Callable[[Callable, str], None]
+        self,
+        tohost: str,
+        action_fn: Callable[[Callable, str], None],
+        gated: bool,
+        entities: Optional[Iterable[str]] = None,
     ):
         # Does two jobs - registering a listener on state, or sending state
         def state_callback(entity, _, __, cur_state, ___):
-            self.adapi.log(f"state_callback(): {entity}  -- {cur_state}", level="DEBUG")
-            self.mqtt.mqtt_publish(
-                topic=f"{self.mqtt_base_topic}/{self.myhostname}/{tohost}/state/{entity}",
-                payload=cur_state,
-                namespace="mqtt",
-            )
+            self.log.debug("state_callback(): %s  -- %.80s", entity, cur_state)
+            self.publish_state(tohost, entity, cur_state, gated)
 
-        for entity in self.state_entities:
+        for entity in self.owned_entities(entities):
             action_fn(state_callback, entity)
 
-    def register_state_entities(self, kwargs):
+    def owned_entities(self, entities: Optional[Iterable[str]] = None) -> List[str]:
+        """
+        Of entities (default: state_for_entities), those this instance publishes.
+        All of them, unless sharded.
+        """
+        entities = self.state_entities if entities is None else entities
+        if self.shards is None:
+            return list(entities)
+        return self.shards.owned_entities(entities)
+
+    def register_state_entities(self, kwargs, entities: Optional[List[str]] = None):
         def do_listen_state(state_callback: Callable, entity: str):
-            self.adapi.log(f"** registered state_listener for: {entity}", level="DEBUG")
-            self.adapi.listen_state(state_callback, entity, immediate=True)
+            if entity in self._state_handles:
+                return  # Already (eg: reconfigured before this first registration ran)
+            self.log.debug("** registered state_listener for: %s", entity)
+            if self.transforms.wants_attributes(entity):
+                handle = self.adapi.listen_state(
+                    state_callback, entity, attribute="all", immediate=True
+                )
+            else:
+                handle = self.adapi.listen_state(state_callback, entity, immediate=True)
+            self._state_handles[entity] = handle
+
+        self.__register_or_send_state("all", do_listen_state, True, entities)
 
-        self.__register_or_send_state("all", do_listen_state)
+    def reconfigure_state_entities(self, entities: List[str]):
+        """
+        Sync exactly these entities from now on. Only the difference is acted on:
+        added entities are listened to (and their state published right away, to "all"),
+        removed ones are no longer listened to. Nothing else is resent.
+        Sharded, only this instance's share is listened to.
+        """
+        entities = list(dict.fromkeys(entities))  # De-duplicated, in order
+        owned = self.owned_entities(entities)
+        wanted = set(owned)
+        removed = [entity for entity in self._state_handles if entity not in wanted]
+        added = [entity for entity in owned if entity not in self._state_handles]
+
+        for entity in removed:
+            handle = self._state_handles.pop(entity, None)
+            if handle is not None:
+                self.adapi.cancel_listen_state(handle)
+            self._deferred.pop(entity, None)
+            self.transforms.forget(entity)
+            self.digest.remove(entity)
+        self.state_entities = entities
+        self.register_state_entities({}, added)
+        self.log.info(
+            "PluginInboundState - reconfigured. Added: %s, removed: %s",
+            added,
+            removed,
+        )
+
+    def rebalance(self):
+        """
+        The instances of this site changed - take on, or let go of, entities.
+        """
+        self.reconfigure_state_entities(self.state_entities)
+
+    def cb_reconfigure(self, event_name, data, kwargs):
+        data = data or {}
+        entities = data.get("state_for_entities")
+        if entities is None:
+            remove = set(data.get("remove") or [])
+            entities = [
+                entity for entity in self.state_entities if entity not in remove
+            ] + list(data.get("add") or [])
+        if not isinstance(entities, list) or not all(
+            isinstance(entity, str) for entity in entities
+        ):
+            self.log.warning(
+                "PluginInboundState - bad SYNC_ENTITIES_RECONFIGURE data: %.80s", data
+            )
+            return
+        self.reconfigure_state_entities(entities)
+
+    def send_state_entities_tohost(
+        self,
+        tohost,
+        have: Optional[Dict[str, int]] = None,
+        entities: Optional[List[str]] = None,
+    ):
+        """
+        have - {entity: state_digest} the remote already has. Those that match are not sent.
+        entities - only these (default: all of state_for_entities)
+        """
 
-    def send_state_entities_tohost(self, tohost):
         def do_send_state(state_callback: Callable, entity: str):
-            cur_state = self.adapi.get_state(entity)
+            if self.transforms.wants_attributes(entity):
+                cur_state = self.adapi.get_state(entity, attribute="all")
+            else:
+                cur_state = self.adapi.get_state(entity)
+            (state, _) = self.transforms.shape(entity, cur_state)
+            if have and have.get(entity) == state_digest(state):
+                return
             state_callback(entity, None, None, cur_state, None)
 
-        self.__register_or_send_state(tohost, do_send_state)
+        self.__register_or_send_state(tohost, do_send_state, False, entities)
+
+    def publish_state(self, tohost: str, entity: str, cur_state, gated: bool = True):
+        """
+        Applies state_transforms (see sync_transforms), then publishes.
+        gated - apply deadband / min_interval. (Not for a full resend.)
+        """
+        transform = self.transforms.transform_for(entity)
+        if transform is None:
+            self.digest.set(entity, cur_state)
+            self.publish(tohost, "state", entity, cur_state)
+            return
+
+        (state, attributes) = transform.shape(cur_state)
+        with self._entity_locks.for_key(entity):
+            if gated:
+                wait = self.transforms.check(entity, state, attributes)
+                if wait is None:
+                    self.log.debug_sampled(
+                        "transform_drop",
+                        "publish_state(): unchanged: %s -- %.80s",
+                        entity,
+                        state,
+                    )
+                    return
+                if wait > 0:
+                    # Rate limited. Publish the latest value once the interval is up.
+                    if entity not in self._deferred:
+                        self.adapi.run_in(self._cb_deferred_state, wait, entity=entity)
+                    self._deferred[entity] = (tohost, state, attributes)
+                    return
+
+            deferred = self._deferred.get(entity)
+            if deferred is not None:
+                if tohost in ("all", deferred[0]):
+                    del self._deferred[entity]  # This publish covers it
+                else:
+                    # Only one host gets this - the deferred publish still goes out, as fresh
+                    self._deferred[entity] = (deferred[0], state, attributes)
+            self._publish_transformed(tohost, entity, state, attributes)
+
+    def _cb_deferred_state(self, kwargs):
+        entity = kwargs["entity"]
+        with self._entity_locks.for_key(entity):
+            deferred = self._deferred.pop(entity, None)
+            if deferred is None:
+                return  # Already went out (eg: a resend to all, or to the same host)
+            (tohost, state, attributes) = deferred
+            self._publish_transformed(tohost, entity, state, attributes)
+
+    def _publish_transformed(self, tohost: str, entity: str, state, attributes):
+        self.transforms.published(entity, state, attributes)
+        self.digest.set(entity, state)
+        if attributes is not None:
+            state = json.dumps({"state": state, "attributes": attributes})
+        self.publish(tohost, "state", entity, state)
 
     def register_inbound_send_state_event(self, kwargs):
         def callback_inbound_send_state(
@@ -103,12 +474,28 @@ class PluginInboundState(Plugin):
             """
             Act on an event received from a remote host:
                 mqtt_shared/seattle/all/send_state
+                mqtt_shared/seattle/all/send_state {"have": {"haven": {"light.office": 2212294583}}}
             """
-            self.adapi.log(
-                f"EVENT - received: {fromhost}/{tohost}/{event}/{entity} data: {payload}",
-                level="DEBUG",
+            self.log.debug(
+                "EVENT - received: %s/%s/%s/%s data: %.80s",
+                fromhost,
+                tohost,
+                event,
+                entity,
+                payload,
+            )
+            have = None
+            if isinstance(payload_asobj, dict) and isinstance(
+                payload_asobj.get("have"), dict
+            ):
+                have = payload_asobj["have"].get(self.myhostname)
+            if isinstance(payload_asobj, dict) and "buckets" in payload_asobj:
+                # Anti-entropy repair - just the buckets that differ
+                self.repair_buckets(fromhost, payload_asobj)
+                return
+            self.send_state_entities_tohost(
+                fromhost, have if isinstance(have, dict) else None
             )
-            self.send_state_entities_tohost(fromhost)
 
         self.dispatcher.add_listener(
             "event_send_state",
@@ -121,7 +508,119 @@ class PluginInboundState(Plugin):
         )
 
     def ask_remotes_for_state(self, kwargs):
-        self.mqtt.mqtt_publish(
-            topic=f"{self.mqtt_base_topic}/{self.myhostname}/all/send_state",
-            namespace="mqtt",
+        # With a mirror store, only ask for what differs from what we restored
+        have = self.mirrors.digests()
+        self.publish(
+            "all", "send_state", payload=json.dumps({"have": have}) if have else None
         )
+
+    #
+    # Anti-entropy - see sync_digest
+    #
+    def send_digest(self, kwargs):
+        self.publish(
+            "all",
+            "digest",
+            payload=json.dumps({"n": self.digest.n, "b": self.digest.buckets()}),
+        )
+
+    def inbound_digest_callback(
+        self, fromhost, tohost, event, entity, payload, payload_asobj=None
+    ):
+        """
+        mqtt_shared/haven/all/digest {"n": 64, "b": [...]}
+        Compare with my mirrors of haven. Ask for the buckets that differ.
+        """
+        if not isinstance(payload_asobj, dict) or not isinstance(
+            payload_asobj.get("n"), int
+        ):
+            self.log.warning_ratelimited(
+                "bad_digest", "Bad digest from %s: %.80s", fromhost, payload
+            )
+            return
+        self._heard_from(fromhost)
+        records = self.mirrors.by_host(fromhost)
+        mine = BucketDigest.of(
+            ((record.entity, record.state) for record in records), payload_asobj["n"]
+        )
+        buckets = mine.diff(payload_asobj.get("b"))
+        if buckets is None:
+            self.log.warning_ratelimited(
+                "bad_digest", "Bad digest from %s: %.80s", fromhost, payload
+            )
+            return
+        if buckets:
+            self.log.info(
+                "Anti-entropy - %s of %s buckets differ from %s. Asking for them.",
+                len(buckets),
+                mine.n,
+                fromhost,
+            )
+            self.publish(
+                fromhost,
+                "send_state",
+                payload=json.dumps({"n": mine.n, "buckets": buckets}),
+            )
+
+    def repair_buckets(self, tohost: str, request: dict):
+        """
+        request - {"n": 64, "buckets": [3, 17]}
+        Resend the entities in those buckets, then list them, so tohost can drop the rest.
+        """
+        n = request.get("n")
+        buckets = request.get("buckets")
+        if not isinstance(n, int) or n < 1 or not isinstance(buckets, list):
+            self.log.warning_ratelimited(
+                "bad_repair", "Bad repair request from %s: %.80s", tohost, request
+            )
+            return
+        wanted = set(buckets)
+        entities = [
+            entity for entity in self.state_entities if bucket_for(entity, n) in wanted
+        ]
+        self.send_state_entities_tohost(tohost, entities=entities)
+        self.publish(
+            tohost,
+            "repaired",
+            payload=json.dumps({"n": n, "buckets": buckets, "entities": entities}),
+        )
+
+    def inbound_repaired_callback(
+        self, fromhost, tohost, event, entity, payload, payload_asobj=None
+    ):
+        """
+        mqtt_shared/haven/seattle/repaired {"n": 64, "buckets": [3, 17], "entities": [...]}
+        Mirrors in those buckets that haven did not list, it no longer syncs.
+        """
+        if not isinstance(payload_asobj, dict):
+            return
+        n = payload_asobj.get("n")
+        buckets = payload_asobj.get("buckets")
+        entities = payload_asobj.get("entities")
+        if not isinstance(n, int) or n < 1 or not isinstance(buckets, list):
+            return
+        if not isinstance(entities, list):
+            return
+        buckets = set(buckets)
+        entities = set(entities)
+        orphans = [
+            record
+            for record in self.mirrors.by_host(fromhost)
+            if record.entity not in entities and bucket_for(record.entity, n) in buckets
+        ]
+        for record in orphans:
+            self.mirrors.remove(record.local_entity)
+            self.adapi.set_state(
+                record.local_entity,
+                state="unavailable",
+                namespace="default",
+                _silent=True,
+            )
+        if orphans:
+            self.log.info(
+                "Anti-entropy - %s no longer syncs %s. Forgot them.",
+                fromhost,
+                [record.entity for record in orphans],
+            )
+            if self.mirror_store:
+                self.mirror_store.delete(record.local_entity for record in orphans)
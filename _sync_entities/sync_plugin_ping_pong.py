@@ -1,4 +1,5 @@
 import datetime as dt
+import json
 from typing import Callable, Dict
 
 from _sync_entities.sync_dispatcher import EventPattern
@@ -33,33 +34,65 @@ class PluginPingPong(Plugin):
 
         self.adapi.run_in(self.register_ping_service, 0)
 
+        # With more than one mqtt namespace, keep measuring each one (see sync_transport)
+        if len(self.transport.namespaces) > 1:
+            self.adapi.run_every(
+                self.probe_paths, "now", self.argsn.get("transport_probe_seconds", 30)
+            )
+
         # Testing
         # self.adapi.run_in(self.test_ping_pong_service, 0)
 
     def cb_ping(self, fromhost, tohost, event, entity, payload, payload_asobj=None):
-        self.adapi.log(
-            f"PING - {self.mqtt_base_topic}/{fromhost}/{tohost}/pong - {payload} [myhostname: {self.myhostname}]",
-            level="DEBUG",
+        self.log.debug(
+            "PING - %s/%s/%s/pong - %.80s [myhostname: %s]",
+            self.mqtt_base_topic,
+            fromhost,
+            tohost,
+            payload,
+            self.myhostname,
         )
-        self.mqtt.mqtt_publish(
-            topic=f"{self.mqtt_base_topic}/{self.myhostname}/{fromhost}/pong",
+        # Answer on the namespace the ping came in on, so the sender measures that path
+        self.publish(
+            fromhost,
+            "pong",
             payload=payload,
-            namespace="mqtt",
+            namespace=self.dispatcher.current_namespace,
         )
 
     def cb_pong(self, fromhost, tohost, event, entity, payload, payload_asobj=None):
-        self.adapi.log(
-            f"PONG - {self.mqtt_base_topic}/{fromhost}/{tohost}/pong - {payload}",
-            level="DEBUG",
+        self.log.debug(
+            "PONG - %s/%s/%s/pong - %.80s",
+            self.mqtt_base_topic,
+            fromhost,
+            tohost,
+            payload,
         )
-        key = f"{fromhost}--{payload}"
-        if key in self.pong_callbacks:
-            self.adapi.log(f"pong_callback found", level="DEBUG")
-            self.pong_callbacks[key]()  # success_cb
-            del self.pong_callbacks[key]
+        if isinstance(payload_asobj, dict) and "probe" in payload_asobj:
+            self.transport.probe_answered(payload_asobj["probe"])
+            return
+        # pop() - the timeout may be firing at the same time, on another thread
+        success_cb = self.pong_callbacks.pop(f"{fromhost}--{payload}", None)
+        if success_cb:
+            self.log.debug("pong_callback found")
+            success_cb()
         else:
             pass  # already timed out
 
+    def probe_paths(self, kwargs):
+        """
+        mqtt_shared/seattle/all/ping {"probe": 17} - on each namespace
+        """
+        self.transport.expire_probes()
+        for namespace in self.transport.namespaces:
+            probe_id = self.transport.probe_sent(namespace)
+            self.publish(
+                "all",
+                "ping",
+                payload=json.dumps({"probe": probe_id}),
+                namespace=namespace,
+            )
+
     def register_ping_service(self, kwargs):
         """
         Register a service that allows you to call ping/pong
@@ -83,9 +116,12 @@ class PluginPingPong(Plugin):
         def callback_ping_service(
             namespace: str, service: str, action: str, kwargs
         ) -> None:
-            self.adapi.log(
-                f"callback_ping_service(namespace={namespace}, service={service}, action={action}, kwargs={kwargs})",
-                level="DEBUG",
+            self.log.debug(
+                "callback_ping_service(namespace=%s, service=%s, action=%s, kwargs=%.80s)",
+                namespace,
+                service,
+                action,
+                kwargs,
             )
 
             # Check args
@@ -111,26 +147,20 @@ class PluginPingPong(Plugin):
 
             # Send PING
             payload = dt.datetime.now().isoformat()
-            self.mqtt.mqtt_publish(
-                topic=f"{self.mqtt_base_topic}/{self.myhostname}/{tohost}/ping",
-                payload=payload,
-                namespace="mqtt",
-            )
+            self.publish(tohost, "ping", payload=payload)
 
             # Optional: Wait for Pong
             if timeout is not None:
                 key = f"{tohost}--{payload}"
-                if key in self.pong_callbacks:
+                if self.pong_callbacks.setdefault(key, success_cb) is not success_cb:
                     raise RuntimeError(
                         f"pong callback key collision. Programming error?"
                     )
-                self.pong_callbacks[key] = success_cb
 
                 def run_timout(kwargs):
-                    self.adapi.log(f"PONG TIMEOUT - {key}", level="DEBUG")
-                    if key in self.pong_callbacks:
+                    self.log.debug("PONG TIMEOUT - %s", key)
+                    if self.pong_callbacks.pop(key, None):
                         timeout_cb()
-                        del self.pong_callbacks[key]
                     else:
                         pass  # already run since it didn't timeout
 
@@ -140,10 +170,7 @@ class PluginPingPong(Plugin):
 
         hass.register_service("sync_entities_via_mqtt/ping", callback_ping_service)
 
-        self.adapi.log(
-            "register_service: sync_entities_via_mqtt -- ping",
-            level="DEBUG",
-        )
+        self.log.debug("register_service: sync_entities_via_mqtt -- ping")
 
     def test_ping_pong_service(self, kwargs):
         self.adapi.log(f"##test_ping_pong_service(): Test Ping/Pong Service")
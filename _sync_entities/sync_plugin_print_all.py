@@ -5,6 +5,11 @@ from _sync_entities.sync_plugin import Plugin
 
 
 class PluginPrintAll(Plugin):
+    """
+    Logs every message. For development - in production, use the recent_messages ring
+    (sync_entities_via_mqtt/dump_recent_messages) instead.
+    """
+
     def initialize(self):
         self.dispatcher.add_listener(
             "print_all",
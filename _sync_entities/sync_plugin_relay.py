@@ -0,0 +1,87 @@
+from _sync_entities.sync_aliases import TOKEN_PREFIX
+from _sync_entities.sync_lanes import INTERACTIVE, topic_event_type
+from _sync_entities.sync_plugin import Plugin
+from _sync_entities.sync_relay import DOWN, UP, RelayRouter
+
+# pylint: disable=unused-argument
+
+
+class PluginRelay(Plugin):
+    """
+    Relays between this instance's group (mqtt_base_topic) and relay_upstream_topic.
+    See sync_relay.
+
+    Enable by adding "relay" to plugins, on one instance per group.
+    """
+
+    def initialize(self):
+        upstream = self.argsn.get("relay_upstream_topic")
+        if not upstream or upstream == self.mqtt_base_topic:
+            raise ValueError(
+                "PluginRelay - relay_upstream_topic must be set, and differ from mqtt_base_topic"
+            )
+        self.base_topics = {DOWN: self.mqtt_base_topic, UP: upstream}
+        # Upstream may be another broker. Default: the same namespaces as the group.
+        self.upstream_namespace = self.argsn.get("relay_upstream_namespace")
+        namespaces = {
+            DOWN: self.transport.namespaces,
+            UP: (
+                [self.upstream_namespace]
+                if self.upstream_namespace
+                else self.transport.namespaces
+            ),
+        }
+        self.router = RelayRouter(self.myhostname)
+
+        for (side, base_topic) in self.base_topics.items():
+            for namespace in namespaces[side]:
+                if side == UP:
+                    # (The app subscribes to the group's base topic)
+                    self.mqtt.mqtt_subscribe(f"{base_topic}/#", namespace=namespace)
+                self.mqtt.listen_event(
+                    self._side_listener(side, namespace),
+                    "MQTT_MESSAGE",
+                    wildcard=f"{base_topic}/#",
+                    namespace=namespace,
+                )
+        self.adapi.run_every(self.log_stats, "now+300", 300)
+
+    def _side_listener(self, side: str, namespace: str):
+        def side_listener(event, data, kwargs):
+            self.on_message(side, namespace, data.get("topic"), data.get("payload"))
+
+        return side_listener
+
+    def on_message(self, side: str, namespace: str, topic, payload):
+        prefix = f"{self.base_topics[side]}/"
+        if not topic or not topic.startswith(prefix):
+            return
+        if not self.transport.accept(namespace, topic, payload):
+            return  # Already arrived on another namespace
+        rest = topic[len(prefix) :]
+        target = self.router.route(side, rest, payload)
+        if target is None:
+            return
+
+        forwarded = f"{self.base_topics[target]}/{rest}"
+        event_type = topic_event_type(forwarded)
+        self.transport.publish(
+            forwarded,
+            payload,
+            namespace=self.upstream_namespace if target == UP else None,
+            event_type=event_type,
+            # An aliased event type could be a command - never coalesce it
+            lane=INTERACTIVE if event_type.startswith(TOKEN_PREFIX) else None,
+            compress=False,  # Already as the sender sent it
+        )
+
+    def log_stats(self, kwargs):
+        router = self.router
+        self.log.info(
+            "PluginRelay - members: %s, up: %s, down: %s, not forwarded: %s, echoes: %s",
+            sorted(router.members),
+            router.forwarded[UP],
+            router.forwarded[DOWN],
+            router.dropped,
+            router.echoes,
+        )
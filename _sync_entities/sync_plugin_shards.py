@@ -0,0 +1,88 @@
+import json
+import time
+
+from _sync_entities.sync_lanes import INTERACTIVE
+from _sync_entities.sync_plugin import Plugin
+
+# pylint: disable=unused-argument
+
+
+class PluginShards(Plugin):
+    """
+    Finds the other instances of this site, and keeps the shard ring up to date. See sync_shards.
+
+    Enable by setting instance_id, and adding "shards" to plugins, on every instance of the site.
+    """
+
+    def initialize(self):
+        self.ring = self.transport.shards
+        if self.ring is None:
+            raise ValueError("PluginShards - instance_id must be set")
+        self.seconds = self.argsn.get("shard_heartbeat_seconds", 10)
+        # Our own site's topic, so the app's dispatcher drops it (fromhost is us) - we listen here
+        host = self.myhostname
+        self.topic = f"{self.mqtt_base_topic}/{host}/{host}/shards"
+        for namespace in self.transport.namespaces:
+            self.mqtt.listen_event(
+                self.cb_announcement,
+                "MQTT_MESSAGE",
+                wildcard=self.topic,
+                namespace=namespace,
+            )
+        self.ring.on_change(self.log_members)
+
+        self.adapi.run_in(self.announce, 0, hello=True)
+        self.adapi.run_every(self.heartbeat, f"now+{self.seconds}", self.seconds)
+
+    def announce(self, kwargs):
+        message = {"id": self.ring.instance_id, "seconds": self.seconds}
+        for key in ("hello", "leaving"):
+            if kwargs.get(key):
+                message[key] = True
+        self.transport.publish(
+            self.topic,
+            json.dumps(message),
+            event_type="shards",
+            lane=INTERACTIVE,
+            compress=False,  # Only this site reads it
+        )
+
+    def heartbeat(self, kwargs):
+        self.ring.expire(time.monotonic())
+        self.announce({})
+
+    def cb_announcement(self, event, data, kwargs):
+        if data.get("topic") != self.topic:
+            return
+        payload = data.get("payload")
+        try:
+            message = json.loads(payload)
+            instance_id = message["id"]
+        except (TypeError, ValueError, KeyError):
+            self.log.warning_ratelimited(
+                "shards_bad", "PluginShards - bad announcement: %.80s", payload
+            )
+            return
+        if instance_id == self.ring.instance_id:
+            return  # Our own, echoed back
+        if message.get("leaving"):
+            self.ring.leave(instance_id)
+            return
+        self.ring.heard(
+            instance_id, time.monotonic(), message.get("seconds") or self.seconds
+        )
+        if message.get("hello"):
+            # It has just started - tell it about us now, not at our next heartbeat
+            self.announce({})
+
+    def log_members(self):
+        self.log.info(
+            "PluginShards - %s: instances %s, rebalance %s",
+            self.ring.instance_id,
+            self.ring.members,
+            self.ring.rebalances,
+        )
+
+    def terminate(self):
+        # Hand our share over now, rather than after 3 missed heartbeats
+        self.announce({"leaving": True})
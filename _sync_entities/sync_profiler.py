@@ -0,0 +1,229 @@
+import cProfile
+import json
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from typing import Callable, Dict, List, Optional, Tuple
+
+# pylint: disable=unused-argument
+
+
+"""
+On-demand profiling of a running app - for when dispatch gets slow in production, without a
+restart or code changes. Started by the sync_entities_via_mqtt/profile service, for N seconds:
+
+    mode "sample" (default) - every interval, the stacks of all threads that are in this app's
+        code (mq_listener, the dispatcher, plugin callbacks - AppDaemon's own frames above them
+        are dropped) are counted. Low overhead. Written as collapsed stacks, one per line:
+
+            mq_listener (sync_entities_via_mqtt.py:512);_receive (...);submit (sync_lanes.py:88) 17
+
+        Feed to flamegraph.pl or speedscope.
+
+    mode "cprofile" - deterministic: every call under mq_listener and the dispatcher, with
+        cProfile. Slower, and one message at a time (one cProfile at a time - concurrent ones run
+        unprofiled). Written as pstats:  python -m pstats <path>.pstats
+
+Both also time each dispatcher listener (calls, total, mean, max), written to <path>.summary.json.
+
+    session = ProfileSession(SAMPLE, interval=0.01)
+    session.start()
+    ...
+    session.stop()
+    session.write("/tmp/sync_profile")
+        # --> ["/tmp/sync_profile.collapsed", "/tmp/sync_profile.summary.json"]
+"""
+
+SAMPLE = "sample"
+CPROFILE = "cprofile"
+MODES = (SAMPLE, CPROFILE)
+
+_PACKAGE_DIR = os.path.dirname(os.path.abspath(__file__))
+_APP_FILE = "sync_entities_via_mqtt.py"
+
+
+def in_scope(filename: str) -> bool:
+    """
+    This app's code - the _sync_entities package, and the app module.
+    """
+    return filename.startswith(_PACKAGE_DIR) or os.path.basename(filename) == _APP_FILE
+
+
+def _label(frame) -> str:
+    code = frame.f_code
+    filename = os.path.basename(code.co_filename)
+    return f"{code.co_name} ({filename}:{code.co_firstlineno})"
+
+
+def scoped_stack(frame, max_depth: int = 64) -> Optional[Tuple[str, ...]]:
+    """
+    Root first, from this app's outermost frame down to the leaf (library calls included).
+    None if the thread is not in this app's code.
+    """
+    frames = []
+    outermost = None
+    while frame is not None and len(frames) < max_depth:
+        if in_scope(frame.f_code.co_filename):
+            outermost = len(frames)
+        frames.append(frame)
+        frame = frame.f_back
+    if outermost is None:
+        return None
+    return tuple(_label(frame) for frame in reversed(frames[: outermost + 1]))
+
+
+class ListenerTimes:
+    """
+    Per dispatcher listener: calls, total, max.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._times: Dict[str, List[float]] = {}  # name -> [calls, total, max]
+
+    def record(self, name: str, seconds: float):
+        with self._lock:
+            times = self._times.get(name)
+            if times is None:
+                times = self._times[name] = [0, 0.0, 0.0]
+            times[0] += 1
+            times[1] += seconds
+            times[2] = max(times[2], seconds)
+
+    def summary(self) -> List[dict]:
+        """
+        Most total time first.
+        """
+        with self._lock:
+            rows = [
+                {
+                    "listener": name,
+                    "calls": calls,
+                    "total_ms": round(total * 1000, 3),
+                    "mean_ms": round(total / calls * 1000, 3),
+                    "max_ms": round(most * 1000, 3),
+                }
+                for (name, (calls, total, most)) in self._times.items()
+            ]
+        return sorted(rows, key=lambda row: row["total_ms"], reverse=True)
+
+
+class ProfileSession:
+    def __init__(self, mode: str = SAMPLE, interval: float = 0.01, max_depth: int = 64):
+        if mode not in MODES:
+            raise ValueError(f"ProfileSession - mode must be one of {MODES}: {mode}")
+        self.mode = mode
+        self.interval = interval
+        self.max_depth = max_depth
+        self.listeners = ListenerTimes()
+        self.samples = 0  # Sampling rounds
+        self.started: Optional[float] = None  # monotonic
+        self.stopped: Optional[float] = None
+
+        self._stacks: "Counter[Tuple[str, ...]]" = Counter()
+        self._stop = threading.Event()
+        self._sampler: Optional[threading.Thread] = None
+        self._profile: Optional[cProfile.Profile] = None
+        self._profile_lock = threading.Lock()  # One cProfile call at a time
+
+    @property
+    def active(self) -> bool:
+        return self.started is not None and self.stopped is None
+
+    def start(self):
+        self.started = time.monotonic()
+        if self.mode == SAMPLE:
+            self._sampler = threading.Thread(
+                target=self._sample_loop, name="sync_profiler", daemon=True
+            )
+            self._sampler.start()
+        else:
+            self._profile = cProfile.Profile()
+
+    def stop(self):
+        if not self.active:
+            return
+        self.stopped = time.monotonic()
+        self._stop.set()
+        if self._sampler is not None:
+            self._sampler.join()
+        # A cProfile call still running finishes on its own - its lock is not ours to wait on
+
+    #
+    # Sampling
+    #
+    def _sample_loop(self):
+        me = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            for (thread_id, frame) in sys._current_frames().items():
+                if thread_id == me:
+                    continue
+                stack = scoped_stack(frame, self.max_depth)
+                if stack:
+                    self._stacks[stack] += 1
+            self.samples += 1
+
+    def collapsed(self) -> List[str]:
+        """
+        "root;...;leaf count" - most samples first.
+        """
+        stacks = self._stacks.most_common()
+        return [f"{';'.join(stack)} {count}" for (stack, count) in stacks]
+
+    #
+    # Deterministic, and listener times
+    #
+    def run(self, function: Callable, *args):
+        """
+        Calls function(*args) - under cProfile, in cprofile mode, if no other call is.
+        """
+        profile = self._profile
+        if profile is None or not self.active or not self._profile_lock.acquire(False):
+            return function(*args)
+        try:
+            return profile.runcall(function, *args)
+        finally:
+            self._profile_lock.release()
+
+    def timed(self, name: str, function: Callable) -> Callable:
+        def timed_function(*args):
+            started = time.perf_counter()
+            try:
+                return self.run(function, *args)
+            finally:
+                self.listeners.record(name, time.perf_counter() - started)
+
+        return timed_function
+
+    #
+    # Results
+    #
+    def summary(self) -> dict:
+        end = self.stopped if self.stopped is not None else time.monotonic()
+        return {
+            "mode": self.mode,
+            "seconds": round(end - self.started, 3) if self.started else 0,
+            "interval": self.interval if self.mode == SAMPLE else None,
+            "samples": self.samples if self.mode == SAMPLE else None,
+            "listeners": self.listeners.summary(),
+        }
+
+    def write(self, path: str) -> List[str]:
+        """
+        path - without extension. Returns the files written.
+        """
+        files = []
+        if self.mode == SAMPLE:
+            files.append(f"{path}.collapsed")
+            with open(files[-1], "w", encoding="utf-8") as file:
+                file.writelines(f"{line}\n" for line in self.collapsed())
+        else:
+            files.append(f"{path}.pstats")
+            with self._profile_lock:
+                self._profile.dump_stats(files[-1])
+        files.append(f"{path}.summary.json")
+        with open(files[-1], "w", encoding="utf-8") as file:
+            json.dump(self.summary(), file, indent=1)
+        return files
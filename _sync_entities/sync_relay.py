@@ -0,0 +1,113 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional, Set, Tuple
+
+# pylint: disable=unused-argument
+
+
+"""
+Relays - for many sites. Sites are split into groups, each with its own base topic, and one
+instance per group relays between the group and the next level up:
+
+    seattle, tacoma -- mqtt_west -- relay "west" -- mqtt_shared -- relay "east" -- mqtt_east -- haven
+
+A group's sites only see their group's traffic, plus what is for them (or for "all") from
+elsewhere - not every other site's pings, acks, replies and commands. Relays can be stacked:
+a relay's upstream can be another relay's group.
+
+Messages are forwarded unchanged (topic after the base, payload), so fromhost and tohost do
+the routing:
+
+    from the group (down):  tohost "all", or a host that is not in the group --> up
+                            tohost in the group --> stays in the group
+    from upstream (up):     tohost "all", or a host in the group --> down
+                            anything else --> dropped (it is for another group)
+
+The group's hosts (members) are learned from what they publish. A forwarded message comes
+back to the relay from the side it was published on (the broker echoes it) - that echo is
+recognised and not forwarded again.
+
+Bulk messages (state, ...) are forwarded through the bulk lane, so repeated updates of an
+entity are coalesced and sent a batch at a time. See sync_lanes.
+"""
+
+UP = "up"
+DOWN = "down"
+
+_OTHER_SIDE = {UP: DOWN, DOWN: UP}
+
+
+def split_hosts(rest: str) -> Tuple[Optional[str], Optional[str]]:
+    """
+    "haven/all/state/light.office" (the topic after the base) --> ("haven", "all")
+    """
+    parts = rest.split("/", 2)
+    if len(parts) < 3:
+        return (None, None)
+    return (parts[0], parts[1])
+
+
+class RelayRouter:
+    def __init__(self, myhostname: str, echo_ttl: float = 30):
+        self.myhostname = myhostname
+        self.echo_ttl = echo_ttl
+        # Hosts that publish in my group (me included), and hosts heard from upstream
+        self.members: Set[str] = {myhostname}
+        self.remotes: Set[str] = set()
+        self.forwarded = {UP: 0, DOWN: 0}
+        self.dropped = 0
+        self.echoes = 0
+
+        # (side it was published to, hash((rest, payload))) -> expires (monotonic)
+        self._echoes: "OrderedDict[Tuple[str, int], float]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _is_echo(self, side: str, key: int, now: float) -> bool:
+        with self._lock:
+            echoes = self._echoes
+            while echoes:
+                (oldest, expires) = next(iter(echoes.items()))
+                if expires > now:
+                    break
+                del echoes[oldest]
+            # pop - a real repeat of the same message, later, is forwarded again
+            return echoes.pop((side, key), None) is not None
+
+    def _expect_echo(self, side: str, key: int, now: float):
+        with self._lock:
+            self._echoes.pop((side, key), None)  # Keep in expiry order
+            self._echoes[(side, key)] = now + self.echo_ttl
+
+    def route(self, side: str, rest: str, payload) -> Optional[str]:
+        """
+        A message arrived on side (UP or DOWN). rest - its topic after the base.
+        Returns the side to forward it to, or None.
+        """
+        (fromhost, tohost) = split_hosts(rest)
+        if fromhost is None:
+            return None
+        now = time.monotonic()
+        key = hash((rest, payload))
+        if self._is_echo(side, key, now):
+            self.echoes += 1
+            return None
+
+        if side == DOWN:
+            if fromhost in self.remotes:
+                return None  # An upstream host's message, whose echo we missed
+            self.members.add(fromhost)
+            forward = tohost == "all" or tohost not in self.members
+        else:
+            if fromhost in self.members:
+                return None  # One of ours, come back around (eg: via another relay)
+            self.remotes.add(fromhost)
+            forward = tohost == "all" or tohost in self.members
+
+        if not forward:
+            self.dropped += 1
+            return None
+        target = _OTHER_SIDE[side]
+        self._expect_echo(target, key, now)
+        self.forwarded[target] += 1
+        return target
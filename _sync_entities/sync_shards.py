@@ -0,0 +1,180 @@
+import bisect
+import threading
+import zlib
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from _sync_entities.sync_concurrency import partition_key
+
+# pylint: disable=unused-argument
+
+
+"""
+Shards - several instances of the app share one site's work. Each instance owns a share of
+the entities, by consistent hashing, so an instance joining or leaving only moves ~1/N of them.
+
+    SyncEntitiesViaMqtt_a:  myhostname: haven, instance_id: a, plugins: [..., shards]
+    SyncEntitiesViaMqtt_b:  myhostname: haven, instance_id: b, plugins: [..., shards]
+
+An entity's key is its partition key (see sync_concurrency) - "<host>/<entity>":
+
+    haven/light.office   - our light.office: published by its owner only
+    seattle/light.den    - seattle's light.den: its mirror is set by its owner only
+
+Inbound, the transport drops what this instance does not own (accept()), before any queueing or
+dispatch. Which instance handles a message:
+
+    with an entity                  its owner (by the key above)
+    ping, bulk_event                one instance, by the topic - so one pong, one set of actions
+    ack, pong                       every instance - the one that sent the command / ping uses it
+    the rest (send_state, ...)      every instance - each answers with its share
+
+Membership: each instance announces itself every shard_heartbeat_seconds, to its own site:
+
+    mqtt_shared/haven/haven/shards {"id": "a", "seconds": 10}
+    mqtt_shared/haven/haven/shards {"id": "a", "seconds": 10, "hello": true}    - starting. Answer.
+    mqtt_shared/haven/haven/shards {"id": "a", "leaving": true}                 - stopping
+
+An instance not heard from in 3 of its intervals is gone. On any change the ring is rebuilt,
+and the on_change() callbacks rebalance (eg: PluginInboundState listens to its new share).
+"""
+
+# Handled by one instance, though they have no entity
+ONE_INSTANCE_EVENT_TYPES = frozenset({"ping", "bulk_event"})
+# Handled by every instance, though they have an entity
+EVERY_INSTANCE_EVENT_TYPES = frozenset({"ack", "pong"})
+
+# Points on the ring per instance - enough for an even split between a few instances
+VNODES = 64
+
+
+def _point(key: str) -> int:
+    # crc32, not hash() - it has to be the same in every process
+    return zlib.crc32(key.encode("utf-8"))
+
+
+class ShardRing:
+    """
+    Which instance of this site owns what.
+
+        ring = ShardRing("haven", "a")
+        ring.heard("b", now, seconds=10)   # --> True: membership changed, the ring rebalanced
+        ring.owns_entity("light.office")   # --> True / False - ours to publish
+        ring.owns_topic("mqtt_shared/seattle/haven/state/light.den")
+    """
+
+    def __init__(self, myhostname: str, instance_id: str, vnodes: int = VNODES):
+        self.myhostname = myhostname
+        self.instance_id = instance_id
+        self.vnodes = vnodes
+        self.not_ours = 0  # Inbound messages left to the other instances
+        self.rebalances = 0
+
+        self._lock = threading.Lock()
+        self._expires: Dict[str, float] = {}  # Other instances -> when they are gone
+        self._ring: Tuple[List[int], List[str]] = ([], [])  # (points, owners), sorted
+        self._listeners: List[Callable[[], None]] = []
+        self._build()
+
+    @property
+    def members(self) -> Tuple[str, ...]:
+        with self._lock:
+            return self._members()
+
+    def _members(self) -> Tuple[str, ...]:
+        # With self._lock held
+        return tuple(sorted([self.instance_id, *self._expires]))
+
+    def _build(self):
+        # With self._lock held
+        ring = sorted(
+            (_point(f"{member}#{index}"), member)
+            for member in self._members()
+            for index in range(self.vnodes)
+        )
+        # One assignment, so a lookup on another thread sees one ring or the other
+        self._ring = ([point for (point, _) in ring], [member for (_, member) in ring])
+
+    #
+    # Ownership
+    #
+    def owner(self, key: str) -> str:
+        (points, owners) = self._ring
+        index = bisect.bisect(points, _point(key))
+        return owners[index % len(owners)]
+
+    def owns(self, key: str) -> bool:
+        return not self._expires or self.owner(key) == self.instance_id
+
+    def owns_entity(self, entity: str) -> bool:
+        """
+        One of our state_for_entities.
+        """
+        return self.owns(f"{self.myhostname}/{entity}")
+
+    def owned_entities(self, entities: Iterable[str]) -> List[str]:
+        return [entity for entity in entities if self.owns_entity(entity)]
+
+    def owns_topic(self, topic: Optional[str]) -> bool:
+        """
+        Is an inbound message this instance's to handle?
+        """
+        if not self._expires or not topic:
+            return True
+        parts = topic.split("/", 4)
+        if len(parts) < 4 or parts[3] in EVERY_INSTANCE_EVENT_TYPES:
+            return True
+        if len(parts) < 5 and parts[3] not in ONE_INSTANCE_EVENT_TYPES:
+            return True
+        if self.owner(partition_key(topic)) == self.instance_id:
+            return True
+        self.not_ours += 1
+        return False
+
+    #
+    # Membership
+    #
+    def on_change(self, callback: Callable[[], None]):
+        self._listeners.append(callback)
+
+    def heard(self, instance_id: str, now: float, seconds: float) -> bool:
+        """
+        An announcement from instance_id. True if it is new (the ring was rebalanced).
+        """
+        if instance_id == self.instance_id:
+            return False
+        with self._lock:
+            joined = instance_id not in self._expires
+            self._expires[instance_id] = now + 3 * seconds
+            if joined:
+                self._build()
+        if joined:
+            self._changed()
+        return joined
+
+    def leave(self, instance_id: str) -> bool:
+        with self._lock:
+            left = self._expires.pop(instance_id, None) is not None
+            if left:
+                self._build()
+        if left:
+            self._changed()
+        return left
+
+    def expire(self, now: float) -> List[str]:
+        """
+        Drops the instances not heard from in time. Returns them.
+        """
+        with self._lock:
+            gone = [member for (member, at) in self._expires.items() if at <= now]
+            for member in gone:
+                del self._expires[member]
+            if gone:
+                self._build()
+        if gone:
+            self._changed()
+        return gone
+
+    def _changed(self):
+        self.rebalances += 1
+        for callback in list(self._listeners):
+            callback()
@@ -0,0 +1,98 @@
+import threading
+from typing import Any, Dict, Iterable, Optional
+
+from _sync_entities.sync_log import SyncLogger
+from appdaemon.adapi import ADAPI
+
+# pylint: disable=unused-argument
+
+
+"""
+Local cache of Hass entity states, for the inbound command path.
+
+    states = StateCache(adapi)
+    states.exists("light.office")   # Hass lookup the first time, then from the cache
+    states.get("light.office")      # --> "on"
+
+The first lookup of an entity reads through to Hass (get_state) and registers a listen_state()
+for it. From then on the cached state is kept current by Hass's state change events, and
+lookups cost nothing.
+
+Entities that do not exist are not cached - each lookup asks Hass again (they might be created).
+"""
+
+
+class StateCache:
+    def __init__(self, adapi: ADAPI, log: Optional[SyncLogger] = None):
+        self.adapi = adapi
+        self.log = log if log else SyncLogger(adapi)
+
+        self._states: Dict[str, Any] = {}  # entity -> state
+        self._handles: Dict[str, Any] = {}  # entity -> listen_state handle
+        self._handles_lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __contains__(self, entity: str):
+        return entity in self._states
+
+    def get(self, entity: str) -> Optional[Any]:
+        """
+        None if the entity does not exist.
+        """
+        if entity in self._states:
+            self.hits += 1
+            return self._states[entity]
+        self.misses += 1
+        state = self.adapi.get_state(entity_id=entity)
+        if state is not None:
+            self._remember(entity, state)
+        return state
+
+    def exists(self, entity: str) -> bool:
+        return self.get(entity) is not None
+
+    def get_many(self, entities: Iterable[str]) -> Dict[str, Any]:
+        """
+        {entity: state} for the entities that exist.
+        Any misses are filled with a single get_state() of everything, not one call each.
+        """
+        entities = list(entities)
+        missing = [entity for entity in entities if entity not in self._states]
+        self.hits += len(entities) - len(missing)
+        if missing:
+            self.misses += len(missing)
+            all_states = self.adapi.get_state()
+            for entity in missing:
+                if entity in all_states:
+                    self._remember(entity, all_states[entity].get("state"))
+        return {
+            entity: self._states[entity]
+            for entity in entities
+            if entity in self._states
+        }
+
+    def invalidate(self, entity: Optional[str] = None):
+        """
+        Forget one entity (or everything). The listen_state()s stay - they are cheap.
+        """
+        if entity is None:
+            self._states.clear()
+        else:
+            self._states.pop(entity, None)
+
+    def _remember(self, entity: str, state):
+        self._states[entity] = state
+        if entity in self._handles:
+            return
+        with self._handles_lock:
+            # Two threads may miss on the same entity - listen only once
+            if entity not in self._handles:
+                self._handles[entity] = self.adapi.listen_state(self._cb_state, entity)
+
+    def _cb_state(self, entity, attribute, old, new, kwargs):
+        if new is None:
+            # Removed from Hass
+            self._states.pop(entity, None)
+        else:
+            self._states[entity] = new
@@ -0,0 +1,110 @@
+import math
+import threading
+from typing import Dict, Hashable, List, Set
+
+# pylint: disable=unused-argument
+
+
+"""
+Hashed timer wheel - many deadlines, cheap to push back, cheap to expire.
+
+    wheel = TimerWheel(slot_seconds=1, slots=64)
+    wheel.schedule("haven", ttl=180, now=now)   # (again) - pushes the deadline back
+    wheel.advance(now)                           # --> ["haven"] once 180s pass without a schedule()
+
+Each key sits in the bucket for its deadline tick. advance() only looks at the buckets for
+the ticks that passed, so the cost per tick does not depend on how many keys there are.
+
+Pushing a deadline back (the common case - a key that keeps getting refreshed) does not move
+the key. It just records the new deadline; when the old bucket comes due, the key is moved
+to the right bucket then.
+
+Thread safe - schedule() / cancel() / advance() take one lock.
+"""
+
+
+class TimerWheel:
+    def __init__(self, slot_seconds: float = 1.0, slots: int = 64):
+        self.slot_seconds = slot_seconds
+        self._slots: List[Set[Hashable]] = [set() for _ in range(slots)]
+        self._deadlines: Dict[Hashable, float] = {}  # key -> deadline
+        self._bucket_ticks: Dict[Hashable, int] = {}  # key -> tick of its bucket
+        self._tick = None  # Last tick processed
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._deadlines)
+
+    def __contains__(self, key):
+        return key in self._deadlines
+
+    def _tick_for(self, when: float) -> int:
+        return math.ceil(when / self.slot_seconds)
+
+    def _insert(self, key: Hashable, tick: int):
+        if self._tick is not None and tick <= self._tick:
+            tick = self._tick + 1
+        self._bucket_ticks[key] = tick
+        self._slots[tick % len(self._slots)].add(key)
+
+    def schedule(self, key: Hashable, ttl: float, now: float):
+        with self._lock:
+            self._schedule(key, ttl, now)
+
+    def _schedule(self, key: Hashable, ttl: float, now: float):
+        if self._tick is None:
+            self._tick = math.floor(now / self.slot_seconds)
+        deadline = now + ttl
+        self._deadlines[key] = deadline
+        tick = self._tick_for(deadline)
+        bucket_tick = self._bucket_ticks.get(key)
+        if bucket_tick is None or tick < bucket_tick:
+            # New, or the deadline moved *earlier*. (Later is handled lazily in advance.)
+            self._insert(key, tick)
+
+    def cancel(self, key: Hashable):
+        # The bucket entry is dropped when its tick comes around
+        with self._lock:
+            self._deadlines.pop(key, None)
+            self._bucket_ticks.pop(key, None)
+
+    def deadline(self, key: Hashable):
+        return self._deadlines.get(key)
+
+    def advance(self, now: float) -> List[Hashable]:
+        """
+        Returns the keys whose deadline is <= now. They are removed from the wheel.
+        """
+        with self._lock:
+            return self._advance(now)
+
+    def _advance(self, now: float) -> List[Hashable]:
+        if self._tick is None:
+            self._tick = math.floor(now / self.slot_seconds)
+            return []
+
+        expired = []
+        slots = len(self._slots)
+        # After a long pause, catch up at most one lap per call
+        # Bucket for tick t holds deadlines in ((t-1)*slot_seconds, t*slot_seconds]
+        target = min(math.floor(now / self.slot_seconds), self._tick + slots)
+        for tick in range(self._tick + 1, target + 1):
+            self._tick = tick
+            bucket = self._slots[tick % slots]
+            for key in list(bucket):
+                bucket_tick = self._bucket_ticks.get(key)
+                if bucket_tick is None or bucket_tick % slots != tick % slots:
+                    bucket.discard(key)  # Cancelled, or moved to an earlier bucket
+                    continue
+                deadline = self._deadlines[key]
+                if deadline <= now:
+                    bucket.discard(key)
+                    del self._deadlines[key]
+                    del self._bucket_ticks[key]
+                    expired.append(key)
+                elif bucket_tick <= tick:
+                    # Deadline was pushed back - move it to the right bucket
+                    bucket.discard(key)
+                    self._insert(key, self._tick_for(deadline))
+                # else: due in a later lap of the wheel
+        return expired
@@ -0,0 +1,221 @@
+import os
+import struct
+import threading
+import time
+from dataclasses import dataclass
+from typing import Any, Callable, Iterable, Iterator, List, Optional
+
+# pylint: disable=unused-argument
+
+
+"""
+Traffic capture and replay.
+
+Record every inbound message to a compact binary trace (trace_file in the .yaml):
+
+    trace = TraceWriter("/conf/apps/sync_entities.trace", max_bytes=16 * 2**20, backups=3)
+    trace.write(namespace, topic, payload)
+
+Files rotate like logs: sync_entities.trace --> .trace.1 --> .trace.2 ... (oldest dropped).
+
+Replay it, at recorded speed (1), N times faster (N), or as fast as possible (0):
+
+    replay = TraceReplay(read_trace(path), handler, speed=10)
+    replay.run()                  # Blocking - eg: an offline benchmark
+    replay.step(time.monotonic()) # Or non-blocking: handles what is due, True when done
+
+handler(TraceRecord). In the app, the sync_entities_via_mqtt/replay service feeds a trace
+through the same path as live messages (lanes, dispatcher, plugins) - on a test instance!
+
+Format: b"SETRACE1", then per message:
+    <d time.time()> <H len(namespace)> <H len(topic)> <I len(payload), 0xFFFFFFFF = None>
+    namespace topic payload (utf-8)
+A truncated last record (eg: a crash mid-write) is ignored by read_trace().
+"""
+
+MAGIC = b"SETRACE1"
+_HEADER = struct.Struct("<dHHI")
+_NO_PAYLOAD = 0xFFFFFFFF
+
+
+@dataclass
+class TraceRecord:
+    timestamp: float  # time.time()
+    namespace: str
+    topic: str
+    payload: Optional[str]
+
+
+def _encode(value: Optional[str]) -> bytes:
+    return value.encode("utf-8") if value is not None else b""
+
+
+class TraceWriter:
+    def __init__(self, path: str, max_bytes: int = 16 * 2**20, backups: int = 3):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.written = 0
+        self._lock = threading.Lock()
+        self._file = None
+        self._open()
+
+    def _open(self):
+        self._file = open(self.path, "ab")
+        if self._file.tell() == 0:
+            self._file.write(MAGIC)
+
+    def write(
+        self, namespace: str, topic: str, payload, timestamp: Optional[float] = None
+    ):
+        if payload is not None and not isinstance(payload, str):
+            payload = str(payload)
+        namespace_bytes = _encode(namespace)
+        topic_bytes = _encode(topic)
+        payload_bytes = _encode(payload)
+        record = (
+            _HEADER.pack(
+                time.time() if timestamp is None else timestamp,
+                len(namespace_bytes),
+                len(topic_bytes),
+                _NO_PAYLOAD if payload is None else len(payload_bytes),
+            )
+            + namespace_bytes
+            + topic_bytes
+            + payload_bytes
+        )
+        with self._lock:
+            if self._file is None:
+                return  # Closed
+            if self._file.tell() + len(record) > self.max_bytes:
+                self._rotate()
+            self._file.write(record)
+            self.written += 1
+
+    def _rotate(self):
+        # With self._lock held
+        self._file.close()
+        for index in range(self.backups - 1, 0, -1):
+            older = f"{self.path}.{index}"
+            if os.path.exists(older):
+                os.replace(older, f"{self.path}.{index + 1}")
+        if self.backups:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+        self._open()
+
+    def flush(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.flush()
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+def trace_files(path: str) -> List[str]:
+    """
+    The trace and its rotated backups, oldest first - the order to replay them in.
+    """
+    files = []
+    index = 1
+    while os.path.exists(f"{path}.{index}"):
+        files.insert(0, f"{path}.{index}")
+        index += 1
+    if os.path.exists(path):
+        files.append(path)
+    return files
+
+
+def read_trace(path: str) -> Iterator[TraceRecord]:
+    with open(path, "rb") as file:
+        if file.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"Not a sync_entities trace: {path}")
+        while True:
+            header = file.read(_HEADER.size)
+            if len(header) < _HEADER.size:
+                return
+            (timestamp, namespace_len, topic_len, payload_len) = _HEADER.unpack(header)
+            body_len = namespace_len + topic_len
+            if payload_len != _NO_PAYLOAD:
+                body_len += payload_len
+            body = file.read(body_len)
+            if len(body) < body_len:
+                return  # Truncated
+            namespace = body[:namespace_len].decode("utf-8")
+            topic = body[namespace_len : namespace_len + topic_len].decode("utf-8")
+            payload = None
+            if payload_len != _NO_PAYLOAD:
+                payload = body[namespace_len + topic_len :].decode("utf-8")
+            yield TraceRecord(timestamp, namespace, topic, payload)
+
+
+class TraceReplay:
+    """
+    speed - 1 = as recorded, 10 = 10x faster, 0 = as fast as possible
+    batch - most records handled per step() (so a step never runs for long)
+    """
+
+    def __init__(
+        self,
+        records: Iterable[TraceRecord],
+        handler: Callable[[TraceRecord], Any],
+        speed: float = 1.0,
+        batch: int = 500,
+    ):
+        self.handler = handler
+        self.speed = speed
+        self.batch = batch
+        self.handled = 0
+        self.busy_seconds = 0.0  # Spent in handler
+        self.started_at: Optional[float] = None  # monotonic
+
+        self._records = iter(records)
+        self._next: Optional[TraceRecord] = next(self._records, None)
+        self._first_timestamp = self._next.timestamp if self._next else None
+
+    @property
+    def done(self) -> bool:
+        return self._next is None
+
+    def wait(self, now: float) -> float:
+        """
+        Seconds until the next record is due (0 = now).
+        """
+        if self._next is None or not self.speed or self.started_at is None:
+            return 0
+        due = (
+            self.started_at
+            + (self._next.timestamp - self._first_timestamp) / self.speed
+        )
+        return max(0.0, due - now)
+
+    def step(self, now: float) -> bool:
+        """
+        Handles the records that are due at now (monotonic). Returns True when done.
+        """
+        if self.started_at is None:
+            self.started_at = now
+        began = time.perf_counter()
+        for _ in range(self.batch):
+            if self._next is None or self.wait(now) > 0:
+                break
+            self.handler(self._next)
+            self.handled += 1
+            self._next = next(self._records, None)
+        self.busy_seconds += time.perf_counter() - began
+        return self._next is None
+
+    def run(self, sleep: Callable[[float], Any] = time.sleep):
+        while not self.step(time.monotonic()):
+            sleep(self.wait(time.monotonic()))
+
+    def rate(self) -> float:
+        """
+        Messages handled per second of handler time - the throughput, at any speed.
+        """
+        return self.handled / max(self.busy_seconds, 1e-9)
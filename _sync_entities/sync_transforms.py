@@ -0,0 +1,168 @@
+import fnmatch
+import time
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Tuple
+
+# pylint: disable=unused-argument
+
+
+"""
+Outbound state transforms - publish less, for entities that change a lot but say little.
+
+    state_transforms:
+      sensor.house_power:          # entity id, or a pattern: sensor.*_power
+        round: 0                   # decimals
+        deadband: 25               # publish only if it moved at least this much since the last publish
+        min_interval: 10           # seconds - at most one publish per 10s (the latest value wins)
+        attributes: [unit_of_measurement, friendly_name]   # also send these attributes
+
+The first matching entry applies: exact entity ids first, then patterns in the order listed.
+
+Without `attributes`, the payload is the (transformed) state, as always. With `attributes`, it is:
+
+    {"state": "1234", "attributes": {"unit_of_measurement": "W"}}
+
+Remote sites need a version that understands that form before you configure `attributes`.
+
+A full resend (send_state) applies round and attributes, but not deadband / min_interval -
+the remote wants the current value.
+"""
+
+
+def _as_float(value) -> Optional[float]:
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+@dataclass
+class StateTransform:
+    round: Optional[int] = None
+    deadband: Optional[float] = None
+    min_interval: Optional[float] = None
+    attributes: Optional[List[str]] = None
+
+    def shape(self, value) -> Tuple[Any, Optional[dict]]:
+        """
+        value - a state, or (if attributes are configured) get_state(attribute="all"):
+            {"state": "1234.56", "attributes": {...}}
+
+        Returns: (state, projected attributes or None)
+        """
+        attributes = None
+        if isinstance(value, dict):
+            state = value.get("state")
+            if self.attributes is not None:
+                all_attributes = value.get("attributes") or {}
+                attributes = {
+                    key: all_attributes[key]
+                    for key in self.attributes
+                    if key in all_attributes
+                }
+        else:
+            state = value
+
+        if self.round is not None:
+            number = _as_float(state)
+            if number is not None:
+                state = str(round(number, self.round) if self.round else round(number))
+        return (state, attributes)
+
+
+class StateTransforms:
+    def __init__(self, config: Optional[Dict[str, dict]] = None):
+        self._exact: Dict[str, StateTransform] = {}
+        self._patterns: List[Tuple[str, StateTransform]] = []
+        for key, options in (config or {}).items():
+            transform = StateTransform(**options)
+            if any(char in key for char in "*?["):
+                self._patterns.append((key, transform))
+            else:
+                self._exact[key] = transform
+
+        self._resolved: Dict[str, Optional[StateTransform]] = {}  # entity -> transform
+        # entity -> (state, attributes, state as float, monotonic time) of the last publish
+        self._published: Dict[str, tuple] = {}
+
+    def __bool__(self):
+        return bool(self._exact or self._patterns)
+
+    def transform_for(self, entity: str) -> Optional[StateTransform]:
+        if entity not in self._resolved:
+            transform = self._exact.get(entity)
+            if transform is None:
+                transform = next(
+                    (t for (p, t) in self._patterns if fnmatch.fnmatchcase(entity, p)),
+                    None,
+                )
+            self._resolved[entity] = transform
+        return self._resolved[entity]
+
+    def wants_attributes(self, entity: str) -> bool:
+        transform = self.transform_for(entity)
+        return transform is not None and transform.attributes is not None
+
+    def shape(self, entity: str, value) -> Tuple[Any, Optional[dict]]:
+        transform = self.transform_for(entity)
+        if transform is None:
+            return (value, None)
+        return transform.shape(value)
+
+    def check(
+        self,
+        entity: str,
+        state,
+        attributes: Optional[dict] = None,
+        now: Optional[float] = None,
+    ) -> Optional[float]:
+        """
+        Should this (already shaped) state be published?
+            None - no (unchanged, or within the deadband)
+            0 - yes, now
+            > 0 - yes, but not for this many seconds (min_interval)
+        """
+        transform = self.transform_for(entity)
+        last = self._published.get(entity)
+        if transform is None or last is None:
+            return 0
+        (last_state, last_attributes, last_number, last_time) = last
+
+        if attributes == last_attributes:  # (A projected attribute change always goes out)
+            number = _as_float(state)
+            if (
+                transform.deadband is not None
+                and number is not None
+                and last_number is not None
+            ):
+                if abs(number - last_number) < transform.deadband:
+                    return None
+            elif state == last_state:
+                return None
+
+        if transform.min_interval:
+            now = time.monotonic() if now is None else now
+            wait = last_time + transform.min_interval - now
+            if wait > 0:
+                return wait
+        return 0
+
+    def published(
+        self,
+        entity: str,
+        state,
+        attributes: Optional[dict] = None,
+        now: Optional[float] = None,
+    ):
+        self._published[entity] = (
+            state,
+            attributes,
+            _as_float(state),
+            time.monotonic() if now is None else now,
+        )
+
+    def forget(self, entity: str):
+        """
+        The next state of entity is published, whatever the last one was.
+        """
+        self._published.pop(entity, None)
@@ -0,0 +1,265 @@
+import itertools
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+from _sync_entities.sync_aliases import TopicAliases
+from _sync_entities.sync_lanes import BULK, LaneConfig, Lanes
+from _sync_entities.sync_log import SyncLogger
+from _sync_entities.sync_pacing import AimdPacer
+from _sync_entities.sync_shards import ShardRing
+from appdaemon.plugins.mqtt.mqttapi import Mqtt as mqttapi
+
+# pylint: disable=unused-argument
+
+
+"""
+MQTT transport - one or more paths (AppDaemon mqtt namespaces, each its own broker / bridge).
+
+    mqtt_namespaces: [mqtt, mqtt_lan]
+
+Publishing goes out on the *active* path only. Health per path comes from probe pings
+(see PluginPingPong.probe_paths):
+
+    mqtt_shared/seattle/all/ping {"probe": 17}      - published on one namespace
+    mqtt_shared/haven/seattle/pong {"probe": 17}    - answered on the namespace it arrived on
+
+    rtt  - moving average of probe round trips
+    loss - moving average of unanswered probes (0 = none lost, 1 = all lost)
+
+The active path is the one with the best score (rtt, penalised by loss). It only changes if
+another path is clearly better, or the active one stops answering - so it does not flap.
+
+Inbound: the same message can arrive on more than one path (eg: both brokers bridge to the cloud).
+accept() drops a message if the identical topic + payload arrived on a *different* path within
+dedup_seconds. Repeats on the same path are left alone - they are real repeats.
+
+Topic aliases: if set (see PluginAliases), topics are compressed on the way out, and must be
+expanded (expand()) on the way in. See sync_aliases.
+
+Outbound priority: with a LaneConfig, bulk event types (state, ...) are queued and published a
+batch at a time, while commands and pings go out immediately. See sync_lanes.
+
+Pacing: with an AimdPacer, the bulk lane goes out at an adaptive rate, fed back from publish
+latency and probes. See sync_pacing.
+
+Shards: with a ShardRing, accept() also drops what another instance of this site owns.
+See sync_shards.
+"""
+
+# Moving average weight for new samples
+EWMA_ALPHA = 0.3
+# Switch only if the other path's score is below this fraction of the active one's
+SWITCH_RATIO = 0.8
+# At or above this loss, a path is considered down
+DEAD_LOSS = 0.9
+
+
+@dataclass
+class PathHealth:
+    namespace: str
+    rtt: Optional[float] = None  # seconds
+    loss: float = 0.0
+    probes_sent: int = 0
+    probes_answered: int = 0
+
+    @property
+    def score(self) -> float:
+        """
+        Lower is better.
+        """
+        if self.loss >= DEAD_LOSS:
+            return float("inf")
+        if self.rtt is None:
+            # Never answered: dead if we've tried, else unknown (worse than any measured path)
+            return float("inf") if self.probes_sent else 1e6
+        return self.rtt * (1 + 10 * self.loss)
+
+
+def _ewma(old: Optional[float], sample: float) -> float:
+    return sample if old is None else old + EWMA_ALPHA * (sample - old)
+
+
+class Transport:
+    def __init__(
+        self,
+        mqtt: mqttapi,
+        namespaces: List[str],
+        log: SyncLogger,
+        dedup_seconds: float = 5,
+        probe_timeout: float = 30,
+        lanes: Optional[LaneConfig] = None,
+        pacer: Optional[AimdPacer] = None,
+        shards: Optional[ShardRing] = None,
+    ):
+        if not namespaces:
+            raise ValueError("Transport - need at least one mqtt namespace")
+        self.mqtt = mqtt
+        self.log = log
+        self.dedup_seconds = dedup_seconds
+        self.probe_timeout = probe_timeout
+
+        self.paths: Dict[str, PathHealth] = {
+            namespace: PathHealth(namespace) for namespace in namespaces
+        }
+        self.active = namespaces[0]
+        self.duplicates = 0
+        self.lane_config = lanes
+        # mqtt is the app, so it has run_in()
+        self.pacer = pacer
+        self.outbound = Lanes(mqtt, self._send, lanes, log, pacer) if lanes else None
+        self.aliases: Optional[TopicAliases] = None
+        self.shards = shards
+
+        self._probe_ids = itertools.count(1)
+        self._probes: Dict[int, Tuple[str, float]] = {}  # id -> (namespace, sent_at)
+        # hash((topic, payload)) -> (namespace, expires)
+        self._seen: "OrderedDict[int, Tuple[str, float]]" = OrderedDict()
+        self._seen_lock = threading.Lock()
+
+    @property
+    def namespaces(self) -> List[str]:
+        return list(self.paths)
+
+    def publish(
+        self,
+        topic: str,
+        payload,
+        namespace: Optional[str] = None,
+        event_type: Optional[str] = None,
+        lane: Optional[str] = None,
+        compress: bool = True,
+    ):
+        """
+        namespace - force a path (eg: answering a probe). Default: the active path.
+        event_type - picks the lane (and its QoS)
+        lane - force a lane instead
+        compress - False for a topic that is already as sent (eg: relayed - see sync_relay)
+        """
+        if self.aliases and compress:
+            topic = self.aliases.compress(topic)
+        if not self.lane_config:
+            self._send((topic, payload, namespace, 0))
+            return
+        lane = lane or self.lane_config.lane_for(event_type)
+        item = (topic, payload, namespace, self.lane_config.qos_for(lane))
+        if lane == BULK:
+            key = self.lane_config.coalesce_key(event_type, (namespace, topic))
+            self.outbound.submit(BULK, key, item)
+        else:
+            self._send(item)
+
+    def _send(self, item: Tuple[str, object, Optional[str], int]):
+        (topic, payload, namespace, qos) = item
+        # The active path is looked up at send time - a queued message follows a failover
+        started = time.monotonic()
+        try:
+            self.mqtt.mqtt_publish(
+                topic=topic,
+                payload=payload,
+                namespace=namespace or self.active,
+                qos=qos,
+            )
+        except Exception:
+            if self.pacer:
+                self.pacer.on_failure(time.monotonic())
+            raise
+        if self.pacer:
+            now = time.monotonic()
+            self.pacer.sent(1, now)
+            self.pacer.on_publish(now - started, now)
+
+    #
+    # Health
+    #
+    def probe_sent(self, namespace: str) -> int:
+        probe_id = next(self._probe_ids)
+        self._probes[probe_id] = (namespace, time.monotonic())
+        self.paths[namespace].probes_sent += 1
+        return probe_id
+
+    def probe_answered(self, probe_id: int) -> bool:
+        """
+        Credits the path the probe was sent on. False if unknown (timed out, or already answered).
+        """
+        probe = self._probes.pop(probe_id, None)
+        if probe is None:
+            return False
+        namespace, sent_at = probe
+        path = self.paths[namespace]
+        path.probes_answered += 1
+        rtt = time.monotonic() - sent_at
+        path.rtt = _ewma(path.rtt, rtt)
+        if self.pacer:
+            self.pacer.on_rtt(rtt, time.monotonic())
+        path.loss = _ewma(path.loss, 0.0)
+        self._select()
+        return True
+
+    def expire_probes(self):
+        """
+        Probes unanswered after probe_timeout count as lost.
+        """
+        now = time.monotonic()
+        for probe_id, (namespace, sent_at) in list(self._probes.items()):
+            # pop() - a pong may be answering it right now, on another thread
+            if now - sent_at >= self.probe_timeout and self._probes.pop(probe_id, None):
+                path = self.paths[namespace]
+                path.loss = _ewma(path.loss, 1.0)
+                if self.pacer:
+                    self.pacer.on_loss(now)
+        self._select()
+
+    def _select(self):
+        active = self.paths[self.active]
+        best = min(self.paths.values(), key=lambda path: path.score)
+        if best is active or best.score == float("inf"):
+            return
+        if active.score == float("inf") or best.score < active.score * SWITCH_RATIO:
+            self.log.warning(
+                "Transport - switching from %s (rtt: %s, loss: %.2f) to %s (rtt: %s, loss: %.2f)",
+                active.namespace,
+                active.rtt,
+                active.loss,
+                best.namespace,
+                best.rtt,
+                best.loss,
+            )
+            self.active = best.namespace
+
+    #
+    # Inbound
+    #
+    def expand(self, topic: Optional[str]) -> Optional[str]:
+        """
+        Undo topic aliases. None if it can't be (yet).
+        """
+        return self.aliases.expand(topic) if self.aliases else topic
+
+    def accept(self, namespace: str, topic: str, payload) -> bool:
+        """
+        False if this message already arrived on a different path, or is another instance's.
+        """
+        if self.shards is not None and not self.shards.owns_topic(topic):
+            return False
+        if len(self.paths) == 1:
+            return True
+        now = time.monotonic()
+        key = hash((topic, payload))
+        with self._seen_lock:
+            seen = self._seen
+            while seen:
+                oldest, (_, expires) = next(iter(seen.items()))
+                if expires > now:
+                    break
+                del seen[oldest]
+
+            previous = seen.get(key)
+            if previous is not None and previous[0] != namespace:
+                self.duplicates += 1
+                return False
+            seen.pop(key, None)  # Keep seen in expiry order
+            seen[key] = (namespace, now + self.dedup_seconds)
+        return True
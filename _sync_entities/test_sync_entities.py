@@ -1,8 +1,52 @@
+import os
+import pstats
+import tempfile
+import threading
+import time
+
+from _sync_entities.sync_aliases import TopicAliases
+from _sync_entities.sync_commands import CommandTracker
+from _sync_entities.sync_concurrency import Partitions, StripedLock, partition_key
+from _sync_entities.sync_digest import BucketDigest, bucket_for
 from _sync_entities.sync_dispatcher import (
     EventListenerDispatcher,
     EventParts,
     EventPattern,
 )
+from _sync_entities.sync_domain_handlers import (
+    HassAction,
+    group_hass_actions,
+    resolve_hass_action,
+    split_command,
+)
+from _sync_entities.sync_history import HistoryAggregator, HistoryStore, aggregate
+from _sync_entities.sync_lanes import BULK, INTERACTIVE, LaneConfig, Lanes
+from _sync_entities.sync_log import SyncLogger
+from _sync_entities.sync_loop_guard import (
+    Envelope,
+    LoopGuard,
+    unwrap_payload,
+    wrap_payload,
+)
+from _sync_entities.sync_message_ring import MessageRing
+from _sync_entities.sync_mirror_registry import MirrorRegistry, state_digest
+from _sync_entities.sync_mirror_store import MirrorStore
+from _sync_entities.sync_pacing import AimdPacer
+from _sync_entities.sync_plugin import PLUGIN_REGISTRY, Plugin, load_plugin
+from _sync_entities.sync_profiler import CPROFILE, SAMPLE, ProfileSession
+from _sync_entities.sync_relay import DOWN, UP, RelayRouter
+from _sync_entities.sync_shards import ShardRing
+from _sync_entities.sync_state_cache import StateCache
+from _sync_entities.sync_timer_wheel import TimerWheel
+from _sync_entities.sync_trace import (
+    TraceRecord,
+    TraceReplay,
+    TraceWriter,
+    read_trace,
+    trace_files,
+)
+from _sync_entities.sync_transforms import StateTransforms
+from _sync_entities.sync_transport import Transport
 from appdaemon.plugins.mqtt import mqttapi as mqtt
 
 # pylint: disable=unused-argument,use-implicit-booleaness-not-comparison
@@ -25,6 +69,29 @@ class TestSyncEntitiesViaMqtt(mqtt.Mqtt):
         self.run_in(self.test_event_parts, 0)
         self.run_in(self.test_dispatcher, 0.1)
         self.run_in(self.test_plugin_ping_pong, 0.2)
+        self.run_in(self.test_loop_guard, 0.3)
+        self.run_in(self.test_command_tracker, 0.4)
+        self.run_in(self.test_group_hass_actions, 0.5)
+        self.run_in(self.test_sync_logger, 0.6)
+        self.run_in(self.test_mirror_store, 0.7)
+        self.run_in(self.test_mirror_registry, 0.75)
+        self.run_in(self.test_timer_wheel, 0.8)
+        self.run_in(self.test_transport, 0.9)
+        self.run_in(self.test_lanes, 1.0)
+        self.run_in(self.test_state_cache, 1.1)
+        self.run_in(self.test_state_transforms, 1.2)
+        self.run_in(self.test_listener_registry, 1.3)
+        self.run_in(self.test_partitions, 1.4)
+        self.run_in(self.test_bucket_digest, 1.5)
+        self.run_in(self.test_trace, 1.6)
+        self.run_in(self.test_topic_aliases, 1.7)
+        self.run_in(self.test_relay_router, 1.8)
+        self.run_in(self.test_history, 1.9)
+        self.run_in(self.test_pacing, 2.0)
+        self.run_in(self.test_message_ring, 2.1)
+        self.run_in(self.test_shard_ring, 2.2)
+        self.run_in(self.test_profiler, 2.3)
+        self.run_in(self.test_load_plugin, 2.4)
 
     def test_event_parts(self, _):
         adapi = self.get_ad_api()
@@ -169,6 +236,725 @@ class TestSyncEntitiesViaMqtt(mqtt.Mqtt):
 
         self.log("**test_dispatcher() - all pass!**")
 
+    def test_listener_registry(self, _):
+        adapi = self.get_ad_api()
+        dispatcher = EventListenerDispatcher(adapi, "mqtt_shared")
+
+        def callback_for(name):
+            def callback(fromhost, tohost, event_type, entity, payload, payload_asobj):
+                return name
+
+            return callback
+
+        state_pattern = EventPattern(pattern_event_type="state")
+        dispatcher.add_listener("state", state_pattern, callback_for("state"))
+        dispatcher.add_listener("ping", EventPattern(pattern_event_type="ping"), None)
+        not_ping_pattern = EventPattern(pattern_event_type="!ping")
+        dispatcher.add_listener("not_ping", not_ping_pattern, callback_for("not_ping"))
+        topic = "mqtt_shared/haven/seattle/state/light.office"
+        assert dispatcher.dispatch(topic, "on") == ["state", "not_ping"]
+
+        # Re-registering replaces (in place), it does not pile up
+        dispatcher.add_listener("state", state_pattern, callback_for("state2"))
+        assert dispatcher.dispatch(topic, "on") == ["state2", "not_ping"]
+
+        # Routing index - only candidates for the event type
+        snapshot = dispatcher._listeners.snapshot()
+        assert [l.name for l in snapshot.candidates("state")] == ["state", "not_ping"]
+        assert [l.name for l in snapshot.candidates("ping")] == ["ping", "not_ping"]
+        assert [l.name for l in snapshot.candidates("other")] == ["not_ping"]
+        assert dispatcher._listeners.snapshot() is snapshot  # Unchanged --> not rebuilt
+
+        dispatcher.remove_listener("not_ping")
+        assert dispatcher.dispatch(topic, "on") == ["state2"]
+        assert dispatcher._listeners.snapshot() is not snapshot
+
+        # Changing listeners during a dispatch: that message keeps the listeners it started with
+        def remover(fromhost, tohost, event_type, entity, payload, payload_asobj):
+            dispatcher.remove_listener("state")
+            dispatcher.add_listener("late", state_pattern, callback_for("late"))
+            return "remover"
+
+        dispatcher.replace_listener("remover", state_pattern, remover)
+        assert dispatcher.dispatch(topic, "on") == ["state2", "remover"]
+        assert dispatcher.dispatch(topic, "on") == ["remover", "late"]
+
+        self.log("**test_listener_registry() - all pass!**")
+
+    def test_partitions(self, _):
+        topic = "mqtt_shared/haven/seattle/state/light.x"
+        assert partition_key(topic) == "haven/light.x"
+        topic = "mqtt_shared/haven/all/state/light.x"
+        assert partition_key(topic) == "haven/light.x"  # Same partition
+        topic = "mqtt_shared/haven/all/ping"
+        assert partition_key(topic) == topic
+
+        locks = StripedLock(4)
+        assert locks.for_key("light.x") is locks.for_key("light.x")
+
+        # Many threads, interleaved keys: each key's items are handled in order, one at a time
+        handled = {}
+        active = set()
+        overlaps = []
+
+        def handler(item):
+            (key, i) = item
+            if key in active:
+                overlaps.append(key)
+            active.add(key)
+            time.sleep(0.0001)
+            handled.setdefault(key, []).append(i)
+            active.discard(key)
+            if i == 3:
+                raise ValueError("A bad message must not stall its partition")
+
+        # 8 keys in 4 partitions - each partition gets items from two producer threads
+        partitions = Partitions(handler, count=4)
+
+        def producer(keys):
+            for i in range(200):
+                for key in keys:
+                    partitions.submit(key, (key, i))
+
+        threads = [
+            threading.Thread(target=producer, args=(keys,))
+            for keys in ("ab", "cd", "ef", "gh")
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert partitions.pending() == 0
+        assert not overlaps
+        for key in "abcdefgh":
+            assert handled[key] == list(range(200)), key
+
+        self.log("**test_partitions() - all pass!**")
+
+    def test_bucket_digest(self, _):
+        states = {f"sensor.s{i}": str(i) for i in range(200)}
+        publisher = BucketDigest(16)
+        for (entity, state) in states.items():
+            publisher.set(entity, "old")
+            publisher.set(entity, state)  # Replaces "old"
+        assert len(publisher) == 200
+
+        # Same content, any order --> same digest
+        mirror = BucketDigest.of(reversed(list(states.items())), 16)
+        assert mirror.diff(publisher.buckets()) == []
+
+        # A lost message, and a mirror the publisher no longer has
+        mirror.set("sensor.s7", "stale")
+        mirror.set("sensor.gone", "on")
+        differ = mirror.diff(publisher.buckets())
+        expected = {bucket_for("sensor.s7", 16), bucket_for("sensor.gone", 16)}
+        assert set(differ) == expected
+
+        publisher.remove("sensor.s8")
+        publisher.set("sensor.s8", states["sensor.s8"])
+        mirror.set("sensor.s7", "7")
+        mirror.remove("sensor.gone")
+        assert mirror.diff(publisher.buckets()) == []
+
+        # The owner has no such entity: it hashes None, its mirror got an empty payload
+        publisher.set("sensor.missing", None)
+        mirror.set("sensor.missing", "")
+        assert mirror.diff(publisher.buckets()) == []
+        assert state_digest(None) == state_digest("")
+
+        assert mirror.diff([0] * 8) is None  # Different bucket count
+        assert mirror.diff("bogus") is None
+
+        self.log("**test_bucket_digest() - all pass!**")
+
+    def test_trace(self, _):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "sync.trace")
+            trace = TraceWriter(path, max_bytes=200, backups=2)
+            for i in range(10):
+                topic = f"mqtt_shared/haven/all/state/s.{i}"
+                trace.write("mqtt", topic, str(i), timestamp=100 + i)
+            trace.write("mqtt_lan", "mqtt_shared/haven/all/send_state", None, 110)
+            trace.close()
+
+            # Rotated, oldest dropped
+            files = trace_files(path)
+            assert files == [f"{path}.2", f"{path}.1", path]
+            records = [record for file in files for record in read_trace(file)]
+            assert records[-1] == TraceRecord(
+                110, "mqtt_lan", "mqtt_shared/haven/all/send_state", None
+            )
+            assert [record.payload for record in records[:-1]] == [
+                str(i) for i in range(10 - len(records) + 1, 10)
+            ]
+
+            # A truncated last record is ignored
+            with open(path, "ab") as file:
+                file.write(b"\x00\x01")
+            assert list(read_trace(path))[-1].topic.endswith("send_state")
+
+        # Replay: all at once (speed 0), or on the recorded schedule, 10x faster
+        records = [TraceRecord(100 + i, "mqtt", f"t/{i}", None) for i in range(5)]
+        handled = []
+        replay = TraceReplay(records, handled.append, speed=0)
+        assert replay.step(now=50)
+        assert handled == records
+
+        handled = []
+        replay = TraceReplay(records, handled.append, speed=10)
+        assert not replay.step(now=50)  # The first one is due right away
+        assert len(handled) == 1
+        assert abs(replay.wait(now=50) - 0.1) < 1e-9
+        assert not replay.step(now=50.25)
+        assert len(handled) == 3
+        assert replay.step(now=50.4)
+        assert handled == records and replay.done
+
+        self.log("**test_trace() - all pass!**")
+
+    def test_topic_aliases(self, _):
+        seattle = TopicAliases("seattle")
+        unknown = []
+        haven = TopicAliases("haven", on_unknown=unknown.append)
+        topic = "mqtt_shared/seattle/haven/state/input_select.home_mode"
+
+        # Not acked yet - full topic. (The names get numbered, though.)
+        assert seattle.compress(topic) == topic
+        assert seattle.dirty
+
+        # haven learns the list and acks it
+        count = haven.learn("seattle", seattle.table())
+        assert count == 2
+        assert seattle.acked("haven", seattle.table()["epoch"], count)
+        short = seattle.compress(topic)
+        assert short == "mqtt_shared/seattle/haven/~0/~1"
+        assert haven.expand(short) == topic
+
+        # Negotiation messages are never aliased
+        hello = "mqtt_shared/seattle/haven/aliases"
+        assert seattle.compress(hello) == hello
+
+        # "all": only once every recently heard from peer has acked
+        to_all = "mqtt_shared/seattle/all/state/input_select.home_mode"
+        assert seattle.compress(to_all) == to_all  # No peers heard from
+        seattle.expand("mqtt_shared/haven/seattle/ping")
+        assert seattle.compress(to_all) == "mqtt_shared/seattle/all/~0/~1"
+        seattle.expand("mqtt_shared/cabin/all/state/light.x")  # Never acks
+        assert seattle.compress(to_all) == to_all
+
+        # A restarted peer has lost the list
+        seattle.forget_peer("haven")
+        assert seattle.compress(topic) == topic
+        restarted = TopicAliases("haven", on_unknown=unknown.append)
+        assert restarted.expand(short) is None
+        assert unknown == ["seattle"]
+
+        # An ack for a list from before my restart is ignored
+        assert not seattle.acked("haven", 12345, 2)
+
+        self.log("**test_topic_aliases() - all pass!**")
+
+    def test_relay_router(self, _):
+        router = RelayRouter("west")
+
+        # From the group, for everyone: up. Its echo from upstream is not sent back down.
+        assert router.route(DOWN, "seattle/all/state/light.office", "on") == UP
+        assert router.route(UP, "seattle/all/state/light.office", "on") is None
+        assert router.echoes == 1
+        # A real repeat, later, goes up again
+        assert router.route(DOWN, "seattle/all/state/light.office", "on") == UP
+
+        # Between two sites of the group: stays in the group
+        assert router.route(DOWN, "tacoma/all/heartbeat", "1") == UP
+        assert router.route(DOWN, "seattle/tacoma/ping", "{}") is None
+
+        # From upstream: for everyone, or for the group - down. For another group - dropped.
+        assert router.route(UP, "haven/all/state/light.porch", "off") == DOWN
+        assert router.route(DOWN, "haven/all/state/light.porch", "off") is None  # Echo
+        assert router.route(UP, "haven/seattle/pong", "{}") == DOWN
+        assert router.route(UP, "haven/cabin/ping", "{}") is None
+        # ... and the group may address hosts outside it
+        assert router.route(DOWN, "seattle/haven/event/light.porch", "on") == UP
+
+        # One of ours, come back around from upstream
+        assert router.route(UP, "seattle/haven/event/light.x", "on") is None
+        assert router.members == {"west", "seattle", "tacoma"}
+        assert router.remotes == {"haven"}
+        assert router.forwarded == {UP: 4, DOWN: 2}
+
+        self.log("**test_relay_router() - all pass!**")
+
+    def test_history(self, _):
+        # Time weighted: 10 for 150s, 20 for 150s. Then a gap, then 5 - carried into the next bucket.
+        samples = [(0, 10.0), (150, 20.0), (300, None), (400, 5.0)]
+        assert aggregate(samples, 300, 0, 900) == [
+            (0, 10.0, 20.0, 15.0),
+            (300, 5.0, 5.0, 5.0),
+            (600, 5.0, 5.0, 5.0),
+        ]
+
+        history = HistoryAggregator(interval=300, keep=4)
+        history.add("sensor.power", "100", 10)
+        history.add("sensor.power", "unavailable", 160)
+        history.add("sensor.power", "300", 250)
+        assert history.close(299) == {}  # Not complete yet
+        assert history.close(305) == {"sensor.power": [(0, 100.0, 300.0, 150.0)]}
+        assert history.close(1000) == {
+            "sensor.power": [(300, 300.0, 300.0, 300.0), (600, 300.0, 300.0, 300.0)]
+        }
+        assert len(history.buckets("sensor.power", since=300)) == 2
+
+        # Rebuilt from the recorder: only keep buckets, and the open one is left open
+        history.backfill("sensor.temp", [(-5000, "20"), (950, "22")], now=1000)
+        assert [bucket[0] for bucket in history.buckets("sensor.temp", -1e9)] == [
+            -300,
+            0,
+            300,
+            600,
+        ]
+        # 20 for 50s, then 22
+        assert history.close(1200)["sensor.temp"] == [(900, 20.0, 22.0, 21.6667)]
+
+        store = HistoryStore()
+        store.put("sensor.sensor_power_xxhavenxx", [(0, 1.0, 2.0, 1.5), (300, 2, 2, 2)])
+        store.put("sensor.sensor_power_xxhavenxx", [(300, 2, 4, 3)])  # Upsert
+        assert store.series("sensor.sensor_power_xxhavenxx", 300) == [(300, 2, 4, 3)]
+        store.put("sensor.sensor_power_xxseattlexx", [(0, 5, 5, 5)])
+        assert store.newest() == {
+            "sensor.sensor_power_xxhavenxx": 300,
+            "sensor.sensor_power_xxseattlexx": 0,
+        }
+        assert store.prune(300) == 2
+        assert store.entities() == ["sensor.sensor_power_xxhavenxx"]
+        store.close()
+
+        self.log("**test_history() - all pass!**")
+
+    def test_pacing(self, _):
+        pacer = AimdPacer(rate=10, min_rate=2, max_rate=12, increase=1, decrease=0.5)
+        assert pacer.allowance(0) == 5  # Half a second's burst
+        pacer.sent(5, 0)
+        assert pacer.allowance(0) == 0 and pacer.delay(0) == 0.1
+        pacer.sent(2, 0)  # Interactive - does not wait, but bulk waits longer
+        assert round(pacer.delay(0), 3) == 0.3
+        assert pacer.allowance(1.0) == 5  # Refilled, up to the burst
+
+        # Additive increase: once a second, while backlogged, up to max_rate
+        pacer.backlogged(1.0)
+        pacer.backlogged(1.5)
+        assert pacer.rate == 11
+        pacer.backlogged(2.0)
+        pacer.backlogged(3.0)
+        assert pacer.rate == 12
+
+        # Multiplicative decrease: a slow publish. Signals from the same burst count once.
+        pacer.on_publish(0.001, 4.0)
+        assert pacer.rate == 12
+        pacer.on_publish(0.5, 4.0)
+        pacer.on_loss(4.2)
+        assert pacer.rate == 6 and pacer.decreases == 1
+        pacer.backlogged(4.5)  # No increase right after a decrease
+        assert pacer.rate == 6
+
+        # Probe round trips: queueing delay well above the best seen
+        pacer.on_rtt(0.05, 6.0)
+        pacer.on_rtt(0.12, 6.0)
+        assert pacer.rate == 6
+        pacer.on_rtt(0.3, 6.0)
+        assert pacer.rate == 3
+        pacer.on_failure(8.0)
+        pacer.on_failure(10.0)
+        assert pacer.rate == 2  # min_rate
+        assert pacer.metrics()["decreases"] == 4
+
+        # In the bulk lane: items go as the tokens allow, then the drain waits for more
+        handled = []
+        drains = []
+
+        class FakeAdapi:
+            def run_in(self, callback, delay, **kwargs):
+                drains.append(delay)
+
+        def send(item):
+            # (As Transport._send does)
+            handled.append(item)
+            pacer.sent(1, time.monotonic())
+
+        pacer = AimdPacer(rate=4, min_rate=1)
+        lanes = Lanes(
+            FakeAdapi(), send, LaneConfig(batch=50), SyncLogger(self.adapi), pacer
+        )
+        for index in range(5):
+            lanes.submit(BULK, index, index)
+        lanes.drain(None)
+        assert handled == [0, 1] and lanes.pending() == 3  # 2 = half a second at 4/s
+        assert 0 < drains[-1] <= 0.25  # Then waits for the next token
+
+        self.log("**test_pacing() - all pass!**")
+
+    def test_message_ring(self, _):
+        ring = MessageRing(3)
+        assert len(ring) == 0 and ring.entries() == []
+        for index in range(5):
+            topic = f"topic/{index}"
+            ring.record(1000.0 + index, 0.001, 0, "mqtt", topic, "on", ("a",))
+        assert len(ring) == 3
+        # Oldest first, the 2 oldest overwritten
+        assert [entry["topic"] for entry in ring.entries()] == [
+            "topic/2",
+            "topic/3",
+            "topic/4",
+        ]
+        assert [entry["topic"] for entry in ring.entries(last=1)] == ["topic/4"]
+        assert "ok      mqtt topic/4 [a] -- on" in ring.lines()[-1]
+
+        # In the dispatcher: outcome and matching listeners, per message
+        def callback(fromhost, tohost, event_type, entity, payload, payload_asobj):
+            if payload == "boom":
+                raise ValueError(payload)
+
+        dispatcher = EventListenerDispatcher(
+            self.get_ad_api(), "mqtt_shared", LoopGuard("seattle")
+        )
+        dispatcher.ring = MessageRing(8)
+        state_pattern = EventPattern(pattern_event_type="state")
+        dispatcher.add_listener("state", state_pattern, callback)
+        dispatcher.dispatch("mqtt_shared/haven/all/state/light.a", "on", "mqtt")
+        dispatcher.dispatch("mqtt_shared/haven/all/bogus", "1", "mqtt")
+        # My own message, echoed back
+        dispatcher.dispatch("mqtt_shared/seattle/all/state/light.a", "on", "mqtt")
+        try:
+            dispatcher.dispatch("mqtt_shared/haven/all/state/light.b", "boom", "mqtt")
+            assert False, "Should have raised"
+        except ValueError:
+            pass
+        entries = dispatcher.ring.entries()
+        assert [entry["outcome"] for entry in entries] == [
+            "ok",
+            "nomatch",
+            "dropped",
+            "error",
+        ]
+        assert entries[0]["listeners"] == ["state"] and entries[2]["listeners"] == []
+        assert entries[3]["payload"] == "boom" and entries[3]["seconds"] >= 0
+
+        self.log("**test_message_ring() - all pass!**")
+
+    def test_shard_ring(self, _):
+        entities = [f"light.l{index}" for index in range(300)]
+        (a, b) = (ShardRing("haven", "a"), ShardRing("haven", "b"))
+        # Alone: everything is ours
+        assert a.owned_entities(entities) == entities
+        assert a.owns_topic("mqtt_shared/seattle/haven/state/light.den")
+
+        changes = []
+        a.on_change(lambda: changes.append(a.members))
+        assert a.heard("b", 0, seconds=10)
+        assert not a.heard("b", 5, seconds=10)  # Already known
+        assert not a.heard("a", 5, seconds=10)  # Our own, echoed
+        assert changes == [("a", "b")]
+        b.heard("a", 0, seconds=10)
+
+        # Each entity has exactly one owner, and the split is roughly even
+        mine = set(a.owned_entities(entities))
+        theirs = set(b.owned_entities(entities))
+        assert not mine & theirs and len(mine | theirs) == len(entities)
+        assert 60 < len(mine) < 240
+        # ... the same in every process (crc32, not hash())
+        assert a.owner("haven/light.l0") == b.owner("haven/light.l0")
+
+        # Inbound: entity messages by owner, ack / pong / send_state to both, ping to one
+        for topic in (
+            "mqtt_shared/seattle/haven/state/light.den",
+            "mqtt_shared/seattle/haven/event/light.office",
+            "mqtt_shared/seattle/haven/ping",
+            "mqtt_shared/seattle/haven/bulk_event",
+        ):
+            assert a.owns_topic(topic) != b.owns_topic(topic), topic
+        for topic in (
+            "mqtt_shared/seattle/haven/ack/light.office",
+            "mqtt_shared/seattle/haven/pong",
+            "mqtt_shared/seattle/all/send_state",
+        ):
+            assert a.owns_topic(topic) and b.owns_topic(topic), topic
+
+        # A third instance joins: only the share it takes moves
+        c = ShardRing("haven", "c")
+        for ring in (a, b):
+            ring.heard("c", 0, seconds=10)
+        for other in ("a", "b"):
+            c.heard(other, 0, seconds=10)
+        taken = set(c.owned_entities(entities))
+        assert taken and set(a.owned_entities(entities)) == mine - taken
+        assert set(b.owned_entities(entities)) == theirs - taken
+
+        # Not heard from in 3 intervals: gone, and its share comes back
+        a.heard("b", 25, seconds=10)
+        assert a.expire(31) == ["c"]
+        assert set(a.owned_entities(entities)) == mine
+        assert a.leave("b") and not a.leave("b")
+        assert a.owned_entities(entities) == entities
+        assert a.rebalances == 4
+
+        self.log("**test_shard_ring() - all pass!**")
+
+    def test_profiler(self, _):
+        def busy_listener(*args):
+            deadline = time.perf_counter() + 0.02
+            while time.perf_counter() < deadline:
+                pass
+
+        directory = tempfile.mkdtemp()
+        dispatcher = EventListenerDispatcher(self.get_ad_api(), MQTT_DEFAULT_BASE_TOPIC)
+        dispatcher.add_listener(
+            "busy", EventPattern(pattern_event_type="state"), busy_listener
+        )
+
+        # Sampling: from another thread, the busy listener's stack is caught
+        session = ProfileSession(SAMPLE, interval=0.002)
+        session.start()
+        dispatcher.profile = session
+        worker = threading.Thread(
+            target=lambda: [
+                dispatcher.dispatch("mqtt_shared/haven/all/state/light.x", "on")
+                for _ in range(5)
+            ]
+        )
+        worker.start()
+        worker.join()
+        dispatcher.profile = None
+        session.stop()
+        assert not session.active and session.samples > 0
+        assert any("busy_listener" in line for line in session.collapsed())
+        # Rooted at this app's code, not at the thread's start
+        roots = [line.split(";")[0] for line in session.collapsed()]
+        assert not any("threading.py" in root for root in roots)
+        [listener] = session.listeners.summary()
+        assert listener["listener"] == "busy" and listener["calls"] == 5
+        assert listener["max_ms"] >= 20
+        files = session.write(os.path.join(directory, "sampled"))
+        assert [os.path.basename(file) for file in files] == [
+            "sampled.collapsed",
+            "sampled.summary.json",
+        ]
+
+        # Deterministic: pstats, with the listener in it
+        session = ProfileSession(CPROFILE)
+        session.start()
+        dispatcher.profile = session
+        session.run(dispatcher.dispatch, "mqtt_shared/haven/all/state/light.x", "on")
+        dispatcher.profile = None
+        session.stop()
+        assert session.run(lambda: 17) == 17  # Stopped: called plainly
+        [pstats_file, _] = session.write(os.path.join(directory, "exact"))
+        stats = pstats.Stats(pstats_file)
+        assert any(name == "busy_listener" for (_, _, name) in stats.stats)
+
+        self.log("**test_profiler() - all pass!**")
+
+    def test_load_plugin(self, _):
+        plugin_class = load_plugin("print_all")
+        assert plugin_class.__name__ == "PluginPrintAll"
+        assert issubclass(plugin_class, Plugin)
+        assert load_plugin("print_all") is plugin_class
+
+        try:
+            load_plugin("no_such_plugin")
+            assert False, "Should have raised"
+        except ValueError as err:
+            assert "no_such_plugin" in str(err) and "print_all" in str(err)
+
+        # Modules are imported on load, not before - a broken entry only hurts if configured
+        PLUGIN_REGISTRY["broken"] = "_sync_entities.no_such_module:PluginBroken"
+        try:
+            assert load_plugin("ping_pong").__name__ == "PluginPingPong"
+            try:
+                load_plugin("broken")
+                assert False, "Should have raised"
+            except ModuleNotFoundError:
+                pass
+        finally:
+            del PLUGIN_REGISTRY["broken"]
+
+        self.log("**test_load_plugin() - all pass!**")
+
+    def test_loop_guard(self, _):
+        assert unwrap_payload("on") == (None, "on")
+        assert unwrap_payload(None) == (None, None)
+        envelope, payload = unwrap_payload(wrap_payload("on", Envelope("haven", 1, 0)))
+        assert envelope == Envelope("haven", 1, 0)
+        assert payload == "on"
+
+        guard = LoopGuard("seattle", tag_outbound=True, max_hops=2)
+
+        # Own messages, echoed back
+        assert not guard.accept("seattle", "all", "state", "light.office", None)
+
+        # Plain payloads
+        assert guard.accept("haven", "all", "state", "light.office", None)
+
+        # Duplicates
+        assert guard.accept("haven", "all", "state", "light.office", envelope)
+        assert not guard.accept("haven", "all", "state", "light.office", envelope)
+
+        # Too many hops
+        assert not guard.accept(
+            "haven", "seattle", "state", "light.den", Envelope("haven", 2, 3)
+        )
+
+        # My own command came back around
+        assert not guard.accept(
+            "haven", "seattle", "event", "light.den", Envelope("seattle", 3, 1)
+        )
+
+        # A user's command about haven's light.office, right after its state arrived, starts a
+        # new chain - and haven accepts it
+        state = Envelope("haven", 4, 0)
+        assert guard.accept("haven", "all", "state", "light.office", state)
+        envelope, payload = unwrap_payload(
+            guard.outbound("haven", "event", "light.office", "off")
+        )
+        assert (envelope.origin, envelope.hops, payload) == ("seattle", 0, "off")
+        haven = LoopGuard("haven", tag_outbound=True)
+        assert haven.accept("seattle", "haven", "event", "light.office", envelope)
+
+        # Published from the state's listener: hops count, but the origin is ours
+        cause = ("state", state)
+        envelope, _ = unwrap_payload(
+            guard.outbound("haven", "event", "light.office", "off", cause)
+        )
+        assert (envelope.origin, envelope.hops) == ("seattle", 1)
+        # ... a state from a state's listener (eg: a relay) keeps its origin
+        envelope, _ = unwrap_payload(
+            guard.outbound("all", "state", "light.office", "on", cause)
+        )
+        assert (envelope.origin, envelope.hops) == ("haven", 1)
+
+        # A command to us: our state for its entity, soon after, is part of its chain
+        command = Envelope("haven", 5, 1)
+        assert guard.accept("haven", "seattle", "event", "light.mine", command)
+        envelope, _ = unwrap_payload(guard.outbound("all", "state", "light.mine", "on"))
+        assert (envelope.origin, envelope.hops) == ("haven", 2)
+
+        # Unrelated messages start a new chain
+        envelope, _ = unwrap_payload(guard.outbound("all", "state", "light.den", "on"))
+        assert (envelope.origin, envelope.hops) == ("seattle", 0)
+
+        # Remembered commands are bounded, and expire
+        small = LoopGuard("seattle", tag_outbound=True, seen_max=2)
+        for index in range(5):
+            command = Envelope("haven", index)
+            small.accept("haven", "seattle", "event", f"light.{index}", command)
+        assert list(small._context) == [("seattle", "light.3"), ("seattle", "light.4")]
+        small = LoopGuard("seattle", tag_outbound=True, context_ttl=0)
+        small.accept("haven", "seattle", "event", "light.5", Envelope("haven", 5))
+        envelope, _ = unwrap_payload(small.outbound("all", "state", "light.5", "on"))
+        assert envelope.origin == "seattle" and not small._context
+
+        self.log("**test_loop_guard() - all pass!**")
+
+    def test_command_tracker(self, _):
+        sent = []
+        results = []
+        tracker = CommandTracker(
+            self.adapi,
+            "seattle",
+            sent.append,
+            timeout=60,
+            max_in_flight=2,
+            on_result=lambda command, ok, detail: results.append(
+                (command.cid, ok, detail)
+            ),
+        )
+
+        cid1 = tracker.submit("haven", "light.a", "on")
+        cid2 = tracker.submit("haven", "light.b", "on")
+        cid3 = tracker.submit("haven", "light.c", "on")  # Waits - window is full
+        cid4 = tracker.submit("cabin", "light.d", "off")  # Different host, goes now
+        assert [command.cid for command in sent] == [cid1, cid2, cid4]
+        assert tracker.in_flight("haven") == 2
+
+        # An ack frees a slot, which sends the waiting command
+        assert tracker.on_ack(cid2, True, "on")
+        assert [command.cid for command in sent] == [cid1, cid2, cid4, cid3]
+
+        # Duplicate acks are ignored
+        assert not tracker.on_ack(cid2, True, "on")
+
+        assert tracker.on_ack(cid1, False, "timeout")
+        assert results == [(cid2, True, "on"), (cid1, False, "timeout")]
+
+        tracker.on_ack(cid3, True, "on")
+        tracker.on_ack(cid4, True, "off")
+        assert tracker.in_flight() == 0
+
+        self.log("**test_command_tracker() - all pass!**")
+
+    def test_group_hass_actions(self, _):
+        groups, failed = group_hass_actions(
+            {
+                "light.a": "off",
+                "switch.c": "on",
+                "light.b": "off",
+                "input_select.mode": "Away",
+                "light.d": "on",
+                "vacuum.x": "on",
+            },
+        )
+        assert [
+            (action.service, action.data, entities) for action, entities in groups
+        ] == [
+            ("light/turn_off", {}, ["light.a", "light.b"]),
+            ("switch/turn_on", {}, ["switch.c"]),
+            ("input_select/select_option", {"option": "Away"}, ["input_select.mode"]),
+            ("light/turn_on", {}, ["light.d"]),
+        ]
+        assert failed == ["vacuum.x"]
+
+        # Domain handlers
+        assert resolve_hass_action("lock.front", "locked") == HassAction(
+            "lock/lock", {}, "locked"
+        )
+        assert resolve_hass_action("cover.garage", "50") == HassAction(
+            "cover/set_cover_position", {"position": 50}, "open"
+        )
+        assert resolve_hass_action(
+            "climate.den", *split_command({"hvac_mode": "heat", "temperature": 20})
+        ) == HassAction(
+            "climate/set_temperature", {"hvac_mode": "heat", "temperature": 20}, "heat"
+        )
+        assert resolve_hass_action(
+            "light.a", *split_command({"state": "on", "brightness": 128, "cid": "x"})
+        ) == HassAction("light/turn_on", {"brightness": 128}, "on")
+        # Only the fields a handler knows are passed on to the service
+        command = {"state": "on", "brightness": 128, "entity_id": "lock.front"}
+        assert resolve_hass_action("light.a", *split_command(command)) == HassAction(
+            "light/turn_on", {"brightness": 128}, "on"
+        )
+        command = {"temperature": 20, "namespace": "other", "entity_id": "climate.x"}
+        assert resolve_hass_action(
+            "climate.den", *split_command(command)
+        ) == HassAction("climate/set_temperature", {"temperature": 20}, None)
+        assert resolve_hass_action("light.a", None, {"entity_id": "light.b"}) is None
+        # The expected hvac_mode is sent, also when it came as the state
+        command = {"state": "heat", "temperature": 20}
+        assert resolve_hass_action(
+            "climate.den", *split_command(command)
+        ) == HassAction(
+            "climate/set_temperature", {"temperature": 20, "hvac_mode": "heat"}, "heat"
+        )
+        command = {"state": "off", "transition": 2, "brightness": 10}
+        assert resolve_hass_action("light.a", *split_command(command)) == HassAction(
+            "light/turn_off", {"transition": 2}, "off"
+        )
+        assert resolve_hass_action("scene.movie", "on").expect is None
+        assert resolve_hass_action("scene.movie", "off") is None
+        assert resolve_hass_action("light.a", "dim") is None
+        assert resolve_hass_action("no_domain", "on") is None
+
+        self.log("**test_group_hass_actions() - all pass!**")
+
     """
     Testing plugins
 
@@ -195,6 +981,280 @@ class TestSyncEntitiesViaMqtt(mqtt.Mqtt):
             namespace="mqtt",
         )
 
+    def test_sync_logger(self, _):
+        log = SyncLogger(self.adapi, sample_every=3, ratelimit_seconds=60)
+
+        # Ratelimited: the first goes out, the rest are only counted
+        for i in range(4):
+            log.warning_ratelimited("test", "test_sync_logger: warning %s", i)
+        assert log._ratelimits["test"][1] == 3
+        log.warning_ratelimited("other", "test_sync_logger: different key")
+        assert log._ratelimits["other"][1] == 0
+
+        # Sampled: nothing is counted (or formatted) below the log level
+        for i in range(7):
+            log.debug_sampled("test", "test_sync_logger: debug %s", i)
+        if log.enabled("DEBUG"):
+            assert log._samples["test"] == 7
+        else:
+            assert "test" not in log._samples
+
+        self.log("**test_sync_logger() - all pass!**")
+
+    def test_mirror_registry(self, _):
+        mirrors = MirrorRegistry()
+        record = mirrors.update("haven", "light.office", "on", seq=10)
+        assert record.local_entity == "sensor.light_office_xxhavenxx"
+        assert mirrors.get("sensor.light_office_xxhavenxx") is record
+        assert mirrors.lookup("haven", "light.office") is record
+        assert not hasattr(record, "__dict__")
+
+        # Out of order - older seq
+        assert mirrors.update("haven", "light.office", "off", seq=9) is None
+        assert record.state == "on"
+        assert mirrors.update("haven", "light.office", "off", seq=11) is record
+        assert record.state == "off"
+
+        mirrors.update("haven", "switch.fan", "on")
+        mirrors.update("cabin", "light.porch", "off")
+        assert len(mirrors) == 3
+        assert mirrors.hosts() == ["cabin", "haven"]
+        assert {r.entity for r in mirrors.by_host("haven")} == {
+            "light.office",
+            "switch.fan",
+        }
+        assert {r.local_entity for r in mirrors.by_domain("light")} == {
+            "sensor.light_office_xxhavenxx",
+            "sensor.light_porch_xxcabinxx",
+        }
+        assert mirrors.resolve_local("sensor.light_porch_xxcabinxx") == (
+            "light.porch",
+            "cabin",
+        )
+        # Not (yet) in the registry - derived from the name
+        assert mirrors.resolve_local("sensor.light_den_xxcabinxx") == (
+            "light.den",
+            "cabin",
+        )
+        assert mirrors.digests()["cabin"] == {"light.porch": state_digest("off")}
+
+        mirrors.remove("sensor.light_porch_xxcabinxx")
+        assert mirrors.hosts() == ["haven"] and mirrors.by_domain("light") == [record]
+
+        # Gone quiet: only mirrors not updated since are marked
+        mirrors.update("haven", "switch.fan", "on", updated_at=100)
+        mirrors.update("haven", "light.office", "on", updated_at=200)
+        marked = mirrors.mark_host("haven", "unavailable", not_since=150)
+        assert [r.entity for r in marked] == ["switch.fan"]
+        assert mirrors.lookup("haven", "switch.fan").state == "unavailable"
+        assert record.state == "on"
+
+        self.log("**test_mirror_registry() - all pass!**")
+
+    def test_mirror_store(self, _):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "mirrors.db")
+            store = MirrorStore(path)
+            assert store.load() == {}
+
+            mirrors = MirrorRegistry()
+            store.put(mirrors.update("haven", "light.a", "on", seq=10))
+            store.put(mirrors.update("haven", "light.b", "off"))
+            store.put(mirrors.update("haven", "light.a", "off", seq=12))
+            assert store.pending() == 2
+            assert store.flush() == 2
+            assert store.flush() == 0
+            store.close()
+
+            store = MirrorStore(path)
+            rows = store.load()
+            assert rows["sensor.light_a_xxhavenxx"].state == "off"
+            assert rows["sensor.light_a_xxhavenxx"].seq == 12
+            assert rows["sensor.light_b_xxhavenxx"].seq is None
+            assert rows["sensor.light_b_xxhavenxx"].host == "haven"
+
+            assert store.delete(["sensor.light_b_xxhavenxx", "sensor.nope"]) == 1
+            assert list(store.load()) == ["sensor.light_a_xxhavenxx"]
+
+            # Forget everything older than -1 seconds, ie: everything
+            assert store.load(forget_seconds=-1) == {}
+            store.close()
+
+        self.log("**test_mirror_store() - all pass!**")
+
+    def test_timer_wheel(self, _):
+        wheel = TimerWheel(slot_seconds=1, slots=8)
+        wheel.schedule("haven", 3, now=100)
+        wheel.schedule("cabin", 20, now=100)  # More than one lap
+        assert len(wheel) == 2
+
+        assert wheel.advance(102) == []
+        wheel.schedule("haven", 3, now=102)  # Refreshed - now due at 105
+        assert wheel.advance(104) == []
+        assert wheel.advance(105) == ["haven"]
+        assert "haven" not in wheel
+
+        wheel.schedule("attic", 2, now=105)
+        wheel.cancel("attic")
+        assert wheel.advance(119) == []
+        assert wheel.advance(120) == ["cabin"]
+        assert len(wheel) == 0
+
+        # Deadline moved earlier
+        wheel.schedule("haven", 10, now=120)
+        wheel.schedule("haven", 1, now=120)
+        assert wheel.advance(121) == ["haven"]
+        assert wheel.advance(131) == []
+
+        self.log("**test_timer_wheel() - all pass!**")
+
+    def test_transport(self, _):
+        published = []
+
+        class FakeMqtt:
+            def mqtt_publish(self, topic, payload, namespace, qos=0):
+                published.append(namespace)
+
+        transport = Transport(
+            FakeMqtt(), ["mqtt", "mqtt_lan"], SyncLogger(self.adapi), probe_timeout=0
+        )
+        transport.publish("mqtt_shared/seattle/all/ping", "x")
+        assert published == ["mqtt"]  # First listed, until measured
+
+        # mqtt_lan answers, mqtt does not
+        probe_mqtt = transport.probe_sent("mqtt")
+        probe_lan = transport.probe_sent("mqtt_lan")
+        assert transport.probe_answered(probe_lan)
+        assert not transport.probe_answered(probe_lan)
+        transport.expire_probes()  # probe_mqtt is lost
+        assert not transport.probe_answered(probe_mqtt)
+        assert transport.active == "mqtt_lan"
+        transport.publish("mqtt_shared/seattle/all/ping", "x")
+        assert published == ["mqtt", "mqtt_lan"]
+
+        # Dedup - only across namespaces
+        topic = "mqtt_shared/haven/seattle/state/light.a"
+        assert transport.accept("mqtt", topic, "on")
+        assert not transport.accept("mqtt_lan", topic, "on")
+        assert transport.accept("mqtt", topic, "on")
+        assert transport.accept("mqtt_lan", topic, "off")
+        assert transport.duplicates == 1
+
+        self.log("**test_transport() - all pass!**")
+
+    def test_lanes(self, _):
+        handled = []
+        drains = []
+
+        class FakeAdapi:
+            def run_in(self, callback, delay, **kwargs):
+                drains.append(callback)
+
+        config = LaneConfig(batch=2)
+        assert config.lane_for("event") == INTERACTIVE
+        assert config.lane_for("state") == BULK
+
+        lanes = Lanes(FakeAdapi(), handled.append, config, SyncLogger(self.adapi))
+        lanes.submit(BULK, "light.a", "a:on")
+        lanes.submit(BULK, "light.b", "b:on")
+        lanes.submit(BULK, "light.c", "c:on")
+        lanes.submit(BULK, "light.a", "a:off")  # Replaces a:on, keeps its place
+        lanes.submit(INTERACTIVE, "light.x", "x:toggle")  # Jumps the queue
+        assert handled == ["x:toggle"]
+        assert len(drains) == 1 and lanes.pending() == 3 and lanes.coalesced == 1
+
+        drains.pop()(None)
+        assert handled == ["x:toggle", "a:off", "b:on"]
+        drains.pop()(None)  # Rescheduled, since there was more
+        assert handled == ["x:toggle", "a:off", "b:on", "c:on"]
+        assert drains == [] and lanes.pending() == 0
+
+        # Only state is merged: two requests to one host are both handled
+        assert config.coalesce_key("state", "t") == "t"
+        assert config.coalesce_key("send_state", "t") is None
+        lanes.submit(BULK, config.coalesce_key("send_state", "t"), "full")
+        lanes.submit(BULK, config.coalesce_key("send_state", "t"), "repair")
+        drains.pop()(None)
+        assert handled[-2:] == ["full", "repair"] and lanes.coalesced == 1
+
+        self.log("**test_lanes() - all pass!**")
+
+    def test_state_cache(self, _):
+        calls = []
+        hass_states = {"light.a": "on", "light.b": "off"}
+
+        class FakeHass:
+            def get_state(self, entity_id=None):
+                calls.append(entity_id)
+                if entity_id is None:
+                    return {entity: {"state": state} for entity, state in hass_states.items()}
+                return hass_states.get(entity_id)
+
+            def listen_state(self, callback, entity):
+                return f"handle-{entity}"
+
+        states = StateCache(FakeHass(), SyncLogger(self.adapi))
+        assert states.get("light.a") == "on"
+        assert states.exists("light.a")
+        assert calls == ["light.a"]  # Second lookup came from the cache
+
+        # Kept current by state change events
+        states._cb_state("light.a", "state", "on", "off", {})
+        assert states.get("light.a") == "off" and calls == ["light.a"]
+
+        # Not cached if it does not exist
+        assert not states.exists("light.nope")
+        assert not states.exists("light.nope")
+        assert calls == ["light.a", "light.nope", "light.nope"]
+
+        # Misses in a batch cost one call
+        assert states.get_many(["light.a", "light.b", "light.nope"]) == {
+            "light.a": "off",
+            "light.b": "off",
+        }
+        assert calls == ["light.a", "light.nope", "light.nope", None]
+        assert states.hits == 3
+
+        self.log("**test_state_cache() - all pass!**")
+
+    def test_state_transforms(self, _):
+        transforms = StateTransforms(
+            {
+                "sensor.house_power": {"round": 0, "deadband": 25, "min_interval": 10},
+                "sensor.*_temperature": {"round": 1, "attributes": ["unit"]},
+            }
+        )
+        assert transforms.transform_for("light.office") is None
+        assert transforms.shape("light.office", "on") == ("on", None)
+        assert transforms.shape("sensor.house_power", "1234.56") == ("1235", None)
+        assert transforms.shape(
+            "sensor.den_temperature",
+            {"state": "20.04", "attributes": {"unit": "C", "friendly_name": "Den"}},
+        ) == ("20.0", {"unit": "C"})
+        assert transforms.shape("sensor.house_power", "unavailable") == (
+            "unavailable",
+            None,
+        )
+
+        # First one always goes
+        assert transforms.check("sensor.house_power", "1235", now=100) == 0
+        transforms.published("sensor.house_power", "1235", now=100)
+        # Within the deadband
+        assert transforms.check("sensor.house_power", "1250", now=200) is None
+        # Outside the deadband, but too soon
+        assert transforms.check("sensor.house_power", "1300", now=104) == 6
+        assert transforms.check("sensor.house_power", "1300", now=110) == 0
+        # Non-numeric - publish on change
+        assert transforms.check("sensor.house_power", "unavailable", now=200) == 0
+
+        # No deadband - only on change (after rounding), or if an attribute changed
+        transforms.published("sensor.den_temperature", "20.0", {"unit": "C"})
+        assert transforms.check("sensor.den_temperature", "20.0", {"unit": "C"}) is None
+        assert transforms.check("sensor.den_temperature", "20.0", {"unit": "F"}) == 0
+        assert transforms.check("sensor.den_temperature", "20.1", {"unit": "C"}) == 0
+
+        self.log("**test_state_transforms() - all pass!**")
+
     def test_plugin_ping_pong(self, _):
         self.log("*** TEST PING/PONG (WILL ONLY SEE RESPONSES IF DEBUG LOGGING)***")
 
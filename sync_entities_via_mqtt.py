@@ -1,8 +1,44 @@
-from typing import List
+import itertools
+import json
+import os
+import tempfile
+import time
+from importlib import import_module, reload
+from typing import List, Optional
 
 import adplus
+from _sync_entities.sync_concurrency import Partitions, partition_key
 from _sync_entities.sync_dispatcher import EventListenerDispatcher
-from _sync_entities.sync_plugin import Plugin
+from _sync_entities.sync_lanes import (
+    BULK,
+    DEFAULT_COALESCE_EVENT_TYPES,
+    DEFAULT_INTERACTIVE_EVENT_TYPES,
+    INTERACTIVE,
+    LaneConfig,
+    Lanes,
+    topic_event_type,
+)
+from _sync_entities.sync_log import SyncLogger
+from _sync_entities.sync_loop_guard import LoopGuard
+from _sync_entities.sync_message_ring import MessageRing
+from _sync_entities.sync_mirror_registry import MirrorRegistry
+from _sync_entities.sync_pacing import AimdPacer
+from _sync_entities.sync_plugin import (
+    DEFAULT_PLUGINS,
+    PLUGIN_REGISTRY,
+    Plugin,
+    load_plugin,
+)
+from _sync_entities.sync_profiler import SAMPLE, ProfileSession
+from _sync_entities.sync_shards import ShardRing
+from _sync_entities.sync_trace import (
+    TraceRecord,
+    TraceReplay,
+    TraceWriter,
+    read_trace,
+    trace_files,
+)
+from _sync_entities.sync_transport import Transport
 from appdaemon.plugins.mqtt import mqttapi as mqtt
 
 # pylint: disable=unused-argument
@@ -28,66 +64,401 @@ class SyncEntitiesViaMqtt(mqtt.Mqtt):
 
     MQTT_DEFAULT_BASE_TOPIC = "mqtt_shared"
 
+    DEV_RELOAD_MODULES = [
+        "_sync_entities.sync_utils",
+        "_sync_entities.sync_log",
+        "_sync_entities.sync_concurrency",
+        "_sync_entities.sync_loop_guard",
+        "_sync_entities.sync_commands",
+        "_sync_entities.sync_mirror_registry",
+        "_sync_entities.sync_digest",
+        "_sync_entities.sync_mirror_store",
+        "_sync_entities.sync_timer_wheel",
+        "_sync_entities.sync_pacing",
+        "_sync_entities.sync_lanes",
+        "_sync_entities.sync_aliases",
+        "_sync_entities.sync_relay",
+        "_sync_entities.sync_state_cache",
+        "_sync_entities.sync_transforms",
+        "_sync_entities.sync_history",
+        "_sync_entities.sync_shards",
+        "_sync_entities.sync_transport",
+        "_sync_entities.sync_trace",
+        "_sync_entities.sync_message_ring",
+        "_sync_entities.sync_profiler",
+        "_sync_entities.sync_domain_handlers",
+        "_sync_entities.sync_dispatcher",
+    ]
+
     SCHEMA = {
         "myhostname": {
             "required": True,
             "type": "string",
             "regex": "^[^-]+$",  # No dashes permitted
         },
+        "instance_id": {
+            "required": False,
+            "type": "string",
+        },
+        "shard_heartbeat_seconds": {
+            "required": False,
+            "type": "number",
+            "default": 10,
+            "min": 1,
+        },
         "mqtt_base_topic": {
             "required": False,
             "type": "string",
             "default": MQTT_DEFAULT_BASE_TOPIC,
         },
+        "mqtt_namespaces": {
+            "required": False,
+            "type": "list",
+            "schema": {"type": "string"},
+            "default": ["mqtt"],
+            "minlength": 1,
+        },
+        "transport_probe_seconds": {
+            "required": False,
+            "type": "number",
+            "default": 30,
+        },
+        "transport_dedup_seconds": {
+            "required": False,
+            "type": "number",
+            "default": 5,
+        },
+        "interactive_event_types": {
+            "required": False,
+            "type": "list",
+            "schema": {"type": "string"},
+            "default": DEFAULT_INTERACTIVE_EVENT_TYPES,
+        },
+        "coalesce_event_types": {
+            "required": False,
+            "type": "list",
+            "schema": {"type": "string"},
+            "default": DEFAULT_COALESCE_EVENT_TYPES,
+        },
+        "lane_qos": {
+            "required": False,
+            "type": "dict",
+            "schema": {
+                INTERACTIVE: {"type": "integer", "allowed": [0, 1, 2], "default": 0},
+                BULK: {"type": "integer", "allowed": [0, 1, 2], "default": 0},
+            },
+            "default": {INTERACTIVE: 0, BULK: 0},
+        },
+        "lane_batch": {
+            "required": False,
+            "type": "integer",
+            "default": 50,
+            "min": 1,
+        },
+        "pacing": {
+            "required": False,
+            "type": "boolean",
+            "default": False,
+        },
+        "pacing_initial_rate": {
+            "required": False,
+            "type": "number",
+            "default": 50,
+            "min": 1,
+        },
+        "pacing_min_rate": {
+            "required": False,
+            "type": "number",
+            "default": 5,
+            "min": 1,
+        },
+        "pacing_max_rate": {
+            "required": False,
+            "type": "number",
+            "default": 500,
+            "min": 1,
+        },
+        "pacing_latency_ms": {
+            "required": False,
+            "type": "number",
+            "default": 100,
+            "min": 1,
+        },
+        "dispatch_partitions": {
+            "required": False,
+            "type": "integer",
+            "default": 16,
+            "min": 1,
+        },
         "state_for_entities": {
             "required": False,
             "type": "list",
             "schema": {"type": "string"},
         },
+        "mirror_store": {
+            "required": False,
+            "type": "string",
+            "nullable": True,
+            "default": None,
+        },
+        "mirror_flush_seconds": {
+            "required": False,
+            "type": "number",
+            "default": 5,
+        },
+        "mirror_forget_days": {
+            "required": False,
+            "type": "number",
+            "default": 7,
+        },
+        "heartbeat_seconds": {
+            "required": False,
+            "type": "number",
+            "default": 60,
+            "min": 0,
+        },
+        "stale_after_heartbeats": {
+            "required": False,
+            "type": "number",
+            "default": 0,
+            "min": 0,
+        },
+        "anti_entropy_seconds": {
+            "required": False,
+            "type": "number",
+            "default": 0,
+            "min": 0,
+        },
+        "anti_entropy_buckets": {
+            "required": False,
+            "type": "integer",
+            "default": 64,
+            "min": 1,
+        },
+        "state_transforms": {
+            "required": False,
+            "type": "dict",
+            "keysrules": {"type": "string"},
+            "valuesrules": {
+                "type": "dict",
+                "schema": {
+                    "round": {"type": "integer", "min": 0},
+                    "deadband": {"type": "number", "min": 0},
+                    "min_interval": {"type": "number", "min": 0},
+                    "attributes": {"type": "list", "schema": {"type": "string"}},
+                },
+            },
+            "default": {},
+        },
+        "alias_publish_seconds": {
+            "required": False,
+            "type": "number",
+            "default": 10,
+            "min": 1,
+        },
+        "history_for_entities": {
+            "required": False,
+            "type": "list",
+            "schema": {"type": "string"},
+            "default": [],
+        },
+        "history_interval": {
+            "required": False,
+            "type": "number",
+            "default": 300,
+            "min": 10,
+        },
+        "history_keep_hours": {
+            "required": False,
+            "type": "number",
+            "default": 24,
+            "min": 1,
+        },
+        "history_store": {
+            "required": False,
+            "type": "string",
+            "nullable": True,
+            "default": None,
+        },
+        "relay_upstream_topic": {
+            "required": False,
+            "type": "string",
+            "nullable": True,
+            "default": None,
+        },
+        "relay_upstream_namespace": {
+            "required": False,
+            "type": "string",
+            "nullable": True,
+            "default": None,
+        },
+        "plugins": {
+            "required": False,
+            "type": "list",
+            "schema": {"type": "string", "allowed": list(PLUGIN_REGISTRY)},
+            "default": DEFAULT_PLUGINS,
+        },
+        "dev_reload": {
+            "required": False,
+            "type": "boolean",
+            "default": False,
+        },
+        "trace_file": {
+            "required": False,
+            "type": "string",
+            "nullable": True,
+            "default": None,
+        },
+        "trace_max_mb": {
+            "required": False,
+            "type": "number",
+            "default": 16,
+            "min": 0.01,
+        },
+        "trace_backups": {
+            "required": False,
+            "type": "integer",
+            "default": 3,
+            "min": 0,
+        },
+        "recent_messages": {
+            "required": False,
+            "type": "integer",
+            "default": 1024,
+            "min": 0,
+        },
+        "log_sample_every": {
+            "required": False,
+            "type": "integer",
+            "default": 100,
+            "min": 1,
+        },
+        "log_ratelimit_seconds": {
+            "required": False,
+            "type": "number",
+            "default": 60,
+        },
+        "loop_suppression": {
+            "required": False,
+            "type": "boolean",
+            "default": False,
+        },
+        "loop_max_hops": {
+            "required": False,
+            "type": "integer",
+            "default": 3,
+        },
+        "command_acks": {
+            "required": False,
+            "type": "boolean",
+            "default": False,
+        },
+        "command_timeout": {
+            "required": False,
+            "type": "number",
+            "default": 10,
+        },
+        "command_window": {
+            "required": False,
+            "type": "integer",
+            "default": 32,
+            "min": 1,
+        },
     }
 
     def initialize(self):
         self.log("Initialize")
         self.adapi = self.get_ad_api()
         self.argsn = adplus.normalized_args(self, self.SCHEMA, self.args, debug=False)
+        dev_reload = self.argsn.get("dev_reload", False)
+        if dev_reload:
+            self._dev_reload()
         self.state_entities = self.argsn.get("state_for_entities")
         self._state_listeners = set()
         self.myhostname = self.argsn.get("myhostname", "HOSTNAME_NOT_SET")
         self.mqtt_base_topic = self.argsn.get(
             "mqtt_base_topic", self.MQTT_DEFAULT_BASE_TOPIC
         )
+        self.loop_guard = LoopGuard(
+            self.myhostname,
+            tag_outbound=self.argsn.get("loop_suppression", False),
+            max_hops=self.argsn.get("loop_max_hops", 3),
+        )
+        self.sync_log = SyncLogger(
+            self.adapi,
+            sample_every=self.argsn.get("log_sample_every", 100),
+            ratelimit_seconds=self.argsn.get("log_ratelimit_seconds", 60),
+        )
+        self.lane_config = LaneConfig(
+            interactive_event_types=frozenset(
+                self.argsn.get(
+                    "interactive_event_types", DEFAULT_INTERACTIVE_EVENT_TYPES
+                )
+            ),
+            qos={INTERACTIVE: 0, BULK: 0, **self.argsn.get("lane_qos", {})},
+            batch=self.argsn.get("lane_batch", 50),
+            coalesce_event_types=frozenset(
+                self.argsn.get("coalesce_event_types", DEFAULT_COALESCE_EVENT_TYPES)
+            ),
+        )
+        # Outbound bulk messages at an adaptive rate. See sync_pacing
+        self.pacer: Optional[AimdPacer] = None
+        if self.argsn.get("pacing", False):
+            self.pacer = AimdPacer(
+                rate=self.argsn.get("pacing_initial_rate", 50),
+                min_rate=self.argsn.get("pacing_min_rate", 5),
+                max_rate=self.argsn.get("pacing_max_rate", 500),
+                latency_target=self.argsn.get("pacing_latency_ms", 100) / 1000,
+            )
+            self.run_every(self._report_pacing, "now", 10)
+        # Several instances of this site, each with a share of the entities. See sync_shards
+        self.shards: Optional[ShardRing] = None
+        if self.argsn.get("instance_id"):
+            self.shards = ShardRing(self.myhostname, self.argsn["instance_id"])
+        self.transport = Transport(
+            self,
+            self.argsn.get("mqtt_namespaces", ["mqtt"]),
+            self.sync_log,
+            dedup_seconds=self.argsn.get("transport_dedup_seconds", 5),
+            probe_timeout=self.argsn.get("transport_probe_seconds", 30),
+            lanes=self.lane_config,
+            pacer=self.pacer,
+            shards=self.shards,
+        )
         self.dispatcher = EventListenerDispatcher(
-            self.get_ad_api(), self.mqtt_base_topic
-        )
-
-        # Required for auto-reloading during development.
-        # Also see "global_dependencies" and "global-modules" in .yaml
-        # pylint: disable=import-outside-toplevel
-        from importlib import reload
-
-        import _sync_entities.sync_dispatcher
-        import _sync_entities.sync_plugin_events
-        import _sync_entities.sync_plugin_inbound_state
-        import _sync_entities.sync_plugin_ping_pong
-        import _sync_entities.sync_plugin_print_all
-        import _sync_entities.sync_utils
-
-        reload(_sync_entities.sync_plugin_ping_pong)
-        reload(_sync_entities.sync_plugin_print_all)
-        reload(_sync_entities.sync_plugin_inbound_state)
-        reload(_sync_entities.sync_plugin_events)
-        reload(_sync_entities.sync_dispatcher)
-        reload(_sync_entities.sync_utils)
-
-        self._plugins = [
-            _sync_entities.sync_plugin_print_all.PluginPrintAll,
-            _sync_entities.sync_plugin_ping_pong.PluginPingPong,
-            _sync_entities.sync_plugin_inbound_state.PluginInboundState,
-            _sync_entities.sync_plugin_events.PluginEvents,
-        ]
+            self.get_ad_api(), self.mqtt_base_topic, self.loop_guard, self.sync_log
+        )
+        # The last N dispatched messages, for dump_recent_messages. See sync_message_ring
+        if self.argsn.get("recent_messages", 1024):
+            self.dispatcher.ring = MessageRing(self.argsn["recent_messages"])
+        self._ring_dumped_at = float("-inf")  # monotonic
+        self.run_in(self._register_dump_service, 0)
+        self.run_in(self._register_profile_service, 0)
+        self.mirrors = MirrorRegistry()
+        self.inbound_lanes = Lanes(
+            self.adapi, self._dispatch, self.lane_config, self.sync_log
+        )
+        self.partitions = Partitions(
+            self._dispatch_now,
+            self.argsn.get("dispatch_partitions", 16),
+            self.sync_log,
+        )
+
+        # Record inbound traffic. See sync_trace
+        self.trace: Optional[TraceWriter] = None
+        if self.argsn.get("trace_file"):
+            self.trace = TraceWriter(
+                self.argsn["trace_file"],
+                max_bytes=int(self.argsn.get("trace_max_mb", 16) * 2**20),
+                backups=self.argsn.get("trace_backups", 3),
+            )
+            self.run_every(self._flush_trace, "now", 5)
+        self._replay: Optional[TraceReplay] = None
+        self.run_in(self._register_replay_service, 0)
 
         self._plugin_handles: List[Plugin] = []
-        for plugin in self._plugins:
+        for name in self.argsn.get("plugins", DEFAULT_PLUGINS):
+            plugin = load_plugin(name, dev_reload)
             self._plugin_handles.append(
                 plugin(
                     self.adapi,
@@ -96,23 +467,248 @@ class SyncEntitiesViaMqtt(mqtt.Mqtt):
                     self.mqtt_base_topic,
                     self.argsn,
                     self.myhostname,
+                    self.transport,
+                    self.mirrors,
+                    self.sync_log,
                 )
             )
 
-        # Note - this will not work if you have previously registered wildcard="#"
-        self.mqtt_unsubscribe(
-            "#", namespace="mqtt"
-        )  # Be safe, though this will hurt other apps. Figure out.
-        self.mqtt_subscribe(f"{self.mqtt_base_topic}/#", namespace="mqtt")
+        for namespace in self.transport.namespaces:
+            # Note - this will not work if you have previously registered wildcard="#"
+            self.mqtt_unsubscribe(
+                "#", namespace=namespace
+            )  # Be safe, though this will hurt other apps. Figure out.
+            self.mqtt_subscribe(f"{self.mqtt_base_topic}/#", namespace=namespace)
 
-        # Dispatch to all mqtt_base_topic events
-        self.listen_event(
-            self.mq_listener,
-            "MQTT_MESSAGE",
-            wildcard=f"{self.mqtt_base_topic}/#",
-            namespace="mqtt",
+            # Dispatch to all mqtt_base_topic events
+            self.listen_event(
+                self._namespace_listener(namespace),
+                "MQTT_MESSAGE",
+                wildcard=f"{self.mqtt_base_topic}/#",
+                namespace=namespace,
+            )
+
+    def _dev_reload(self):
+        """
+        Required for auto-reloading during development.
+        Also see "global_dependencies" and "global-modules" in .yaml
+
+        Plugin modules are reloaded by load_plugin(), and only if configured.
+        """
+        for module_name in self.DEV_RELOAD_MODULES:
+            reload(import_module(module_name))
+
+    def _namespace_listener(self, namespace: str):
+        def namespace_listener(event, data, kwargs):
+            self.mq_listener(event, data, kwargs, namespace)
+
+        return namespace_listener
+
+    def mq_listener(self, event, data, kwargs, namespace: str = "mqtt"):
+        self.sync_log.debug_sampled(
+            "mq_listener", "mq_listener: %s, %s, %.80s", namespace, event, data
         )
+        profile = self.dispatcher.profile
+        if profile is not None:
+            profile.run(self._mq_receive, data, namespace)
+        else:
+            self._mq_receive(data, namespace)
+
+    def _mq_receive(self, data, namespace: str):
+        topic = self.transport.expand(data.get("topic"))
+        if topic is None:
+            return  # Aliased, and we don't have the sender's aliases yet
+        payload = data.get("payload")
+        if self.trace:
+            self.trace.write(namespace, topic, payload)
+        self._receive(topic, payload, namespace)
+
+    def _receive(self, topic: str, payload, namespace: str):
+        if not self.transport.accept(namespace, topic, payload):
+            return  # Already arrived on another namespace
+        event_type = topic_event_type(topic)
+        self.inbound_lanes.submit(
+            self.lane_config.lane_for(event_type),
+            self.lane_config.coalesce_key(event_type, topic),
+            (topic, payload, namespace),
+        )
+
+    def _dispatch(self, item):
+        # Messages for one entity stay in order, the rest may run in parallel on AppDaemon's
+        # worker threads. See sync_concurrency.
+        self.partitions.submit(partition_key(item[0]), item)
+
+    def _dispatch_now(self, item):
+        (topic, payload, namespace) = item
+        profile = self.dispatcher.profile
+        try:
+            if profile is not None:
+                profile.run(self.dispatcher.dispatch, topic, payload, namespace)
+            else:
+                self.dispatcher.dispatch(topic, payload, namespace)
+        except Exception as err:
+            # What led up to it - at most once per log_ratelimit_seconds
+            now = time.monotonic()
+            interval = self.argsn.get("log_ratelimit_seconds", 60)
+            if now - self._ring_dumped_at >= interval:
+                self._ring_dumped_at = now
+                self._dump_recent_messages(f"listener failed: {err}", last=50)
+            raise
+
+    def terminate(self):
+        for plugin in self._plugin_handles:
+            plugin.terminate()
+        if self.dispatcher.profile is not None:
+            self.dispatcher.profile.stop()
+        if self.trace:
+            self.trace.close()
+
+    def _flush_trace(self, kwargs):
+        self.trace.flush()
+
+    def _report_pacing(self, kwargs):
+        """
+        sensor.sync_entities_<myhostname>_publish_rate - messages per second, and how it got there
+        """
+        metrics = self.pacer.metrics()
+        self.set_state(
+            f"sensor.sync_entities_{self.myhostname}_publish_rate",
+            state=metrics.pop("rate"),
+            attributes={
+                **metrics,
+                "backlog": self.transport.outbound.pending(),
+                "unit_of_measurement": "msg/s",
+            },
+            namespace="default",
+        )
+
+    #
+    # Recent messages - see sync_message_ring
+    #
+    def _register_dump_service(self, kwargs):
+        """
+        self.call_service(
+            "sync_entities_via_mqtt/dump_recent_messages",
+            last=100,  # Default: all of them (recent_messages)
+            path="/conf/apps/sync_entities_recent.json",  # Default: to the log
+        )
+        """
+        hass = self.get_plugin_api("HASS")
+        hass.register_service(
+            "sync_entities_via_mqtt/dump_recent_messages", self._cb_dump_service
+        )
+
+    def _cb_dump_service(self, namespace: str, service: str, action: str, kwargs):
+        if self.dispatcher.ring is None:
+            raise RuntimeError("dump_recent_messages - recent_messages is 0 (off)")
+        last = kwargs.get("last")
+        path = kwargs.get("path")
+        if path:
+            with open(path, "w", encoding="utf-8") as file:
+                json.dump(self.dispatcher.ring.entries(last), file, default=str)
+            self.sync_log.info("dump_recent_messages - written to %s", path)
+        else:
+            self._dump_recent_messages("on request", last)
 
-    def mq_listener(self, event, data, kwargs):
-        self.log(f"mq_listener: {event}, {data}", level="DEBUG")
-        self.dispatcher.dispatch(data.get("topic"), data.get("payload"))
+    def _dump_recent_messages(self, reason: str, last: Optional[int] = None):
+        ring = self.dispatcher.ring
+        if ring is None:
+            return
+        lines = ring.lines(last)
+        self.sync_log.warning(
+            "Recent messages (%s, oldest first, %s of %s):\n%s",
+            reason,
+            len(lines),
+            len(ring),
+            "\n".join(lines),
+        )
+
+    #
+    # Profiling - see sync_profiler
+    #
+    def _register_profile_service(self, kwargs):
+        """
+        self.call_service(
+            "sync_entities_via_mqtt/profile",
+            seconds=30,  # Default: 30
+            mode="sample",  # Or "cprofile". Default: sample
+            interval_ms=10,  # Between samples. Default: 10
+            path="/conf/apps/sync_profile",  # Extensions are added. Default: the temp directory
+        )
+        """
+        hass = self.get_plugin_api("HASS")
+        hass.register_service(
+            "sync_entities_via_mqtt/profile", self._cb_profile_service
+        )
+
+    def _cb_profile_service(self, namespace: str, service: str, action: str, kwargs):
+        if self.dispatcher.profile is not None:
+            raise RuntimeError("profile - already profiling")
+        session = ProfileSession(
+            kwargs.get("mode", SAMPLE),
+            interval=float(kwargs.get("interval_ms", 10)) / 1000,
+        )
+        seconds = float(kwargs.get("seconds", 30))
+        stamp = time.strftime("%Y%m%d_%H%M%S")
+        path = kwargs.get("path") or os.path.join(
+            tempfile.gettempdir(), f"sync_entities_profile_{stamp}"
+        )
+        session.start()
+        self.dispatcher.profile = session
+        self.sync_log.info("profile - %s, for %ss", session.mode, seconds)
+        self.run_in(self._profile_done, seconds, path=path)
+
+    def _profile_done(self, kwargs):
+        session = self.dispatcher.profile
+        self.dispatcher.profile = None
+        session.stop()
+        files = session.write(kwargs["path"])
+        line = "%(listener)s: %(calls)s calls, %(total_ms)sms total, %(max_ms)sms max"
+        slowest = [line % row for row in session.listeners.summary()[:5]]
+        self.sync_log.info(
+            "profile - written to %s. Slowest listeners:\n%s", files, "\n".join(slowest)
+        )
+
+    #
+    # Replay - see sync_trace
+    #
+    def _register_replay_service(self, kwargs):
+        """
+        Feeds a recorded trace through the inbound path (lanes, dispatcher, plugins), as if it
+        arrived from mqtt. For a test instance - it *will* set states and run commands.
+
+        self.call_service(
+            "sync_entities_via_mqtt/replay",
+            path="/conf/apps/sync_entities.trace",  # Default: trace_file (with its backups)
+            speed=10,  # 1 = as recorded, 0 = as fast as possible
+        )
+        """
+        hass = self.get_plugin_api("HASS")
+        hass.register_service("sync_entities_via_mqtt/replay", self._cb_replay_service)
+
+    def _cb_replay_service(self, namespace: str, service: str, action: str, kwargs):
+        path = kwargs.get("path") or self.argsn.get("trace_file")
+        files = trace_files(path) if path else []
+        if not files:
+            raise RuntimeError(f"replay - no trace files found: {path}")
+        if self._replay and not self._replay.done:
+            raise RuntimeError("replay - already replaying")
+
+        records = itertools.chain.from_iterable(read_trace(file) for file in files)
+        self._replay = TraceReplay(
+            records, self._replay_record, speed=float(kwargs.get("speed", 1))
+        )
+        self.sync_log.info("replay - %s at speed %s", files, self._replay.speed)
+        self.run_in(self._replay_tick, 0)
+
+    def _replay_record(self, record: TraceRecord):
+        self._receive(record.topic, record.payload, record.namespace)
+
+    def _replay_tick(self, kwargs):
+        replay = self._replay
+        if replay.step(time.monotonic()):
+            self.sync_log.info(
+                "replay - done: %s messages, %.1f/s", replay.handled, replay.rate()
+            )
+            return
+        self.run_in(self._replay_tick, replay.wait(time.monotonic()))